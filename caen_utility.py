@@ -0,0 +1,507 @@
+#!/usr/bin/env python3
+import os
+import fcntl
+import re
+import json
+import datetime
+import typing
+import threading
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+# Each root file is the second of data before the time in its name.
+FILE_WINDOW_NS = 1_000_000_000
+
+CAEN_DIR = Path("/data/raid2/eliza4/he6_cres/betamon/caen")
+# Sorted hit times of each CAEN run and channel (see load_caen_hits).
+CAEN_HIT_CACHE_DIR = Path("/data/raid2/eliza4/he6_cres/katydid_analysis/caen_hit_cache")
+# One lock per cache entry, see hit_cache_lock().
+HIT_CACHE_LOCKS = {}
+HIT_CACHE_LOCKS_LOCK = threading.Lock()
+# Rows of the CompAss csv parsed at a time while building the cache.
+CAEN_CSV_CHUNK_ROWS = 5_000_000
+# Max time between hits on different channels for them to be a coincidence.
+COINCIDENCE_WINDOW_NS = 100
+# Start, end and hit counts of every CAEN run (see load_caen_run_index).
+CAEN_RUN_INDEX_PATH = CAEN_HIT_CACHE_DIR / "caen_run_index.csv"
+CAEN_RUN_INDEX_COLS = [
+    "run_name",
+    "channel",
+    "time_start",
+    "start_ns",
+    "end_ns",
+    "num_hits",
+    "csv_size",
+    "csv_mtime_ns",
+]
+
+
+def utc_ns(times: pd.Series) -> np.ndarray:
+    """
+    int64 ns since the epoch (UTC) of a column of datetimes, either tz aware
+    or naive UTC.
+    """
+    times = pd.to_datetime(times)
+    if times.dt.tz is not None:
+        times = times.dt.tz_convert("UTC").dt.tz_localize(None)
+
+    return times.to_numpy(dtype="datetime64[ns]").astype(np.int64)
+
+
+def hit_times_ns(time_start: datetime.datetime, timetag_ps: np.ndarray) -> np.ndarray:
+    """
+    Absolute UTC times of the CAEN hits of a run, sorted, as int64 ns since
+    the epoch.
+
+    Args:
+        time_start (datetime.datetime): tz aware time.start of the run (from
+            run.info).
+        timetag_ps (np.ndarray): TIMETAG of each hit, ps since time_start.
+
+    Returns:
+        hit_times (np.ndarray): Sorted int64 ns.
+    """
+    start_ns = pd.Timestamp(time_start).tz_convert("UTC").value
+    hit_times = start_ns + np.asarray(timetag_ps, dtype=np.int64) // 1_000
+
+    return np.sort(hit_times, kind="mergesort")
+
+
+def count_hits(
+    hit_times: np.ndarray,
+    window_ends: np.ndarray,
+    window_ns: typing.Union[int, np.ndarray] = FILE_WINDOW_NS,
+) -> np.ndarray:
+    """
+    Number of hits strictly inside (end - window_ns, end) for each end, with
+    two searchsorted calls for all the windows at once instead of a scan of
+    the hits per window. Hits exactly on either edge aren't counted.
+
+    Args:
+        hit_times (np.ndarray): Sorted int64 ns (see hit_times_ns).
+        window_ends (np.ndarray): int64 ns end of each window (see utc_ns).
+        window_ns (int): Length of the windows.
+
+    Returns:
+        counts (np.ndarray): int64 count of each window.
+    """
+    window_ends = np.asarray(window_ends, dtype=np.int64)
+
+    first = np.searchsorted(hit_times, window_ends - window_ns, side="right")
+    last = np.searchsorted(hit_times, window_ends, side="left")
+
+    return np.maximum(last - first, 0)
+
+
+def merge_hit_streams(
+    hit_streams: typing.List[np.ndarray],
+) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """
+    Merges the sorted hit times of several channels into one time ordered
+    stream. The sort is stable (timsort), which on the concatenated sorted
+    channels is a merge of k runs, O(n log k).
+
+    Returns:
+        times (np.ndarray): Sorted int64 ns of all the hits.
+        streams (np.ndarray): Index in hit_streams of each hit.
+    """
+    times = np.concatenate([np.asarray(hits, dtype=np.int64) for hits in hit_streams])
+    streams = np.repeat(np.arange(len(hit_streams)), [len(hits) for hits in hit_streams])
+
+    order = np.argsort(times, kind="stable")
+
+    return times[order], streams[order]
+
+
+def coincidence_times(
+    hit_streams: typing.List[np.ndarray], window_ns: int = COINCIDENCE_WINDOW_NS
+) -> np.ndarray:
+    """
+    Times of the coincidences between the hits of several channels, in one
+    pass over the merged stream instead of comparing the channels pairwise.
+
+    Neighbouring hits in the merged stream that are on different channels
+    and at most window_ns apart are linked. Each hit can be in only one
+    coincidence, so a chain of n links counts ceil(n / 2) coincidences:
+    links 0, 2, 4... of the chain, paired greedily from its start.
+
+    Args:
+        hit_streams (List[np.ndarray]): Sorted int64 ns hit times of each
+            channel (see load_caen_hits).
+        window_ns (int): Coincidence window.
+
+    Returns:
+        times (np.ndarray): Sorted int64 ns of the first hit of each
+            coincidence, ready for count_hits.
+    """
+    times, streams = merge_hit_streams(hit_streams)
+
+    linked = (np.diff(times) <= window_ns) & (streams[1:] != streams[:-1])
+
+    link_index = np.arange(len(linked))
+    starts_chain = linked & ~np.concatenate([[False], linked[:-1]])
+    chain_start = np.maximum.accumulate(np.where(starts_chain, link_index, 0))
+    paired = linked & ((link_index - chain_start) % 2 == 0)
+
+    return times[:-1][paired]
+
+
+def read_caen_time_start(run_name: str, caen_dir: Path = CAEN_DIR) -> str:
+    """
+    time.start of a CAEN run from its run.info, as written there (local
+    time with utc offset, ex: "2025/10/01 10:00:00.123-0700").
+    """
+    run_info_path = Path(caen_dir) / run_name / "run.info"
+    if run_info_path.exists():
+        with run_info_path.open("r") as f:
+            for line in f:
+                if line.startswith("time.start="):
+                    return line.split("=")[1].strip()
+
+    raise UserWarning(f"No time.start in {run_info_path}.")
+
+
+def parse_caen_time_start(time_start: str) -> datetime.datetime:
+    """
+    UTC datetime of a run.info time.start.
+    """
+    dt = datetime.datetime.strptime(time_start, "%Y/%m/%d %H:%M:%S.%f%z")
+
+    return dt.astimezone(datetime.timezone.utc)
+
+
+def caen_data_path(run_name: str, channel: int, caen_dir: Path = CAEN_DIR) -> Path:
+    """
+    CompAss csv of the hits of one channel of a CAEN run.
+    """
+    return Path(caen_dir) / run_name / "RAW" / f"DataR_CH{channel}@DT5725_1146_{run_name}.csv"
+
+
+def hit_cache_lock(npy_path: Path) -> threading.Lock:
+    """
+    The lock of one entry (run/channel/cut) of the hit cache in this process.
+    """
+    with HIT_CACHE_LOCKS_LOCK:
+        return HIT_CACHE_LOCKS.setdefault(str(npy_path), threading.Lock())
+
+
+def load_caen_hits(
+    run_name: str,
+    channel: int,
+    min_energy: typing.Union[None, float] = None,
+    caen_dir: Path = CAEN_DIR,
+    cache_dir: Path = CAEN_HIT_CACHE_DIR,
+) -> np.ndarray:
+    """
+    Sorted absolute UTC hit times (int64 ns, see hit_times_ns) of one channel
+    of a CAEN run, memory-mapped from the hit cache.
+
+    The first time a run/channel/energy cut is asked for, its csv (GBs of
+    semicolon separated text) is parsed once, in chunks, and written to the
+    cache as a .npy plus a .json sidecar with time.start, channel, the cut
+    and the size and mtime of the csv. Afterwards it is only read again if
+    the csv changes.
+
+    Args:
+        run_name (str): Name of the CAEN run directory.
+        channel (int): Digitizer channel (ex: 0 trigger, 4 in the 2023 setup).
+        min_energy (float): Only keep hits with ENERGY > min_energy.
+
+    Returns:
+        hit_times (np.ndarray): Read only memmap of sorted int64 ns.
+    """
+    csv_path = caen_data_path(run_name, channel, caen_dir)
+
+    name = f"{run_name}_CH{channel}"
+    if min_energy is not None:
+        name += f"_E{min_energy:g}"
+    npy_path = Path(cache_dir) / f"{name}.npy"
+    meta_path = Path(cache_dir) / f"{name}.json"
+
+    # Threads asking for the same run/channel/cut wait for the first one to
+    # cache it instead of each parsing the csv.
+    with hit_cache_lock(npy_path):
+        csv_stat = csv_path.stat() if csv_path.exists() else None
+
+        if npy_path.exists() and meta_path.exists():
+            with meta_path.open("r") as f:
+                meta = json.load(f)
+
+            # Keep using the cache if the raw data has been moved off disk.
+            if csv_stat is None or (
+                meta["csv_size"] == csv_stat.st_size and meta["csv_mtime_ns"] == csv_stat.st_mtime_ns
+            ):
+                return np.load(npy_path, mmap_mode="r")
+
+        if csv_stat is None:
+            raise UserWarning(f"No CAEN data at {csv_path}.")
+
+        print(f"Caching CAEN hits of {csv_path}.")
+        time_start = read_caen_time_start(run_name, caen_dir)
+
+        timetags = []
+        for chunk in pd.read_csv(
+            csv_path, sep=";", usecols=["TIMETAG", "ENERGY"], chunksize=CAEN_CSV_CHUNK_ROWS
+        ):
+            if min_energy is not None:
+                chunk = chunk[chunk["ENERGY"] > min_energy]
+            timetags.append(chunk["TIMETAG"].to_numpy(dtype=np.int64))
+
+        timetags = np.concatenate(timetags) if timetags else np.empty(0, dtype=np.int64)
+        hit_times = hit_times_ns(parse_caen_time_start(time_start), timetags)
+
+        meta = {
+            "run_name": run_name,
+            "channel": channel,
+            "time_start": time_start,
+            "min_energy": min_energy,
+            "num_hits": int(len(hit_times)),
+            "csv_size": csv_stat.st_size,
+            "csv_mtime_ns": csv_stat.st_mtime_ns,
+        }
+
+        # Written to tmp files then moved into place (npy first) so that
+        # concurrent jobs never read a partial cache.
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+        tmp_suffix = f".{os.getpid()}.tmp"
+        with open(f"{npy_path}{tmp_suffix}", "wb") as f:
+            np.save(f, hit_times)
+        os.replace(f"{npy_path}{tmp_suffix}", npy_path)
+        with open(f"{meta_path}{tmp_suffix}", "w") as f:
+            json.dump(meta, f, indent=2)
+        os.replace(f"{meta_path}{tmp_suffix}", meta_path)
+
+        return np.load(npy_path, mmap_mode="r")
+
+
+def load_caen_run_index(
+    caen_dir: Path = CAEN_DIR,
+    index_path: Path = CAEN_RUN_INDEX_PATH,
+    before_ns: typing.Union[None, int] = None,
+) -> pd.DataFrame:
+    """
+    Index of all the CAEN runs in caen_dir, one row per run and channel:
+    time.start, start and end (int64 ns UTC), number of hits and the size
+    and mtime of the channel's csv. It is kept at index_path and brought up
+    to date on each load; only new or changed csvs are read.
+
+    The end of a run is the time of the last hit of the channel (CompAss
+    writes the hits of a channel in time order), so it needs one pass over
+    the csv to count the lines, but no parsing.
+
+    The update holds a lock next to index_path, so when many jobs start at
+    once one of them builds the index and the others wait and read it.
+
+    Args:
+        before_ns (int): Only bring runs that start before this time (ns UTC)
+            up to date, so the csvs of later runs (ex: the one being taken)
+            aren't read. Their rows are kept as they are.
+
+    Returns:
+        index (pd.DataFrame): CAEN_RUN_INDEX_COLS, sorted by start_ns.
+    """
+    index_path = Path(index_path)
+    index_path.parent.mkdir(parents=True, exist_ok=True)
+
+    with open(index_path.with_name(f"{index_path.name}.lock"), "a") as lock:
+        # lockf (POSIX locks) rather than flock, as index_path is on NFS.
+        fcntl.lockf(lock, fcntl.LOCK_EX)
+        try:
+            return update_caen_run_index(Path(caen_dir), index_path, before_ns)
+        finally:
+            fcntl.lockf(lock, fcntl.LOCK_UN)
+
+
+def update_caen_run_index(
+    caen_dir: Path, index_path: Path, before_ns: typing.Union[None, int] = None
+) -> pd.DataFrame:
+    """
+    Reads the index at index_path, rescans the new or changed csvs of the
+    runs starting before before_ns and writes it back if anything changed.
+    Called by load_caen_run_index() with the lock held.
+    """
+    if index_path.exists():
+        index = pd.read_csv(index_path)
+    else:
+        index = pd.DataFrame(columns=CAEN_RUN_INDEX_COLS)
+
+    known = {}
+    for row in index.itertuples(index=False):
+        known.setdefault(row.run_name, {})[row.channel] = row
+
+    rows = []
+    changed = False
+    for run_info_path in sorted(caen_dir.glob("*/run.info")):
+        run_name = run_info_path.parent.name
+        known_rows = known.get(run_name, {})
+
+        if known_rows:
+            start_ns = next(iter(known_rows.values())).start_ns
+        else:
+            try:
+                time_start = read_caen_time_start(run_name, caen_dir)
+            except UserWarning as e:
+                print(e)
+                continue
+            start_ns = pd.Timestamp(parse_caen_time_start(time_start)).value
+
+        if before_ns is not None and start_ns > before_ns:
+            rows.extend(row._asdict() for row in known_rows.values())
+            continue
+
+        for csv_path in sorted((run_info_path.parent / "RAW").glob("DataR_CH*@*.csv")):
+            match = re.match(r"DataR_CH(\d+)@", csv_path.name)
+            if match is None:
+                continue
+            channel = int(match.group(1))
+            stat = csv_path.stat()
+
+            row = known_rows.get(channel)
+            if (
+                row is not None
+                and row.csv_size == stat.st_size
+                and row.csv_mtime_ns == stat.st_mtime_ns
+            ):
+                rows.append(row._asdict())
+                continue
+
+            try:
+                time_start = read_caen_time_start(run_name, caen_dir)
+            except UserWarning as e:
+                print(e)
+                continue
+            start_ns = pd.Timestamp(parse_caen_time_start(time_start)).value
+            num_hits, last_timetag = scan_caen_csv(csv_path)
+
+            rows.append(
+                {
+                    "run_name": run_name,
+                    "channel": channel,
+                    "time_start": time_start,
+                    "start_ns": start_ns,
+                    "end_ns": start_ns + last_timetag // 1_000,
+                    "num_hits": num_hits,
+                    "csv_size": stat.st_size,
+                    "csv_mtime_ns": stat.st_mtime_ns,
+                }
+            )
+            changed = True
+
+    index = pd.DataFrame(rows, columns=CAEN_RUN_INDEX_COLS)
+    index = index.sort_values(["start_ns", "run_name", "channel"]).reset_index(drop=True)
+
+    if changed or len(index) != sum(len(known_rows) for known_rows in known.values()):
+        tmp_path = index_path.with_name(f"{index_path.name}.{os.getpid()}.tmp")
+        index.to_csv(tmp_path, index=False)
+        os.replace(tmp_path, index_path)
+
+    return index
+
+
+def scan_caen_csv(csv_path: Path, block_size: int = 1 << 24) -> typing.Tuple[int, int]:
+    """
+    Number of hits and TIMETAG (ps) of the last hit of a CompAss csv, from a
+    count of its lines and its last line. 0, 0 if it has no hits. A last
+    line without its newline is still being written, so it isn't counted.
+    """
+    num_lines = 0
+    with open(csv_path, "rb") as f:
+        header = f.readline().decode().strip().split(";")
+        for block in iter(lambda: f.read(block_size), b""):
+            num_lines += block.count(b"\n")
+
+        if num_lines == 0:
+            return 0, 0
+
+        f.seek(max(0, f.tell() - 4096))
+        tail = f.read()
+        last_line = tail[: tail.rfind(b"\n")].splitlines()[-1].decode().strip()
+
+    return num_lines, int(last_line.split(";")[header.index("TIMETAG")])
+
+
+def overlapping_caen_runs(
+    index: pd.DataFrame,
+    window_ends: np.ndarray,
+    channels: typing.List[int],
+    window_ns: int = FILE_WINDOW_NS,
+) -> pd.DataFrame:
+    """
+    The CAEN runs (with a csv for each of channels) that overlap at least
+    one of the windows (end - window_ns, end). The window ends are sorted
+    once and each run is an interval lookup (two searchsorted) against them.
+
+    Returns:
+        runs (pd.DataFrame): run_name, start_ns and end_ns of each run.
+    """
+    has_channels = index[index["channel"].isin(channels)].groupby("run_name")
+    runs = has_channels.agg(
+        start_ns=("start_ns", "min"),
+        end_ns=("end_ns", "max"),
+        num_channels=("channel", "nunique"),
+    ).reset_index()
+    runs = runs[runs["num_channels"] == len(set(channels))]
+
+    ends = np.sort(np.asarray(window_ends, dtype=np.int64))
+    first = np.searchsorted(ends, runs["start_ns"].to_numpy(dtype=np.int64), side="right")
+    last = np.searchsorted(ends, runs["end_ns"].to_numpy(dtype=np.int64) + window_ns, side="left")
+
+    return runs[last > first][["run_name", "start_ns", "end_ns"]].reset_index(drop=True)
+
+
+def offline_monitor_counts(
+    file_times: pd.Series,
+    channel: int,
+    min_energy: typing.Union[None, float] = None,
+    coincidence_channels: typing.Union[None, typing.List[int]] = None,
+    coincidence_window_ns: int = COINCIDENCE_WINDOW_NS,
+    index: typing.Union[None, pd.DataFrame] = None,
+) -> np.ndarray:
+    """
+    Offline beta monitor counts in the second before each file time, summed
+    over every CAEN run that overlaps that second (so files across a CAEN
+    restart are counted from both runs).
+
+    Args:
+        file_times (pd.Series): UTC time of each file (end of its second).
+        channel (int): Channel to count the hits of.
+        min_energy (float): Only count hits with ENERGY > min_energy.
+        coincidence_channels (List[int]): Count coincidences between these
+            channels instead (see coincidence_times).
+        coincidence_window_ns (int): Coincidence window.
+        index (pd.DataFrame): CAEN run index. Default: load_caen_run_index().
+
+    Returns:
+        counts (np.ndarray): Count of each file, NaN where no CAEN run
+            overlaps its second.
+    """
+    channels = list(coincidence_channels) if coincidence_channels else [channel]
+    window_ends = utc_ns(file_times)
+
+    if index is None:
+        # Runs starting after the last file can't overlap any of them.
+        index = load_caen_run_index(before_ns=window_ends.max() if len(window_ends) else None)
+
+    counts = np.zeros(len(window_ends))
+    covered = np.zeros(len(window_ends), dtype=bool)
+
+    for run_name, start_ns, end_ns in overlapping_caen_runs(
+        index, window_ends, channels
+    ).itertuples(index=False):
+        print(f"Counting offline beta monitor hits in caen run {run_name}")
+        hit_streams = [
+            load_caen_hits(run_name, channel=ch, min_energy=min_energy) for ch in channels
+        ]
+        if coincidence_channels:
+            hit_times = coincidence_times(hit_streams, coincidence_window_ns)
+        else:
+            hit_times = hit_streams[0]
+
+        counts += count_hits(hit_times, window_ends)
+        covered |= (window_ends > start_ns) & (window_ends - FILE_WINDOW_NS < end_ns)
+
+    counts[~covered] = np.nan
+
+    return counts
@@ -9,6 +9,7 @@ from pathlib import Path
 # Local imports.
 from rocks_utility import (
     he6cres_db_query,
+    HE6CRES_DB_BATCH_SIZE,
     get_pst_time,
     set_permissions,
     check_if_exists,
@@ -151,7 +152,8 @@ def check_rga_vs_sql(rga_path: str,
         FROM he6cres_runs.rga
         WHERE created_at BETWEEN '{tmin}'::timestamp AND '{tmax}'::timestamp
     """
-    df_db = he6cres_db_query(query)
+    # The whole window of an RGA log, streamed from the server in batches.
+    df_db = he6cres_db_query(query, batch_size=HE6CRES_DB_BATCH_SIZE)
     if df_db.empty:
         print("No DB rows in this window.")
         return df_log, df_db, [], []
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+import typing
+
+import numpy as np
+from sklearn.cluster import DBSCAN
+
+# Local imports.
+from rocks_utility import parallel_map
+
+
+def dbscan_1d(
+    values: np.ndarray, group_codes: np.ndarray, eps: typing.Union[float, np.ndarray]
+) -> np.ndarray:
+    """
+    DBSCAN with min_samples=1 on a single feature, for many groups at once.
+
+    With one feature and min_samples=1 every point is a core point, so the
+    clusters are just the runs of the sorted values whose gaps are <= eps.
+    One sort by (group, value) and a gap test replace a DBSCAN fit per group.
+    The labels are numbered from 0 within each group in order of the first
+    row of each cluster, the same as sklearn's DBSCAN gives for that group.
+
+    Args:
+        values (np.ndarray): Feature value of each row. Must not be NaN.
+        group_codes (np.ndarray): Integer group of each row (ex: from
+            groupby().ngroup()). Rows with a negative code aren't clustered.
+        eps (float or np.ndarray): Max distance between neighbours, either
+            one for all rows or one per row (constant within a group).
+
+    Returns:
+        labels (np.ndarray): Cluster label of each row, NaN for rows with a
+            negative group code.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    group_codes = np.asarray(group_codes, dtype=np.int64)
+    eps = np.broadcast_to(np.asarray(eps, dtype=np.float64), values.shape)
+
+    labels = np.full(len(values), np.nan)
+
+    rows = np.flatnonzero(group_codes >= 0)
+    if len(rows) == 0:
+        return labels
+
+    values, group_codes, eps = values[rows], group_codes[rows], eps[rows]
+
+    # Sort by group then value, and start a new cluster at each new group or
+    # wherever the gap to the previous value is larger than eps.
+    order = np.lexsort((values, group_codes))
+    sorted_values = values[order]
+    sorted_codes = group_codes[order]
+
+    new_cluster = np.ones(len(order), dtype=bool)
+    new_cluster[1:] = (sorted_codes[1:] != sorted_codes[:-1]) | (
+        np.diff(sorted_values) > eps[order][1:]
+    )
+
+    cluster = np.empty(len(order), dtype=np.int64)
+    cluster[order] = np.cumsum(new_cluster) - 1
+
+    # Renumber the clusters within each group by their first row.
+    num_clusters = cluster.max() + 1
+    first_row = np.full(num_clusters, len(cluster), dtype=np.int64)
+    np.minimum.at(first_row, cluster, np.arange(len(cluster)))
+
+    first_row_group = group_codes[first_row]
+    cluster_order = np.lexsort((first_row, first_row_group))
+    ordered_groups = first_row_group[cluster_order]
+
+    group_start = np.ones(num_clusters, dtype=bool)
+    group_start[1:] = ordered_groups[1:] != ordered_groups[:-1]
+    start_index = np.maximum.accumulate(np.where(group_start, np.arange(num_clusters), 0))
+
+    cluster_label = np.empty(num_clusters, dtype=np.int64)
+    cluster_label[cluster_order] = np.arange(num_clusters) - start_index
+
+    labels[rows] = cluster_label[cluster]
+
+    return labels
+
+
+def dbscan_partitions(
+    X: np.ndarray,
+    partitions: typing.List[np.ndarray],
+    eps: typing.Sequence[float],
+    min_samples: int = 1,
+    workers: int = 1,
+) -> np.ndarray:
+    """
+    sklearn DBSCAN (kd tree neighbour search) run separately on each
+    partition of the rows of X, on a pool of worker processes. For
+    clustering on several features, where dbscan_1d doesn't apply.
+
+    Args:
+        X (np.ndarray): (n_rows, n_features) feature values.
+        partitions (List[np.ndarray]): Row positions of each partition (ex:
+            each (run_id, file_id, Acq_ID)). Rows in no partition aren't
+            clustered.
+        eps (Sequence[float]): eps of each partition.
+        min_samples (int): DBSCAN min_samples.
+        workers (int): Number of worker processes.
+
+    Returns:
+        labels (np.ndarray): Cluster label of each row, numbered within its
+            partition, NaN for rows in no partition.
+    """
+    X = np.asarray(X, dtype=np.float64)
+    labels = np.full(len(X), np.nan)
+
+    # Several partitions per task, balanced by rows, so that the many small
+    # acquisitions don't each pay for a round trip to a worker.
+    sizes = np.array([len(rows) for rows in partitions], dtype=np.int64)
+    num_batches = max(1, min(len(partitions), 4 * workers))
+    batch_of = np.minimum(
+        (np.cumsum(sizes) - sizes) * num_batches // max(sizes.sum(), 1), num_batches - 1
+    )
+    batches = [
+        [(X[partitions[i]], eps[i], min_samples) for i in np.flatnonzero(batch_of == batch)]
+        for batch in range(num_batches)
+    ]
+
+    batch_labels = parallel_map(_dbscan_batch, batches, workers)
+
+    for i, partition_labels in enumerate(
+        partition_labels for batch in batch_labels for partition_labels in batch
+    ):
+        labels[partitions[i]] = partition_labels
+
+    return labels
+
+
+def _dbscan_batch(batch) -> typing.List[np.ndarray]:
+    """
+    DBSCAN labels of each (X, eps, min_samples) in batch. Module level so
+    that it can be sent to the worker processes.
+    """
+    return [
+        DBSCAN(eps=eps, min_samples=min_samples, algorithm="kd_tree").fit(X).labels_
+        for X, eps, min_samples in batch
+    ]
@@ -1,66 +1,176 @@
 #!/usr/bin/env python3
 """
-Helper script to add environment data and compute offline beta monitor event counts for a single run_id.
+Helper script to add environment data and compute offline beta monitor event counts for one run_id,
+or with -rids for many run_ids in one process.
 
-Each compute node should run this script for one run_id in parallel.
-It uses the same PostProcessing class from run_post_processing_2025LTF.py.
+Each compute node can run this script for one run_id in parallel, or one node can do a batch of
+run_ids: their slow control data is then fetched once for all of them, and each CAEN run's hits
+are cached once and memory-mapped by all the run_ids it overlaps. The per-run work runs on a pool
+of threads, and a run that fails is logged and skipped without stopping the others.
 """
 
 import sys
+import traceback
 import pandas as pd
 from pathlib import Path
 from datetime import datetime
-from run_post_processing_2025LTF import PostProcessing
+from concurrent.futures import ThreadPoolExecutor
 
-def count_offline_mon_for_run(run_id: int, analysis_id: int, ms_standard: int = 1):
+# Local imports.
+from caen_utility import COINCIDENCE_WINDOW_NS, load_caen_run_index, offline_monitor_counts, utc_ns
+from env_utility import ENV_TABLES, add_env_logs, fetch_env_logs
+from rocks_utility import root_file_times, write_atomic
+
+ROOT_FILES_DIR = Path("/data/raid2/eliza4/he6_cres/katydid_analysis/root_files")
+# Counted hits: the trigger channel, with a naive cut above the 511s at ADC 4000.
+OFFLINE_MONITOR_CHANNEL = 0
+OFFLINE_MONITOR_MIN_ENERGY = 4000
+
+
+def file_df_paths(run_id: int, analysis_id: int):
     """
-    Loads the per-run CSV, adds offline monitor event counts, and writes an updated CSV.
+    Returns:
+        base, offline (Path, Path): The per-run root_files CSV and the updated
+            CSV written next to it (so the original is not overwritten).
     """
-    print(f"\n[{datetime.now()}] Starting offline monitor count for run_id={run_id}, analysis_id={analysis_id}\n")
-
-    # Instantiate PostProcessing for this run_id (no multi-run or heavy setup)
-    pp = PostProcessing(
-        run_ids=[run_id],
-        analysis_id=analysis_id,
-        experiment_name=None,
-        num_files_tracks=0,
-        num_files_points=0,
-        file_id=0,
-        stage=-1,  # just using its utilities
-        ms_standard=ms_standard,
-    )
+    rid_ai_dir = ROOT_FILES_DIR / f"rid_{run_id:04d}" / f"aid_{analysis_id:03d}"
 
-    # Path to per-run root_files CSV
-    file_df_path, file_exists_flag = pp.build_file_df_path(run_id)
-    print(file_df_path)
-    if not file_exists_flag:
-        raise FileNotFoundError(f"Missing file_df for run_id {run_id}: {file_df_path}")
+    base = rid_ai_dir / f"rid_df_{run_id:04d}_{analysis_id:03d}.csv"
+    offline = rid_ai_dir / f"rid_df_{run_id:04d}_{analysis_id:03d}_with_offline_mon.csv"
+
+    return base, offline
+
+
+def load_file_df(file_df_path: Path) -> pd.DataFrame:
+    """
+    Reads a per-run root_files CSV and adds the tz aware pst_time and utc_time of each file.
+    """
+    if not file_df_path.exists():
+        raise FileNotFoundError(f"Missing file_df: {file_df_path}")
 
-    print(f"Loading {file_df_path}")
     file_df = pd.read_csv(file_df_path)
+    file_df["pst_time"] = root_file_times(file_df["root_file_path"]).dt.tz_localize("US/Pacific")
+    file_df["utc_time"] = file_df["pst_time"].dt.tz_convert("UTC")
+
+    return file_df
+
+
+def count_offline_mon_for_runs(
+    run_ids,
+    analysis_id: int,
+    ms_standard: int = 1,
+    coincidence_channels=None,
+    coincidence_window_ns: int = COINCIDENCE_WINDOW_NS,
+    workers: int = 1,
+):
+    """
+    Loads the per-run CSVs, adds environmental data and offline monitor event counts, and writes
+    an updated CSV per run_id. The slow control logs and the CAEN run index are fetched once for
+    all the run_ids; reading, counting and writing each run is done on a pool of workers threads.
+    A run that fails is printed and skipped, the others are still written.
+
+    Args:
+        ms_standard (int): Unused, root_file_times() reads both file name formats. Kept for the
+            command line.
+
+    Returns:
+        out_paths (List[Path]): The updated CSV of each run_id that succeeded.
+    """
+    run_ids = list(run_ids)
+    print(f"\n[{datetime.now()}] Starting offline monitor count for run_ids={run_ids}, analysis_id={analysis_id}\n")
+
+    failed = []
+
+    def attempt(func, run_id):
+        try:
+            return func(run_id)
+        except Exception:
+            print(f"run_id {run_id} failed:\n{traceback.format_exc()}")
+            failed.append(run_id)
+            return None
+
+    def load(run_id):
+        return load_file_df(file_df_paths(run_id, analysis_id)[0])
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        file_dfs = dict(zip(run_ids, executor.map(lambda run_id: attempt(load, run_id), run_ids)))
+    file_dfs = {run_id: file_df for run_id, file_df in file_dfs.items() if file_df is not None}
+    print(f"Loaded {sum(len(file_df) for file_df in file_dfs.values())} files for {len(file_dfs)} run_ids.")
+
+    out_paths = []
+    if file_dfs:
+        all_files = pd.concat(file_dfs.values(), ignore_index=True)
 
-    # Add other environmental data
-    updated_df = pp.add_env_data(file_df)
+        # One fetch per slow control table for all the run_ids, joined back per run_id.
+        logs = fetch_env_logs(all_files, ENV_TABLES)
 
-    # Compute offline monitor counts
-    updated_df = pp.add_offline_monitor_counts(updated_df)
+        # Runs starting after the last file can't overlap any of them.
+        window_ends = utc_ns(all_files["utc_time"])
+        index = load_caen_run_index(before_ns=window_ends.max() if len(window_ends) else None)
 
-    # Write to new CSV (avoid overwriting original)
-    out_path = file_df_path.with_name(file_df_path.stem + "_with_offline_mon.csv")
-    updated_df.to_csv(out_path, index=False)
-    print(f"Wrote updated file: {out_path}")
+        def count_and_write(run_id):
+            file_df = add_env_logs(file_dfs[run_id], logs)
 
-    print(f"\n[{datetime.now()}] Finished offline monitor count for run_id={run_id}\n")
+            file_df["offline_monitor_counts"] = offline_monitor_counts(
+                file_df["utc_time"],
+                channel=OFFLINE_MONITOR_CHANNEL,
+                min_energy=OFFLINE_MONITOR_MIN_ENERGY,
+                coincidence_channels=coincidence_channels,
+                coincidence_window_ns=coincidence_window_ns,
+                index=index,
+            )
+            if file_df["offline_monitor_counts"].isnull().values.any():
+                print(f"Some files of run_id {run_id} are outside of all the CAEN runs, no offline monitor counts.")
 
-    return out_path
+            out_path = file_df_paths(run_id, analysis_id)[1]
+            write_atomic(out_path, lambda tmp_path: file_df.to_csv(tmp_path, index=False))
+            print(f"Wrote updated file: {out_path}")
+            return out_path
+
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            written = executor.map(lambda run_id: attempt(count_and_write, run_id), list(file_dfs))
+            out_paths = [out_path for out_path in written if out_path is not None]
+
+    print(f"\n[{datetime.now()}] Finished offline monitor count for run_ids={run_ids}\n")
+    if failed:
+        print(f"Failed run_ids: {sorted(failed)}")
+
+    return out_paths
+
+
+def count_offline_mon_for_run(
+    run_id: int,
+    analysis_id: int,
+    ms_standard: int = 1,
+    coincidence_channels=None,
+    coincidence_window_ns: int = COINCIDENCE_WINDOW_NS,
+):
+    """
+    Loads the per-run CSV, adds offline monitor event counts, and writes an updated CSV.
+    """
+    out_paths = count_offline_mon_for_runs(
+        [run_id],
+        analysis_id,
+        ms_standard=ms_standard,
+        coincidence_channels=coincidence_channels,
+        coincidence_window_ns=coincidence_window_ns,
+    )
+    if not out_paths:
+        raise UserWarning(f"Offline monitor count failed for run_id {run_id}.")
+
+    return out_paths[0]
 
 
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser(
-        description="Compute offline beta monitor event counts for a single run_id."
+        description="Compute offline beta monitor event counts for a single run_id, or many with -rids."
+    )
+    run_id_args = parser.add_mutually_exclusive_group(required=True)
+    run_id_args.add_argument("-rid", "--run_id", type=int, help="Run ID to process.")
+    run_id_args.add_argument(
+        "-rids", "--run_ids", nargs="+", type=int, help="Run IDs to process together in this process."
     )
-    parser.add_argument("-rid", "--run_id", type=int, required=True, help="Run ID to process.")
     parser.add_argument("-aid", "--analysis_id", type=int, required=True, help="Analysis ID.")
     parser.add_argument(
         "-ms",
@@ -69,6 +179,39 @@ if __name__ == "__main__":
         default=1,
         help="0 = filename to second precision, 1 = filename includes milliseconds (default=1).",
     )
+    parser.add_argument(
+        "-coincidence_channels",
+        "--coincidence-channels",
+        nargs="+",
+        type=int,
+        default=None,
+        help="Count coincidences between these CAEN channels instead of single channel hits.",
+    )
+    parser.add_argument(
+        "-coincidence_window_ns",
+        "--coincidence-window-ns",
+        type=int,
+        default=COINCIDENCE_WINDOW_NS,
+        help=f"Max ns between hits on different channels of a coincidence (default={COINCIDENCE_WINDOW_NS}).",
+    )
+    parser.add_argument(
+        "-workers",
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of threads reading and writing the per-run CSVs (default=1).",
+    )
 
     args = parser.parse_args()
-    count_offline_mon_for_run(args.run_id, args.analysis_id, ms_standard=args.ms_standard)
+    run_ids = [args.run_id] if args.run_ids is None else args.run_ids
+    out_paths = count_offline_mon_for_runs(
+        run_ids,
+        args.analysis_id,
+        ms_standard=args.ms_standard,
+        coincidence_channels=args.coincidence_channels,
+        coincidence_window_ns=args.coincidence_window_ns,
+        workers=args.workers,
+    )
+    # Non-zero exit so the job shows up as failed, after the other runs are written.
+    if len(out_paths) < len(run_ids):
+        sys.exit(1)
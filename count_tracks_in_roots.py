@@ -10,42 +10,31 @@ from pathlib import Path
 import pandas as pd
 import uproot
 
+from root_utility import TRACK_TREES, find_track_tree, get_branch, missing_branches
+
 
 def count_tree_entries(root_path):
     try:
         with uproot.open(root_path) as f:
             keys = set(f.keys())
+            tree_type = find_track_tree(keys)
 
-            if "MB-events;1" in keys:
-                tree = f["MB-events;1"]
-                return {
-                    "tree_type": "MB-events",
-                    "entries": tree.num_entries,
-                    "keys": ",".join(f.keys()),
-                    "error": "",
-                }
-
-            if "tracks;1" in keys:
-                tree = f["tracks;1"]
+            if tree_type is None:
                 return {
-                    "tree_type": "tracks",
-                    "entries": tree.num_entries,
+                    "tree_type": "NO_RECOGNIZED_TRACK_TREE",
+                    "entries": 0,
+                    "missing_branches": "",
                     "keys": ",".join(f.keys()),
                     "error": "",
                 }
 
-            if "multiTrackEvents;1" in keys:
-                tree = f["multiTrackEvents;1"]
-                return {
-                    "tree_type": "multiTrackEvents",
-                    "entries": tree.num_entries,
-                    "keys": ",".join(f.keys()),
-                    "error": "",
-                }
+            tree = TRACK_TREES[tree_type]
 
+            # Check the branch schema against the branch names only.
             return {
-                "tree_type": "NO_RECOGNIZED_TRACK_TREE",
-                "entries": 0,
+                "tree_type": tree_type,
+                "entries": f[tree["key"]].num_entries,
+                "missing_branches": ",".join(missing_branches(get_branch(f, tree), tree)),
                 "keys": ",".join(f.keys()),
                 "error": "",
             }
@@ -54,6 +43,7 @@ def count_tree_entries(root_path):
         return {
             "tree_type": "ERROR",
             "entries": 0,
+            "missing_branches": "",
             "keys": "",
             "error": repr(exc),
         }
@@ -105,6 +95,8 @@ def main():
 
         if out["error"]:
             print(f"    ERROR: {out['error']}", flush=True)
+        if out["missing_branches"]:
+            print(f"    MISSING BRANCHES: {out['missing_branches']}", flush=True)
 
     out_df = pd.DataFrame(rows)
 
@@ -134,9 +126,13 @@ def main():
             .to_string(index=False)
         )
 
-    bad = out_df[(out_df["tree_type"] == "ERROR") | (out_df["tree_type"] == "NO_RECOGNIZED_TRACK_TREE")]
+    bad = out_df[
+        (out_df["tree_type"] == "ERROR")
+        | (out_df["tree_type"] == "NO_RECOGNIZED_TRACK_TREE")
+        | (out_df["missing_branches"] != "")
+    ]
     if len(bad):
-        print("\nFiles with errors or no recognized track tree:")
+        print("\nFiles with errors, no recognized track tree or missing branches:")
         cols = [
             "run_id",
             "file_id",
@@ -144,6 +140,7 @@ def main():
             "analysis_variant",
             "set_field",
             "tree_type",
+            "missing_branches",
             "error",
             "keys",
             "root_file_path",
@@ -0,0 +1,486 @@
+#!/usr/bin/env python3
+import typing
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+# Local imports.
+from rocks_utility import he6cres_db_query, he6cres_db_query_cached
+
+# Slow control tables used in add_env_data: name -> (query, time column). See query_run_logs().
+ENV_QUERIES = {
+    "monitor": (
+        """SELECT m.monitor_id, m.created_at, m.rate
+           FROM he6cres_runs.monitor as m 
+           WHERE {}
+        """,
+        "m.created_at",
+    ),
+    # Note that I also need to make sure the field probe was locked! (see nearest_join require)
+    "nmr": (
+        """SELECT n.nmr_id, n.created_at, n.field, n.locked
+           FROM he6cres_runs.nmr as n 
+           WHERE {}
+        """,
+        "n.created_at",
+    ),
+    "rga": (
+        """SELECT r.utc_write_time, r.nitrogen, r.helium, r.co2, r.hydrogen, r.water, r.oxygen, r.krypton, r.argon, r.cf3, r.a19, r.total
+           FROM he6cres_runs.rga as r 
+           WHERE {}
+               AND r.time_since_write < 60.0
+        """,
+        "r.utc_write_time",
+    ),
+    "endpoint": (
+        """SELECT e.endpoint_id, e.timestamp, e.value_raw
+           FROM public.endpoint_numeric_data as e
+           WHERE {}
+        """,
+        "e.timestamp",
+    ),
+    "dmm": (
+        """SELECT n.dmm_id, n.utc_write_time, n.voltage
+           FROM he6cres_runs.dmm as n 
+           WHERE {}
+        """,
+        "n.utc_write_time",
+    ),
+}
+# The tables add_env_logs() joins to the files.
+ENV_TABLES = ["nmr", "monitor", "rga", "endpoint", "dmm"]
+# Max slow control tables fetched at once (each on its own db connection).
+ENV_MAX_CONNECTIONS = 3
+
+# What the server side nearest lookup (see query_nearest_logs) has to do on
+# top of ENV_QUERIES to pick the same row that nearest_join picks:
+#   condition: only rows nearest_join can match (ex: add_field require="locked").
+#   key: (column, values). One nearest row per value, for tables that
+#       nearest_join matches by that column too (ex: add_temps endpoint_id).
+ENV_NEAREST_OPTIONS = {
+    "nmr": {"condition": "n.locked"},
+    "endpoint": {"key": ("e.endpoint_id", [7, 8, 9, 10, 11, 12, 13, 14])},
+}
+
+
+def check_one_file_per_id(root_files_df: pd.DataFrame) -> None:
+    """
+    Raises a UserWarning if any (run_id, file_id) has more than one file.
+    """
+    duplicated = root_files_df.duplicated(["run_id", "file_id"], keep=False)
+    if duplicated.any():
+        rid, fid = root_files_df.loc[duplicated, ["run_id", "file_id"]].iloc[0]
+        raise UserWarning(
+            f"There should be only one file with run_id = {rid} and file_id = {fid}."
+        )
+
+    return None
+
+
+def run_time_windows(root_files_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Slow control time window of each run_id: from the first file time
+    floored to the minute to one minute past the last file time floored to
+    the minute. Naive UTC.
+
+    Returns:
+        windows (pd.DataFrame): run_id, start and end of each window.
+    """
+    utc_time = root_files_df.groupby("run_id")["utc_time"]
+    windows = pd.DataFrame(
+        {
+            "start": utc_time.min().dt.floor("min").dt.tz_localize(None),
+            "end": utc_time.max().dt.floor("min").dt.tz_localize(None)
+            + pd.Timedelta(minutes=1),
+        }
+    )
+
+    return windows.reset_index()
+
+
+def merge_windows(windows: pd.DataFrame) -> typing.List[typing.Tuple[pd.Timestamp, pd.Timestamp]]:
+    """
+    Merges overlapping (or touching) [start, end] windows into the minimal
+    list of disjoint ranges that cover them, in time order.
+    """
+    ranges = []
+    for start, end in windows.sort_values("start")[["start", "end"]].itertuples(index=False):
+        if ranges and start <= ranges[-1][1]:
+            ranges[-1] = (ranges[-1][0], max(ranges[-1][1], end))
+        else:
+            ranges.append((start, end))
+
+    return ranges
+
+
+def query_run_logs(root_files_df: pd.DataFrame, query: str, time_col: str) -> pd.DataFrame:
+    """
+    Gets a slow control log for the time window of each run_id in
+    root_files_df (see run_time_windows). The windows of all the runs are
+    merged into disjoint ranges and fetched in a single query (through the
+    slow control cache, see he6cres_db_query_cached), then split back up per
+    run_id locally.
+
+    Args:
+        root_files_df (pd.DataFrame): Files, with run_id and a UTC utc_time.
+        query (str): Query with one {} in its WHERE clause, that is filled
+            with the condition on time_col.
+        time_col (str): Timestamp column (naive UTC) of the log, as named
+            in the query (ex: "m.created_at").
+
+    Returns:
+        log (pd.DataFrame): The rows in the window of each run_id, with a
+            run_id column and the UTC time in created_at. Rows in the
+            windows of several runs appear once per run.
+    """
+    windows = run_time_windows(root_files_df)
+    if windows.empty:
+        return pd.DataFrame(columns=["run_id", "created_at"])
+
+    log = he6cres_db_query_cached(query, time_col, merge_windows(windows))
+    if log is None or log.empty:
+        return pd.DataFrame(columns=["run_id", "created_at"])
+
+    # Name of the column in the result.
+    time_col = time_col.split(".")[-1]
+
+    log[time_col] = pd.to_datetime(log[time_col])
+    log = log.sort_values(time_col, kind="mergesort").reset_index(drop=True)
+    times = log[time_col].to_numpy()
+
+    # Split the rows back up into the window of each run.
+    logs = []
+    for rid, start, end in windows[["run_id", "start", "end"]].itertuples(index=False):
+        first = np.searchsorted(times, np.datetime64(start), side="left")
+        last = np.searchsorted(times, np.datetime64(end), side="right")
+        logs.append(log.iloc[first:last].assign(run_id=rid))
+
+    log = pd.concat(logs, ignore_index=True)
+
+    # This is NOT always the same as the created_at field in the db, the
+    # more accurate write time is used where there is one.
+    log["created_at"] = log[time_col].dt.tz_localize("UTC")
+
+    return log
+
+
+def query_nearest_logs(
+    root_files_df: pd.DataFrame,
+    query: str,
+    time_col: str,
+    condition: typing.Union[None, str] = None,
+    key: typing.Union[None, typing.Tuple[str, typing.List[int]]] = None,
+) -> pd.DataFrame:
+    """
+    Like query_run_logs(), but only the log rows that can be the nearest to
+    a file come back from he6cres_db: for each file, the last row before its
+    utc_time and the first row at or after it, within the window of its
+    run_id. The file times are sent up as arrays and each row is found with
+    an ORDER BY time_col LIMIT 1 in a LATERAL subquery, so it is an index
+    lookup on the server instead of downloading the whole window.
+
+    nearest_join() on the result gives the same values as on the
+    query_run_logs() log, as long as condition and key cover what
+    nearest_join filters and matches on (see ENV_NEAREST_OPTIONS).
+
+    Args:
+        root_files_df (pd.DataFrame): Files, with run_id and a UTC utc_time.
+        query (str): Query with one {} in its WHERE clause (see ENV_QUERIES).
+        time_col (str): Timestamp column (naive UTC) of the log, as named
+            in the query (ex: "m.created_at").
+        condition (str): Extra SQL condition on the rows (ex: "n.locked").
+        key (Tuple[str, List[int]]): (column, values). Look up the nearest
+            rows for each of the values of column separately.
+
+    Returns:
+        log (pd.DataFrame): At most two rows per file (and key value), with
+            a run_id column and the UTC time in created_at.
+    """
+    windows = run_time_windows(root_files_df)
+    files = root_files_df[["run_id", "utc_time"]].dropna().merge(windows, on="run_id")
+    if files.empty:
+        return pd.DataFrame(columns=["run_id", "created_at"])
+
+    def timestamps(times: pd.Series) -> typing.List[str]:
+        if times.dt.tz is not None:
+            times = times.dt.tz_convert("UTC").dt.tz_localize(None)
+        return times.dt.strftime("%Y-%m-%d %H:%M:%S.%f").tolist()
+
+    params = [
+        files["run_id"].astype(np.int64).tolist(),
+        timestamps(files["utc_time"]),
+        timestamps(files["start"]),
+        timestamps(files["end"]),
+    ]
+
+    extra = "" if condition is None else f" AND ({condition})"
+    key_join = ""
+    if key is not None:
+        key_col, key_values = key
+        key_join = "CROSS JOIN unnest(%s::bigint[]) AS k(key)"
+        extra += f" AND {key_col} = k.key"
+        params.append([int(value) for value in key_values])
+
+    after = query.format(
+        f"{time_col} >= f.utc_time AND {time_col} <= f.window_end{extra}"
+    ) + f" ORDER BY {time_col} ASC LIMIT 1"
+    before = query.format(
+        f"{time_col} < f.utc_time AND {time_col} >= f.window_start{extra}"
+    ) + f" ORDER BY {time_col} DESC LIMIT 1"
+
+    nearest_query = f"""SELECT f.run_id, x.*
+           FROM unnest(%s::bigint[], %s::timestamp[], %s::timestamp[], %s::timestamp[])
+               AS f(run_id, utc_time, window_start, window_end)
+           {key_join}
+           CROSS JOIN LATERAL (
+               ({after})
+               UNION ALL
+               ({before})
+           ) AS x
+        """
+
+    log = he6cres_db_query(nearest_query, params=params)
+    if log is None or log.empty:
+        return pd.DataFrame(columns=["run_id", "created_at"])
+
+    # Neighbouring files mostly share their nearest rows.
+    log = log.drop_duplicates().reset_index(drop=True)
+
+    time_col = time_col.split(".")[-1]
+    log[time_col] = pd.to_datetime(log[time_col])
+    log["created_at"] = log[time_col].dt.tz_localize("UTC")
+
+    return log
+
+
+def fetch_env_logs(
+    root_files_df: pd.DataFrame,
+    tables: typing.List[str],
+    max_connections: int = ENV_MAX_CONNECTIONS,
+    nearest_on_server: bool = False,
+) -> typing.Dict[str, pd.DataFrame]:
+    """
+    query_run_logs() for several ENV_QUERIES tables at the same time, in a
+    pool of at most max_connections threads. The tables are independent and
+    the time is mostly spent waiting on he6cres_db.
+
+    Args:
+        nearest_on_server (bool): Use query_nearest_logs() instead, so that
+            only the rows nearest each file are transferred. Less data, more
+            work for the db.
+
+    Returns:
+        logs (Dict[str, pd.DataFrame]): table -> log, once all have arrived.
+    """
+
+    def fetch(table: str) -> pd.DataFrame:
+        if nearest_on_server:
+            return query_nearest_logs(
+                root_files_df, *ENV_QUERIES[table], **ENV_NEAREST_OPTIONS.get(table, {})
+            )
+        return query_run_logs(root_files_df, *ENV_QUERIES[table])
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_connections, len(tables)))) as executor:
+        futures = {table: executor.submit(fetch, table) for table in tables}
+        return {table: future.result() for table, future in futures.items()}
+
+
+def nearest_join(
+    left: pd.DataFrame,
+    right: pd.DataFrame,
+    columns: typing.List[str],
+    on: str = "utc_time",
+    right_on: str = "created_at",
+    by: typing.Union[None, typing.List[str]] = None,
+    tolerance: typing.Union[None, pd.Timedelta] = None,
+    require: typing.Union[None, str] = None,
+) -> pd.DataFrame:
+    """
+    For each row of left, the columns of the row of right nearest in time.
+    One sort and one merge_asof instead of a scan of right per row.
+
+    Args:
+        left (pd.DataFrame): Rows to look up (ex: root_files_df).
+        right (pd.DataFrame): Log to look them up in.
+        columns (List[str]): Columns of right to return.
+        on (str): Time column of left.
+        right_on (str): Time column of right, same dtype as on.
+        by (List[str]): Columns that must also match (ex: ["run_id"]).
+        tolerance (pd.Timedelta): Only match log rows at most this far
+            away. Default: any distance.
+        require (str): Boolean column of right (ex: "locked"). Only rows
+            where it is True are matched.
+
+    Returns:
+        values (pd.DataFrame): columns, with the index of left. NaN where
+            there is no match.
+    """
+    by = [] if by is None else list(by)
+
+    if require is not None and not right.empty:
+        right = right[right[require].fillna(False).astype(bool)]
+
+    right = right.dropna(subset=[right_on])
+    if right.empty:
+        return pd.DataFrame(np.nan, index=left.index, columns=columns)
+
+    left_keys = left[by + [on]].copy()
+    left_keys["_row"] = np.arange(len(left))
+
+    # Ties go to the earlier log row.
+    merged = pd.merge_asof(
+        left_keys.sort_values(on, kind="mergesort"),
+        right[by + [right_on] + columns].sort_values(right_on, kind="mergesort"),
+        left_on=on,
+        right_on=right_on,
+        by=by if by else None,
+        direction="nearest",
+        tolerance=tolerance,
+    )
+
+    values = merged.sort_values("_row")[columns]
+    values.index = left.index
+
+    return values
+
+
+def add_arduino_monitor_rate(root_files_df: pd.DataFrame, monitor_log=None) -> pd.DataFrame:
+    """
+    Adds the arduino_monitor_rate nearest each file. Raises a UserWarning if
+    any file has none.
+    """
+    check_one_file_per_id(root_files_df)
+
+    # One query for all the run_ids, then one nearest-time join for all files.
+    if monitor_log is None:
+        monitor_log = query_run_logs(root_files_df, *ENV_QUERIES["monitor"])
+
+    root_files_df["arduino_monitor_rate"] = nearest_join(
+        root_files_df, monitor_log, ["rate"], by=["run_id"]
+    )["rate"]
+
+    if root_files_df["arduino_monitor_rate"].isnull().values.any():
+        raise UserWarning("Some arduino_monitor_rate data was not collected.")
+
+    return root_files_df
+
+
+def add_field(root_files_df: pd.DataFrame, field_log=None) -> pd.DataFrame:
+    """
+    Adds the locked nmr field nearest each file.
+    """
+    check_one_file_per_id(root_files_df)
+
+    if field_log is None:
+        field_log = query_run_logs(root_files_df, *ENV_QUERIES["nmr"])
+
+    # Get field during second of data
+    root_files_df["field"] = nearest_join(
+        root_files_df, field_log, ["field"], by=["run_id"], require="locked"
+    )["field"]
+
+    if root_files_df["field"].isnull().values.any():
+        print("Some nmr data was not collected.")
+
+    return root_files_df
+
+
+def add_pressures(root_files_df: pd.DataFrame, rga_log=None) -> pd.DataFrame:
+    """
+    Adds the rga partial pressure of each gas (and the total) nearest each file.
+    """
+    gases = [
+        "nitrogen", "helium", "co2", "hydrogen",
+        "water", "oxygen", "krypton", "argon",
+        "cf3", "a19", "total"
+    ]
+    check_one_file_per_id(root_files_df)
+
+    if rga_log is None:
+        rga_log = query_run_logs(root_files_df, *ENV_QUERIES["rga"])
+
+    # Assign values for all gases at once
+    root_files_df = root_files_df.assign(
+        **nearest_join(root_files_df, rga_log, gases, by=["run_id"])
+    )
+
+    if root_files_df["total"].isnull().values.any():
+        print("Some rga data was not collected.")
+
+    return root_files_df
+
+
+def add_temps(root_files_df: pd.DataFrame, temp_log=None) -> pd.DataFrame:
+    """
+    Adds the temperature sensors A-H (endpoints 7-14) nearest each file.
+    """
+    epts = [7, 8, 9, 10, 11, 12, 13, 14]
+    sensor_names = ['A', 'B', 'C', 'D', 'E', 'F', 'G', 'H']
+    check_one_file_per_id(root_files_df)
+
+    if temp_log is None:
+        temp_log = query_run_logs(root_files_df, *ENV_QUERIES["endpoint"])
+
+    # Match each file to the nearest reading of each endpoint.
+    endpoints = pd.DataFrame({"endpoint_id": epts, "sensor": sensor_names})
+    files = root_files_df[["run_id", "utc_time"]].reset_index(drop=True)
+    file_endpoints = files.assign(row=files.index).merge(endpoints, how="cross")
+    file_endpoints["temp"] = nearest_join(
+        file_endpoints, temp_log, ["value_raw"], by=["run_id", "endpoint_id"]
+    )["value_raw"].to_numpy()
+
+    temps = file_endpoints.pivot(index="row", columns="sensor", values="temp")
+    temps = temps.reindex(index=files.index, columns=sensor_names)
+    temps.index = root_files_df.index
+    root_files_df = root_files_df.assign(**temps)
+
+    if root_files_df[sensor_names].isnull().any().any():
+        print("Some temp data was not collected.")
+
+    return root_files_df
+
+
+def add_voltage(root_files_df: pd.DataFrame, voltage_log=None) -> pd.DataFrame:
+    """
+    Adds the dmm voltage nearest each file.
+    """
+    check_one_file_per_id(root_files_df)
+
+    if voltage_log is None:
+        voltage_log = query_run_logs(root_files_df, *ENV_QUERIES["dmm"])
+
+    # Get voltage during second of data
+    root_files_df["voltage"] = nearest_join(
+        root_files_df, voltage_log, ["voltage"], by=["run_id"]
+    )["voltage"]
+
+    if root_files_df["voltage"].isnull().values.any():
+        print("Some voltage data was not collected.")
+
+    return root_files_df
+
+
+def add_env_logs(
+    root_files_df: pd.DataFrame, logs: typing.Dict[str, pd.DataFrame]
+) -> pd.DataFrame:
+    """
+    Adds the field, monitor rate, pressures, temperatures, voltage and
+    set_field of each file from the ENV_TABLES logs of fetch_env_logs().
+    The logs can cover more run_ids than root_files_df (they are joined by
+    run_id), so one fetch can serve runs processed separately.
+    """
+    root_files_df = add_field(root_files_df, logs["nmr"])
+
+    # Beta monitor not working for Kr DON'T ADD BETA MONITOR!
+    # root_files_df["arduino_monitor_rate"] = 1
+
+    root_files_df = add_arduino_monitor_rate(root_files_df, logs["monitor"])
+    root_files_df = add_pressures(root_files_df, logs["rga"])
+    root_files_df = add_temps(root_files_df, logs["endpoint"])
+    root_files_df = add_voltage(root_files_df, logs["dmm"])
+
+    # Add the set_field by rounding to nearest 100th place.
+    root_files_df["set_field"] = root_files_df["field"].round(decimals=2)
+
+    return root_files_df
@@ -23,6 +23,8 @@ class ExperimentResults:
         rebuild_experiment_dir=False,
         rocks_username="harringtonh",
         rocks_IP="172.25.100.1",
+        tracks_columns=None,
+        events_columns=None,
     ):
 
         # Attributes.
@@ -34,6 +36,9 @@ class ExperimentResults:
         self.rebuild_experiment_dir = rebuild_experiment_dir
         self.rocks_username = rocks_username
         self.rocks_IP = rocks_IP
+        # Only read these columns of the tracks and events (None: all).
+        self.tracks_columns = tracks_columns
+        self.events_columns = events_columns
 
         self.rocks_base_path = Path(
             "/data/raid2/eliza4/he6_cres/katydid_analysis/saved_experiments"
@@ -365,20 +370,49 @@ class ExperimentResults:
     def build_result_attributes(self):
 
         self.root_files_path = self.experiment_dir_loc / Path("root_files.csv")
-        self.tracks_path = self.experiment_dir_loc / Path("tracks.csv")
-        self.events_path = self.experiment_dir_loc / Path("events.csv")
+        self.tracks_path = self.result_path("tracks")
+        self.events_path = self.result_path("events")
 
         print("\nCollecting root_files, tracks, and events.\n")
 
         self.root_files = pd.read_csv(self.root_files_path, index_col=0)
-        self.tracks = pd.read_csv(self.tracks_path, index_col=0)
-        self.events = pd.read_csv(self.events_path, index_col=0)
+        self.tracks = self.read_result(self.tracks_path, self.tracks_columns)
+        self.events = self.read_result(self.events_path, self.events_columns)
 
         self.run_ids = sorted(self.root_files["run_id"].unique().tolist())
         self.file_ids = sorted(self.root_files["file_id"].unique().tolist())
 
         return None
 
+    def result_path(self, name):
+        """
+        The parquet dataset dir of a result (-output_format parquet) if there
+        is one, else its csv.
+        """
+        dataset_path = self.experiment_dir_loc / Path(name)
+        if dataset_path.is_dir():
+            return dataset_path
+
+        return self.experiment_dir_loc / Path(f"{name}.csv")
+
+    def read_result(self, path, columns=None):
+        """
+        Reads a result written by post processing. For the parquet datasets
+        only the given columns are read off disk.
+        """
+        if path.is_dir():
+            df = pd.read_parquet(path, columns=columns)
+            # The run_id partitions come back as a category.
+            if "run_id" in df.columns:
+                df["run_id"] = df["run_id"].astype(np.int64)
+            return df
+
+        df = pd.read_csv(path, index_col=0)
+        if columns is not None:
+            df = df[columns]
+
+        return df
+
     def build_local_experiment_dir(self):
 
         if self.experiment_dir_loc.exists():
@@ -1,6 +1,16 @@
 #!/usr/bin/env python3
+import os
+import io
+import uuid
+import csv
+import threading
 import psycopg2
+import psycopg2.pool
 from psycopg2 import Error
+import sqlite3
+import hashlib
+import shutil
+import tempfile
 import pandas as pd
 import pytz
 import numpy as np
@@ -9,59 +19,650 @@ import typing
 import pandas.io.sql as psql
 import subprocess as sp
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+# Local copy of the slow control tables, see he6cres_db_query_cached(). On
+# the node's local disk (one per user), since sqlite locking isn't reliable on
+# NFS (/data/raid2). Set HE6CRES_SLOW_CONTROL_CACHE to put it elsewhere.
+SLOW_CONTROL_CACHE_PATH = Path(
+    os.environ.get(
+        "HE6CRES_SLOW_CONTROL_CACHE",
+        Path(tempfile.gettempdir()) / f"he6cres_slow_control_cache_{os.getuid()}.sqlite",
+    )
+)
+# Data newer than this may not all be written to the db yet, so it isn't cached.
+SLOW_CONTROL_CACHE_LAG = pd.Timedelta(minutes=30)
 
 
-def he6cres_db_connection_local():
-
-    # Connect to the he6cres_db from a machine on the CENPA vpn.
-    connection = psycopg2.connect(
+# Connection parameters of the he6cres_db from a machine on the CENPA vpn (local) or from rocks.
+HE6CRES_DB_PARAMS = {
+    True: dict(
         user="postgres",
         password="chirality",
         host="192.168.20.80",
         port="5432",
         database="he6cres_db",
-    )
+    ),
+    False: dict(
+        user="postgres",
+        password="chirality",
+        host="192.168.20.80",
+        port="5432",
+        database="he6cres_db",
+    ),
+}
+# Max connections kept open by each process.
+HE6CRES_DB_MAX_CONNECTIONS = 8
+# Rows per round trip when streaming a query with a server side cursor.
+HE6CRES_DB_BATCH_SIZE = 50_000
+
+# (pid, local) -> connection pool. Keyed by pid so that worker processes never
+# share the sockets of their parent.
+_he6cres_db_pools = {}
+_he6cres_db_pools_lock = threading.Lock()
+
+
+def he6cres_db_connection_local():
+
+    # Connect to the he6cres_db from a machine on the CENPA vpn.
+    connection = psycopg2.connect(**HE6CRES_DB_PARAMS[True])
     return connection
 
 
 def he6cres_db_connection_rocks():
 
     # Connect to the he6cres_db from rocks.
-    connection = psycopg2.connect(
-        user="postgres",
-        password="chirality",
-        host="192.168.20.80",
-        port="5432",
-        database="he6cres_db",
-    )
+    connection = psycopg2.connect(**HE6CRES_DB_PARAMS[False])
     return connection
 
 
-def he6cres_db_query(query: str, local=False) -> typing.Union[None, pd.DataFrame]:
+def he6cres_db_pool(local=False) -> psycopg2.pool.ThreadedConnectionPool:
+    """
+    The connection pool of this process, made on first use.
+    """
+    key = (os.getpid(), local)
+    # Threads fetching at the same time must end up sharing one pool.
+    with _he6cres_db_pools_lock:
+        if key not in _he6cres_db_pools:
+            _he6cres_db_pools[key] = psycopg2.pool.ThreadedConnectionPool(
+                1, HE6CRES_DB_MAX_CONNECTIONS, **HE6CRES_DB_PARAMS[local]
+            )
+
+    return _he6cres_db_pools[key]
+
+
+@contextmanager
+def he6cres_db_connection(local=False):
+    """
+    Borrows a connection from the pool of this process, inside a transaction
+    that is committed on success and rolled back on error.
 
+    Usage:
+        with he6cres_db_connection() as connection:
+            ...
+    """
+    pool = he6cres_db_pool(local)
+    connection = pool.getconn()
+    broken = False
     try:
-        # Create a connection to the database
-        if not local:
-            with he6cres_db_connection_rocks() as connection:
-                with connection.cursor() as cursor:
-                    # Execute a SQL command
-                    cursor.execute(query)
-                    cols = [desc[0] for desc in cursor.description]
-                    query_result = pd.DataFrame(cursor.fetchall(), columns=cols)
-        else:
-            with he6cres_db_connection_local() as connection:
+        with connection:
+            yield connection
+    except (psycopg2.OperationalError, psycopg2.InterfaceError):
+        # Lost connection, don't hand it out again.
+        broken = True
+        raise
+    finally:
+        pool.putconn(connection, close=broken or connection.closed != 0)
+
+
+def he6cres_db_query(
+    query: str,
+    local=False,
+    params: typing.Union[None, typing.Sequence, typing.Dict] = None,
+    batch_size: typing.Union[None, int] = None,
+    raise_errors: bool = False,
+) -> typing.Union[None, pd.DataFrame]:
+    """
+    Runs a query on the he6cres_db with a pooled connection. For bulk time
+    range pulls see also he6cres_db_copy_query().
+
+    Args:
+        query (str): SQL, with psycopg2 placeholders (%s or %(name)s) for params.
+        local (bool): Connect from the CENPA vpn instead of rocks.
+        params (Sequence or Dict): Bound query parameters.
+        batch_size (int): If given, the result is streamed from a server side
+            cursor this many rows at a time, so the whole result is never held
+            as python tuples (ex: HE6CRES_DB_BATCH_SIZE).
+        raise_errors (bool): Raise db errors instead of printing them and
+            returning None.
+
+    Returns:
+        query_result (pd.DataFrame): None on error (unless raise_errors).
+    """
+    try:
+        with he6cres_db_connection(local) as connection:
+
+            if batch_size is None:
                 with connection.cursor() as cursor:
-                    cursor.execute(query)
+                    cursor.execute(query, params)
                     cols = [desc[0] for desc in cursor.description]
                     query_result = pd.DataFrame(cursor.fetchall(), columns=cols)
 
+            else:
+                # Named cursor: the rows stay on the server until fetched.
+                with connection.cursor(name=f"he6cres_{uuid.uuid4().hex}") as cursor:
+                    cursor.itersize = batch_size
+                    cursor.execute(query, params)
+
+                    batches = []
+                    cols = None
+                    while True:
+                        rows = cursor.fetchmany(batch_size)
+                        if cols is None:
+                            cols = [desc[0] for desc in cursor.description]
+                        if not rows:
+                            break
+                        batches.append(pd.DataFrame.from_records(rows, columns=cols))
+
+                    if batches:
+                        query_result = pd.concat(batches, ignore_index=True)
+                    else:
+                        query_result = pd.DataFrame(columns=cols)
+
     except (Exception, Error) as error:
+        if raise_errors:
+            raise
         print("Error while connecting to he6cres_db", error)
         query_result = None
 
     return query_result
 
 
+# Postgres type oids -> how the COPY text of the column is parsed.
+PG_DATETIME_OIDS = {1082, 1114, 1184}  # date, timestamp, timestamptz
+PG_TIMESTAMPTZ_OIDS = {1184}
+PG_BOOL_OIDS = {16}
+PG_INT_OIDS = {20, 21, 23}  # int8, int2, int4
+PG_FLOAT_OIDS = {700, 701, 1700}  # float4, float8, numeric
+PG_NUMERIC_OIDS = PG_INT_OIDS | PG_FLOAT_OIDS
+# Bytes of COPY output buffered before they are parsed, see copy_query().
+COPY_CHUNK_BYTES = 64 * 1024**2
+# dtype pandas gives a column of datetime objects, as in he6cres_db_query()
+# results (datetime64[ns] before pandas 3, datetime64[us] since).
+PD_DATETIME_DTYPE = pd.Series([datetime.datetime(2000, 1, 1)]).dtype
+# Backslash escapes of the COPY text format.
+COPY_ESCAPES = {"b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t", "v": "\v"}
+
+
+def he6cres_db_copy_query(
+    query: str,
+    local=False,
+    params: typing.Union[None, typing.Sequence, typing.Dict] = None,
+    connection=None,
+    raise_errors: bool = False,
+) -> typing.Union[None, pd.DataFrame]:
+    """
+    Bulk version of he6cres_db_query() for large pulls (ex: a month of rga
+    or endpoint_numeric_data). The result is exported server side with
+    COPY (query) TO STDOUT and parsed by pd.read_csv COPY_CHUNK_BYTES at a
+    time, rather than fetched row by row as python tuples. The column names
+    are the same as he6cres_db_query(), but the types are normalized:
+    timestamp and date columns are naive PD_DATETIME_DTYPE (timestamptz
+    converted to UTC), numeric and real columns are float64, integer
+    columns are int64 (float64 if they hold NULLs), and bool columns are
+    bool (pandas' nullable "boolean" if they hold NULLs).
+
+    Args:
+        query (str): SELECT, with psycopg2 placeholders for params.
+        local (bool): Connect from the CENPA vpn instead of rocks.
+        params (Sequence or Dict): Query parameters (interpolated client side,
+            COPY can't take bound parameters).
+        connection: An open psycopg2 connection to use instead of the pool
+            (ex: a local Postgres for testing).
+        raise_errors (bool): Raise db errors instead of printing them and
+            returning None.
+
+    Returns:
+        query_result (pd.DataFrame): None on error (unless raise_errors).
+    """
+    try:
+        if connection is None:
+            with he6cres_db_connection(local) as connection:
+                return copy_query(connection, query, params)
+
+        return copy_query(connection, query, params)
+
+    except (Exception, Error) as error:
+        if raise_errors:
+            raise
+        print("Error while connecting to he6cres_db", error)
+
+    return None
+
+
+def copy_query(connection, query: str, params=None) -> pd.DataFrame:
+    """
+    COPY (query) TO STDOUT on connection, parsed into a DataFrame with the
+    column types of the query (see he6cres_db_copy_query()).
+    """
+    with connection.cursor() as cursor:
+        query = cursor.mogrify(query, params).decode() if params is not None else query
+
+        # The column types, without running the query.
+        cursor.execute(f"SELECT * FROM ({query}) AS q LIMIT 0")
+        columns = [(desc[0], desc[1]) for desc in cursor.description]
+
+        if any(type_code in PG_TIMESTAMPTZ_OIDS for _, type_code in columns):
+            # timestamptz is printed in the session time zone, so have the
+            # server convert it to naive UTC.
+            query = "SELECT {} FROM ({}) AS q".format(
+                ", ".join(
+                    '(q."{0}" AT TIME ZONE \'UTC\') AS "{0}"'.format(name.replace('"', '""'))
+                    if type_code in PG_TIMESTAMPTZ_OIDS
+                    else 'q."{}"'.format(name.replace('"', '""'))
+                    for name, type_code in columns
+                ),
+                query,
+            )
+
+        output = CopyChunks(columns)
+        cursor.copy_expert(f"COPY ({query}) TO STDOUT", output)
+
+    return output.result()
+
+
+class CopyChunks:
+    """
+    File like target for cursor.copy_expert(). The COPY text output (one
+    row per line, tab separated, NULL as \\N) is parsed by read_copy_text()
+    every COPY_CHUNK_BYTES, so the raw text is never held all at once.
+    """
+
+    def __init__(self, columns, chunk_bytes: int = COPY_CHUNK_BYTES):
+        self.columns = columns
+        self.chunk_bytes = chunk_bytes
+        self.pending = []
+        self.pending_bytes = 0
+        self.frames = []
+
+    def write(self, data) -> int:
+        # psycopg2 writes one whole row per call.
+        if isinstance(data, bytes):
+            data = data.decode()
+        self.pending.append(data)
+        self.pending_bytes += len(data)
+
+        if self.pending_bytes >= self.chunk_bytes:
+            text = "".join(self.pending)
+            # Rows never span lines (newlines in values are escaped).
+            end = text.rfind("\n") + 1
+            if end:
+                self.frames.append(read_copy_text(text[:end], self.columns))
+                text = text[end:]
+            self.pending = [text]
+            self.pending_bytes = len(text)
+
+        return len(data)
+
+    def result(self) -> pd.DataFrame:
+        text = "".join(self.pending)
+        if text or not self.frames:
+            self.frames.append(read_copy_text(text, self.columns))
+        self.pending = []
+        query_result = pd.concat(self.frames, ignore_index=True)
+        self.frames = []
+
+        for name, type_code in self.columns:
+            if type_code in PG_BOOL_OIDS and not query_result[name].isna().any():
+                query_result[name] = query_result[name].astype(bool)
+
+        return query_result
+
+
+def read_copy_text(text: str, columns) -> pd.DataFrame:
+    """
+    Parses complete lines of COPY text format output into a DataFrame with
+    the given (name, type oid) columns.
+    """
+    names = [name for name, _ in columns]
+    dtype = {
+        name: "float64" if type_code in PG_FLOAT_OIDS else str
+        for name, type_code in columns
+        if type_code not in PG_INT_OIDS
+    }
+    # Postgres prints float NaN as "NaN".
+    na_values = {
+        name: ["\\N", "NaN"] if type_code in PG_FLOAT_OIDS else ["\\N"]
+        for name, type_code in columns
+    }
+    query_result = pd.read_csv(
+        io.StringIO(text),
+        sep="\t",
+        header=None,
+        names=names,
+        dtype=dtype,
+        na_values=na_values,
+        keep_default_na=False,
+        quoting=csv.QUOTE_NONE,
+    )
+
+    for name, type_code in columns:
+        if type_code in PG_DATETIME_OIDS:
+            # Postgres drops the fraction of whole seconds, so the format varies row to row.
+            try:
+                times = pd.to_datetime(query_result[name], format="ISO8601")
+            except ValueError:
+                # pandas < 2 has no "ISO8601" format but parses mixed ISO strings by default.
+                times = pd.to_datetime(query_result[name])
+            # The same unit for every chunk (and cached rows), whatever their precision.
+            query_result[name] = times.astype(PD_DATETIME_DTYPE)
+        elif type_code in PG_INT_OIDS and query_result[name].dtype == object:
+            # Only an empty chunk has nothing to infer the type from.
+            query_result[name] = query_result[name].astype("int64")
+        elif type_code in PG_BOOL_OIDS:
+            query_result[name] = query_result[name].map({"t": True, "f": False}).astype("boolean")
+        elif type_code not in PG_NUMERIC_OIDS and query_result[name].str.contains("\\", regex=False).any():
+            query_result[name] = query_result[name].str.replace(
+                r"\\(.)", lambda match: COPY_ESCAPES.get(match.group(1), match.group(1)), regex=True
+            )
+
+    return query_result
+
+
+def time_range_condition(time_col: str, ranges) -> typing.Tuple[str, typing.List[str]]:
+    """
+    SQL condition selecting time_col within any of the closed (start, end)
+    ranges (naive UTC), and its bound parameters.
+    """
+    condition = "({})".format(
+        " OR ".join(
+            f"({time_col} >= %s::timestamp AND {time_col} <= %s::timestamp)" for _ in ranges
+        )
+    )
+    params = [str(pd.Timestamp(value)) for start, end in ranges for value in (start, end)]
+
+    return condition, params
+
+
+def he6cres_db_query_cached(
+    query: str,
+    time_col: str,
+    ranges,
+    cache_path: typing.Union[None, str, Path] = SLOW_CONTROL_CACHE_PATH,
+    offline: bool = False,
+    local: bool = False,
+) -> typing.Union[None, pd.DataFrame]:
+    """
+    he6cres_db_query() for slow control logs, backed by a local sqlite cache.
+    Slow control history doesn't change once written, so the cache keeps
+    track of which time intervals it holds for each query and only the
+    missing sub-intervals are fetched from he6cres_db. If the db can't be
+    reached (or offline) the result comes from the cache alone.
+
+    Concurrent jobs on a node share the cache. The write lock is only held
+    to store a fetch (BEGIN IMMEDIATE), not during the fetch itself, so two
+    jobs missing the same range may both fetch it; rows are keyed by a hash
+    of their values, so re-inserting one is a no-op, and the coverage
+    intervals are merged. The column dtypes are stored with the rows, so
+    cached and freshly fetched rows come back the same.
+
+    Args:
+        query (str): Query with one {} in its WHERE clause, that is filled
+            with the condition on time_col.
+        time_col (str): Timestamp column (naive UTC) as named in the query
+            (ex: "m.created_at").
+        ranges (List[Tuple]): Closed (start, end) naive UTC time ranges.
+        cache_path (str or Path): sqlite file, on a local disk. None to skip
+            the cache.
+        offline (bool): Don't query he6cres_db at all.
+
+    Returns:
+        query_result (pd.DataFrame): Rows within ranges. None if the db
+            couldn't be reached and there is no cache to fall back on.
+    """
+    ranges = [(pd.Timestamp(start), pd.Timestamp(end)) for start, end in ranges]
+    if not ranges:
+        return pd.DataFrame()
+
+    if cache_path is None:
+        condition, params = time_range_condition(time_col, ranges)
+        return he6cres_db_copy_query(query.format(condition), local, params=params)
+
+    column = time_col.split(".")[-1]
+    key = hashlib.sha1(f"{query}|{time_col}".encode()).hexdigest()[:16]
+    table = f"slow_control_{key}"
+    lag_ns = (pd.Timestamp.now("UTC").tz_localize(None) - SLOW_CONTROL_CACHE_LAG).floor("us").value
+
+    Path(cache_path).parent.mkdir(parents=True, exist_ok=True)
+    # Transactions are managed explicitly (isolation_level=None).
+    cache = sqlite3.connect(str(cache_path), timeout=600, isolation_level=None)
+    try:
+        # Readers aren't blocked while another job stores a fetch.
+        cache.execute("PRAGMA journal_mode=WAL")
+        cache.execute(
+            "CREATE TABLE IF NOT EXISTS slow_control_coverage (key TEXT, start_ns INTEGER, end_ns INTEGER)"
+        )
+        cache.execute(
+            "CREATE TABLE IF NOT EXISTS slow_control_dtypes (tbl TEXT, name TEXT, dtype TEXT)"
+        )
+        covered = cache.execute(
+            "SELECT start_ns, end_ns FROM slow_control_coverage WHERE key = ? ORDER BY start_ns",
+            (key,),
+        ).fetchall()
+
+        # he6cres_db timestamps are to the microsecond.
+        missing = subtract_intervals(
+            [(start.value, end.value) for start, end in ranges], covered, step=1000
+        )
+
+        fetched = None
+        if missing and not offline:
+            condition, params = time_range_condition(
+                time_col, [(pd.Timestamp(start), pd.Timestamp(end)) for start, end in missing]
+            )
+            fetched = he6cres_db_copy_query(query.format(condition), local, params=params)
+            if fetched is None:
+                print(f"he6cres_db unreachable, using the slow control cache {cache_path} only.")
+        elif missing:
+            print(f"Offline: using the slow control cache {cache_path} only.")
+
+        recent = None
+        if fetched is not None:
+            # Only the part of the fetch old enough to be complete is cached.
+            time_ns = pd.to_datetime(fetched[column]).astype("datetime64[ns]").astype(np.int64)
+            settled = (time_ns <= lag_ns).to_numpy()
+
+            cache.execute("BEGIN IMMEDIATE")
+            if settled.any():
+                insert_slow_control_rows(cache, table, fetched[settled], column, time_ns[settled])
+            cache.executemany(
+                "INSERT INTO slow_control_coverage VALUES (?, ?, ?)",
+                [(key, int(start), int(min(end, lag_ns))) for start, end in missing if start <= lag_ns],
+            )
+            merge_coverage(cache, key, step=1000)
+            cache.execute("COMMIT")
+
+            recent = fetched[~settled]
+
+        has_table = cache.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)
+        ).fetchone()
+        cached = None
+        if has_table:
+            cached = pd.read_sql_query(
+                f"SELECT * FROM {table} WHERE "
+                + " OR ".join("(_time_ns >= ? AND _time_ns <= ?)" for _ in ranges),
+                cache,
+                params=[value for start, end in ranges for value in (start.value, end.value)],
+            )
+            dtypes = dict(
+                cache.execute(
+                    "SELECT name, dtype FROM slow_control_dtypes WHERE tbl = ? ORDER BY rowid",
+                    (table,),
+                ).fetchall()
+            )
+            cached[column] = cached.pop("_time_ns")
+            cached = restore_dtypes(cached, dtypes)[list(dtypes)]
+    finally:
+        if cache.in_transaction:
+            cache.execute("ROLLBACK")
+        cache.close()
+
+    if cached is None and recent is None:
+        # Nothing to return if the db couldn't be reached and nothing is cached.
+        return None if missing else pd.DataFrame()
+
+    query_result = pd.concat([df for df in [cached, recent] if df is not None], ignore_index=True)
+    if fetched is not None:
+        query_result = query_result[fetched.columns]
+
+    return query_result
+
+
+def insert_slow_control_rows(
+    cache, table: str, df: pd.DataFrame, time_col: str, time_ns: pd.Series
+) -> None:
+    """
+    Adds the rows of df to table, with time_col stored as int ns (time_ns).
+    The table is created with an index on the time and a unique row hash on
+    the first insert, and the dtypes of df are recorded for restore_dtypes().
+    Rows already in the table are skipped (INSERT OR IGNORE).
+    """
+    dtypes = df.dtypes
+    df = df.drop(columns=[time_col])
+    columns = [f'"{name}"' for name in df.columns]
+    cache.execute(
+        f"CREATE TABLE IF NOT EXISTS {table} (_time_ns INTEGER, _row_hash INTEGER, {', '.join(columns)})"
+    )
+    cache.execute(f"CREATE INDEX IF NOT EXISTS {table}_time ON {table} (_time_ns)")
+    cache.execute(f"CREATE UNIQUE INDEX IF NOT EXISTS {table}_row ON {table} (_row_hash)")
+
+    if cache.execute("SELECT 1 FROM slow_control_dtypes WHERE tbl = ?", (table,)).fetchone() is None:
+        cache.executemany(
+            "INSERT INTO slow_control_dtypes VALUES (?, ?, ?)",
+            [(table, name, str(dtype)) for name, dtype in dtypes.items()],
+        )
+
+    # Datetimes as int ns and NaN/NaT as NULL.
+    values = df.copy()
+    for name in values.columns:
+        if pd.api.types.is_datetime64_any_dtype(values[name]):
+            time = values[name].astype("datetime64[ns]")
+            values[name] = pd.Series(time.to_numpy().view(np.int64), index=time.index).where(
+                time.notna()
+            )
+    values = values.astype(object).where(values.notna(), None)
+
+    row_hash = pd.util.hash_pandas_object(
+        df.assign(_time_ns=time_ns.to_numpy()), index=False
+    ).to_numpy().view(np.int64)
+
+    cache.executemany(
+        f"INSERT OR IGNORE INTO {table} VALUES ({', '.join(['?'] * (len(columns) + 2))})",
+        (
+            (int(t), int(h)) + tuple(row)
+            for t, h, row in zip(time_ns, row_hash, values.itertuples(index=False, name=None))
+        ),
+    )
+
+    return None
+
+
+def restore_dtypes(df: pd.DataFrame, dtypes: typing.Dict[str, str]) -> pd.DataFrame:
+    """
+    Casts the columns of df read back from sqlite to the dtypes they had
+    when they were cached. Integer and bool columns with NULLs stay float
+    and nullable boolean. Datetimes are read as int ns.
+    """
+    for name, dtype in dtypes.items():
+        if name not in df.columns:
+            continue
+        if dtype.startswith("datetime64"):
+            df[name] = pd.to_datetime(df[name]).astype(dtype)
+        elif dtype in ("bool", "boolean"):
+            values = df[name].astype("boolean")
+            df[name] = values.astype(bool) if dtype == "bool" and not values.isna().any() else values
+        elif dtype.startswith(("int", "uint", "float")):
+            values = pd.to_numeric(df[name])
+            df[name] = values if values.isna().any() else values.astype(dtype)
+
+    return df
+
+
+def subtract_intervals(intervals, covered, step: int = 1) -> typing.List[typing.Tuple[int, int]]:
+    """
+    Parts of the closed integer intervals not in the (sorted, disjoint)
+    closed integer intervals covered. step is the resolution of the values.
+    """
+    missing = []
+    for start, end in intervals:
+        for covered_start, covered_end in covered:
+            if covered_end < start or covered_start > end:
+                continue
+            if covered_start > start:
+                missing.append((start, covered_start - step))
+            start = max(start, covered_end + step)
+            if start > end:
+                break
+        if start <= end:
+            missing.append((start, end))
+
+    return missing
+
+
+def merge_coverage(cache, key: str, step: int = 1) -> None:
+    """
+    Merges the overlapping or touching (within step) coverage intervals of
+    key in place.
+    """
+    intervals = cache.execute(
+        "SELECT start_ns, end_ns FROM slow_control_coverage WHERE key = ? ORDER BY start_ns", (key,)
+    ).fetchall()
+
+    merged = []
+    for start, end in intervals:
+        if merged and start <= merged[-1][1] + step:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+
+    cache.execute("DELETE FROM slow_control_coverage WHERE key = ?", (key,))
+    cache.executemany(
+        "INSERT INTO slow_control_coverage VALUES (?, ?, ?)", [(key, start, end) for start, end in merged]
+    )
+
+    return None
+
+
+# Timestamp at the end of a root file name: to the second, then optionally
+# "-" and ms, then 9 more characters.
+ROOT_FILE_TIME_REGEX = r"(\d{4}(?:-\d{2}){5})(-\d{3})?.{9}$"
+
+
+def root_file_times(root_file_paths: pd.Series) -> pd.Series:
+    """
+    Naive (local PST) datetimes from the names of root files, for a whole
+    column at once: one regex extract and one pd.to_datetime. Each name can
+    be to the ms (%Y-%m-%d-%H-%M-%S-%f, rid 1570 and later) or only to the
+    second (%Y-%m-%d-%H-%M-%S).
+
+    Raises:
+        UserWarning: if a name has no timestamp.
+    """
+    parts = root_file_paths.astype(str).str.extract(ROOT_FILE_TIME_REGEX)
+
+    if parts[0].isnull().any():
+        raise UserWarning(
+            f"No timestamp in root file names: {list(root_file_paths[parts[0].isnull()][:5])}"
+        )
+
+    # Names to the second get ms = 000. The ms padding is very important!
+    time_str = parts[0] + parts[1].fillna("-000")
+
+    return pd.to_datetime(time_str, format="%Y-%m-%d-%H-%M-%S-%f")
+
+
 def get_pst_time():
     tz = pytz.timezone("US/Pacific")
     pst_now = datetime.datetime.now(tz).replace(microsecond=0).replace(tzinfo=None)
@@ -109,6 +710,90 @@ def log_file_break():
     print("\n\n")
     return None
 
+def parallel_map(
+    func, items, workers: int = 1, initializer=None, initargs=(), chunksize=None
+) -> list:
+    """
+    Applies func to every item, in a pool of worker processes if workers > 1.
+    The results are always returned in the order of items, so merging them
+    gives the same output as a serial loop.
+
+    func and items are pickled to the workers, so func should be a module
+    level function of small arguments (not a bound method, which would send
+    its whole instance with every item). Per-process state (ex: a cache) is
+    set up once per worker by initializer(*initargs), which is also run
+    before the serial loop.
+
+    Args:
+        chunksize (int): Items sent to a worker at a time. Default: about 4
+            chunks per worker.
+    """
+    items = list(items)
+
+    if workers <= 1 or len(items) <= 1:
+        if initializer is not None:
+            initializer(*initargs)
+        return [func(item) for item in items]
+
+    workers = min(workers, len(items))
+    if chunksize is None:
+        chunksize = max(1, len(items) // (4 * workers))
+
+    with ProcessPoolExecutor(
+        max_workers=workers, initializer=initializer, initargs=initargs
+    ) as executor:
+        return list(executor.map(func, items, chunksize=chunksize))
+
+
+# Compression of the parquet outputs of post processing (see -output_format).
+PARQUET_COMPRESSION = "zstd"
+
+
+def write_parquet_dataset(df: pd.DataFrame, dataset_dir, partition_cols=("run_id",)) -> None:
+    """
+    Writes df as a parquet dataset partitioned by partition_cols, one
+    directory per value (ex: tracks/run_id=1748/<part>.parquet), so readers
+    can skip whole run_ids as well as columns. Repeated strings (ex:
+    root_file_path) are dictionary encoded. It is written to a tmp directory
+    and then moved in place of dataset_dir.
+    """
+    dataset_dir = Path(dataset_dir)
+    tmp_dir = dataset_dir.with_name(f"{dataset_dir.name}.{os.getpid()}.tmp")
+    if tmp_dir.exists():
+        shutil.rmtree(tmp_dir)
+    tmp_dir.mkdir(parents=True)
+
+    if not df.empty:
+        df.to_parquet(
+            tmp_dir,
+            partition_cols=list(partition_cols),
+            compression=PARQUET_COMPRESSION,
+            index=False,
+        )
+
+    if dataset_dir.exists():
+        shutil.rmtree(dataset_dir)
+    os.replace(tmp_dir, dataset_dir)
+
+    return None
+
+
+def write_atomic(path, write) -> None:
+    """
+    Calls write(tmp_path) (ex: lambda tmp: df.to_csv(tmp)) then moves the
+    tmp file onto path, so that readers never see a partially written file.
+    """
+    path = Path(path)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        write(tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if tmp_path.exists():
+            tmp_path.unlink()
+
+    return None
+
 def sbatch_job(
         cmd: str, 
         job_name: str, 
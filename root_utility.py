@@ -0,0 +1,589 @@
+#!/usr/bin/env python3
+import os
+import hashlib
+import typing
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import awkward as ak
+import uproot
+
+# Version of the branch schemas below. Bump this whenever they change.
+SCHEMA_VERSION = 1
+
+# Shared cache of the tables read out of the root (and slew time) files.
+ROOT_TABLE_CACHE_DIR = Path("/data/raid2/eliza4/he6_cres/katydid_analysis/root_table_cache")
+ROOT_TABLE_CACHE_MAX_BYTES = 500 * 1024 ** 3
+# Evictions go down to this fraction of max_bytes, so that they are rare once the cache is full.
+ROOT_TABLE_CACHE_LOW_WATER = 0.9
+
+# Katydid processed track branches (TProcessedTrackData) used downstream,
+# with their target dtypes. Required branches must be in the file, optional
+# ones are read when present. EventID/TrackID are rebuilt from the tree
+# structure when an event tree doesn't store them.
+PROCESSED_TRACK_REQUIRED = {
+    "StartTimeInRunC": np.float64,
+    "EndTimeInRunC": np.float64,
+    "TimeLength": np.float64,
+    "StartFrequency": np.float64,
+    "EndFrequency": np.float64,
+    "Slope": np.float64,
+    "NTrackBins": np.float64,
+    "TotalTrackSNR": np.float64,
+    "MaxTrackSNR": np.float64,
+    "TotalTrackNUP": np.float64,
+    "TotalPower": np.float64,
+}
+PROCESSED_TRACK_OPTIONAL = {
+    "Component": np.int64,
+    "AcquisitionID": np.int64,
+    "EventID": np.int64,
+    "TrackID": np.int64,
+    "EventSequenceID": np.int64,
+    "IsCut": np.bool_,
+    "StartTimeInAcq": np.float64,
+    "FrequencyWidth": np.float64,
+    "Intercept": np.float64,
+    "MaxTrackNUP": np.float64,
+    "TotalWideTrackSNR": np.float64,
+    "TotalWideTrackNUP": np.float64,
+    "StartTimeInRunCSigma": np.float64,
+    "EndTimeInRunCSigma": np.float64,
+    "TimeLengthSigma": np.float64,
+    "StartFrequencySigma": np.float64,
+    "EndFrequencySigma": np.float64,
+    "FrequencyWidthSigma": np.float64,
+    "SlopeSigma": np.float64,
+    "InterceptSigma": np.float64,
+    "TotalPowerSigma": np.float64,
+}
+
+# The tracks tree only guarantees the track line parameters.
+TRACK_LINE_REQUIRED = {
+    "StartTimeInRunC": np.float64,
+    "EndTimeInRunC": np.float64,
+    "StartFrequency": np.float64,
+    "EndFrequency": np.float64,
+    "Slope": np.float64,
+}
+
+# Katydid track tree layouts, in the order they are looked for in a file.
+# branch: path from the tree to the parent of the track branches.
+# prefix: part of the branch names dropped from the column names.
+# events: True if each entry is an event holding several tracks.
+# required/optional: branch schema (column name -> dtype).
+TRACK_TREES = {
+    "MB-events": {
+        "key": "MB-events;1",
+        "branch": ("MultiBandEvent", "fTracks"),
+        "prefix": "fTracks.f",
+        "events": True,
+        "required": PROCESSED_TRACK_REQUIRED,
+        "optional": PROCESSED_TRACK_OPTIONAL,
+    },
+    "tracks": {
+        "key": "tracks;1",
+        "branch": ("Track",),
+        "prefix": "f",
+        "events": False,
+        "required": TRACK_LINE_REQUIRED,
+        "optional": dict(
+            {
+                column: dtype
+                for column, dtype in PROCESSED_TRACK_REQUIRED.items()
+                if column not in TRACK_LINE_REQUIRED
+            },
+            NPoints=np.int64,
+            **PROCESSED_TRACK_OPTIONAL,
+        ),
+    },
+    "multiTrackEvents": {
+        "key": "multiTrackEvents;1",
+        "branch": ("Event", "fTracks"),
+        "prefix": "fTracks.f",
+        "events": True,
+        "required": dict(PROCESSED_TRACK_REQUIRED, EventSequenceID=np.int64),
+        "optional": {
+            column: dtype
+            for column, dtype in PROCESSED_TRACK_OPTIONAL.items()
+            if column != "EventSequenceID"
+        },
+    },
+}
+
+# The fPoints of each track only live in the tracks tree.
+TRACK_POINTS_TREE = {
+    "key": "tracks;1",
+    "branch": ("Track", "fPoints"),
+    "prefix": "fPoints.f",
+    "required": {
+        "TimeInRunC": np.float64,
+        "Frequency": np.float64,
+    },
+    "optional": {
+        "TimeInAcq": np.float64,
+        "Amplitude": np.float64,
+        "Power": np.float64,
+        "Mean": np.float64,
+        "Variance": np.float64,
+        "NeighborhoodAmplitude": np.float64,
+        "BinInSlice": np.int64,
+        "AcquisitionID": np.int64,
+        "Component": np.int64,
+    },
+}
+
+
+def find_track_tree(keys, tree_types=tuple(TRACK_TREES)) -> typing.Union[None, str]:
+    """
+    Returns the first of tree_types whose tree is in keys (the keys of an
+    open root file), or None.
+    """
+    for tree_type in tree_types:
+        if TRACK_TREES[tree_type]["key"] in keys:
+            return tree_type
+
+    return None
+
+
+def get_branch(rootfile, tree):
+    """
+    Returns the parent branch of the columns of tree (an entry of
+    TRACK_TREES or TRACK_POINTS_TREE) in an open root file.
+    """
+    branch = rootfile[tree["key"]]
+    for name in tree["branch"]:
+        branch = branch[name]
+
+    return branch
+
+
+def missing_branches(branches, tree) -> typing.List[str]:
+    """
+    Names of the required columns of tree that are not under branches. Only
+    looks at the branch names, nothing is decompressed.
+    """
+    names = set(key.split("/")[-1] for key in branches.keys())
+
+    return [
+        column for column in tree["required"] if tree["prefix"] + column not in names
+    ]
+
+
+class KatydidRootFile:
+    """
+    Opens a katydid output root file once and works out which track tree
+    layout it holds, so that the tracks and the track points can both be
+    read without re-opening the file (and re-reading its directory).
+
+    Usage:
+        with KatydidRootFile(root_file_path) as root_file:
+            tracks_df, track_points_df = root_file.read()
+    """
+
+    def __init__(self, root_file_path, tree_types=tuple(TRACK_TREES)):
+
+        self.root_file_path = root_file_path
+        self.rootfile = uproot.open(root_file_path)
+        self.keys = set(self.rootfile.keys())
+
+        self.tree_type = find_track_tree(self.keys, tree_types)
+
+        self.has_track_points = TRACK_POINTS_TREE["key"] in self.keys
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self.rootfile.close()
+
+    def tracks(self) -> pd.DataFrame:
+        """
+        Bulk track parameters, one row per track. Empty if the file has no
+        recognized track tree.
+        """
+        if self.tree_type is None:
+            return pd.DataFrame()
+
+        tree = TRACK_TREES[self.tree_type]
+        tracks_df, offsets = read_schema_branches(get_branch(self.rootfile, tree), tree)
+        if tree["events"]:
+            tracks_df = add_missing_ids(tracks_df, offsets)
+
+        return tracks_df
+
+    def track_points(self) -> pd.DataFrame:
+        """
+        Track points (fPoints), one row per point. Empty if the file has
+        no tracks tree.
+        """
+        if not self.has_track_points:
+            return pd.DataFrame()
+
+        track_points_df, _ = read_schema_branches(
+            get_branch(self.rootfile, TRACK_POINTS_TREE), TRACK_POINTS_TREE
+        )
+
+        return track_points_df
+
+    def iter_track_points(self, step_size) -> typing.Iterator[pd.DataFrame]:
+        """
+        Track points in chunks of step_size entries (int) or bytes (str,
+        ex: "100MB"), so that the whole fPoints tree is never in memory.
+        Yields nothing if the file has no tracks tree.
+        """
+        if not self.has_track_points:
+            return
+
+        for track_points_df, _ in iterate_schema_branches(
+            get_branch(self.rootfile, TRACK_POINTS_TREE), TRACK_POINTS_TREE, step_size
+        ):
+            yield track_points_df
+
+    def read(
+        self, track_points: bool = True
+    ) -> typing.Tuple[pd.DataFrame, typing.Union[None, pd.DataFrame]]:
+        """
+        Returns the tracks and (if track_points) the track points tables.
+        """
+        tracks_df = self.tracks()
+        track_points_df = self.track_points() if track_points else None
+
+        return tracks_df, track_points_df
+
+
+def read_schema_branches(branches, tree) -> typing.Tuple[pd.DataFrame, np.ndarray]:
+    """
+    Reads only the schema branches of tree (an entry of TRACK_TREES or
+    TRACK_POINTS_TREE) below a TTree/TBranch, in one call, and flattens them
+    into columns of the schema dtypes.
+
+    Args:
+        branches (uproot TTree or TBranch): Parent of the branches to read.
+        tree (dict): Layout and branch schema of the tree.
+
+    Returns:
+        df (pd.DataFrame): One row per flattened element (track, point...).
+        offsets (np.ndarray): Per-entry offsets into the rows of df, of
+            length num_entries + 1. See entry_indices().
+    """
+    names, dtypes = schema_names(branches, tree)
+    arrays = branches.arrays(filter_name=names, library="ak", how=dict)
+
+    return flatten_arrays(arrays, tree["prefix"], dtypes=dtypes)
+
+
+def iterate_schema_branches(
+    branches, tree, step_size
+) -> typing.Iterator[typing.Tuple[pd.DataFrame, np.ndarray]]:
+    """
+    Same as read_schema_branches() but walks the entries in chunks of
+    step_size (entries if int, bytes if str like "100MB"), yielding one
+    flattened (df, offsets) per chunk. Offsets are relative to the chunk.
+    """
+    names, dtypes = schema_names(branches, tree)
+
+    for arrays in branches.iterate(
+        filter_name=names, step_size=step_size, library="ak", how=dict
+    ):
+        yield flatten_arrays(arrays, tree["prefix"], dtypes=dtypes)
+
+
+def schema_names(branches, tree) -> typing.Tuple[typing.List[str], typing.Dict[str, typing.Any]]:
+    """
+    Branch names to read for tree, and the column name -> dtype map.
+
+    Raises:
+        UserWarning: if a required branch is missing.
+    """
+    missing = missing_branches(branches, tree)
+    if missing:
+        raise UserWarning(
+            f"Missing required branches {missing} in {tree['key']} of {branches.file.file_path}"
+        )
+
+    dtypes = dict(tree["required"], **tree["optional"])
+    names = [tree["prefix"] + column for column in dtypes]
+
+    return names, dtypes
+
+
+def flatten_arrays(
+    arrays: typing.Dict[str, typing.Any], prefix: str, dtypes: typing.Dict[str, typing.Any] = None
+) -> typing.Tuple[pd.DataFrame, np.ndarray]:
+    """
+    Flattens a dict of (jagged) awkward arrays that share the same per-entry
+    structure into a DataFrame, without any per-element python work.
+
+    Args:
+        arrays (Dict[str, awkward array]): branch name -> array.
+        prefix (str): Leading part of the branch names to drop from the
+            column names.
+        dtypes (Dict[str, dtype]): column name -> dtype. Columns not listed
+            keep the branch dtype.
+
+    Returns:
+        df (pd.DataFrame): One row per flattened element.
+        offsets (np.ndarray): Per-entry offsets into the rows of df.
+    """
+    dtypes = {} if dtypes is None else dtypes
+    columns = {}
+    counts = None
+
+    for key, array in arrays.items():
+        # Nested branches can come back with their full path (parent/child).
+        name = key.split("/")[-1]
+        if name.startswith(prefix):
+            name = name[len(prefix):]
+
+        if counts is None:
+            counts = entry_counts(array)
+
+        column = ak.to_numpy(ak.flatten(array, axis=None))
+        if name in dtypes:
+            column = column.astype(dtypes[name], copy=False)
+        columns[name] = column
+
+    if counts is None:
+        counts = np.zeros(0, dtype=np.int64)
+
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+
+    return pd.DataFrame(columns), offsets
+
+
+def entry_counts(array) -> np.ndarray:
+    """
+    Number of flattened elements in each entry of an awkward array.
+    """
+    if array.ndim == 1:
+        return np.ones(len(array), dtype=np.int64)
+
+    # Collapse any inner nesting so the counts match ak.flatten(axis=None).
+    while array.ndim > 2:
+        array = ak.flatten(array, axis=2)
+
+    return ak.to_numpy(ak.num(array, axis=1)).astype(np.int64)
+
+
+def entry_indices(offsets: np.ndarray) -> typing.Tuple[np.ndarray, np.ndarray]:
+    """
+    Rebuilds the entry index and the index within the entry of every
+    flattened row from the per-entry offsets.
+
+    Returns:
+        entry (np.ndarray): Entry (event) number of each row.
+        local (np.ndarray): Position of each row within its entry.
+    """
+    counts = np.diff(offsets)
+    entry = np.repeat(np.arange(len(counts), dtype=np.int64), counts)
+    local = np.arange(offsets[-1], dtype=np.int64) - np.repeat(offsets[:-1], counts)
+
+    return entry, local
+
+
+def add_missing_ids(df: pd.DataFrame, offsets: np.ndarray) -> pd.DataFrame:
+    """
+    Fills in EventID/TrackID from the tree structure when the tree doesn't
+    store them (one entry per event, one element per track).
+    """
+    if "EventID" in df.columns and "TrackID" in df.columns:
+        return df
+
+    entry, local = entry_indices(offsets)
+    if "EventID" not in df.columns:
+        df["EventID"] = entry
+    if "TrackID" not in df.columns:
+        df["TrackID"] = local
+
+    return df
+
+
+class RootTableCache:
+    """
+    Content addressed on-disk cache of the tables extracted from a file
+    (tracks, track points, slew times...), stored as compressed parquet.
+
+    The key is the file path, size and mtime plus SCHEMA_VERSION, so
+    re-running post processing over the same files (ex: with new cuts or a
+    new experiment_name) skips the root read, while a re-written file or a
+    schema change is a miss. Once the cache is over max_bytes the least
+    recently used tables are deleted. The size of the cache is only scanned
+    on the first save of each process and again once the running total of
+    what it saved goes over max_bytes, not on every save.
+
+    Usage:
+        cache = RootTableCache()
+        tracks_df = cache.load(root_file_path, "tracks", read_tracks)
+    """
+
+    def __init__(
+        self,
+        cache_dir=ROOT_TABLE_CACHE_DIR,
+        max_bytes=ROOT_TABLE_CACHE_MAX_BYTES,
+        enabled=True,
+        refresh=False,
+    ):
+
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.refresh = refresh
+        # Bytes in the cache as of the last scan plus what was saved since.
+        self.total_bytes = None
+
+    def path(self, file_path, table) -> Path:
+        """
+        Cache file of table for file_path in its current state.
+        """
+        stat = os.stat(file_path)
+        key = f"{Path(file_path).resolve()}|{stat.st_size}|{stat.st_mtime_ns}|{SCHEMA_VERSION}"
+        digest = hashlib.sha1(key.encode()).hexdigest()
+
+        return self.cache_dir / Path(digest[:2]) / Path(f"{digest}_{table}.parquet")
+
+    def load(self, file_path, table: str, build: typing.Callable[[], pd.DataFrame]) -> pd.DataFrame:
+        """
+        Returns table for file_path from the cache, or calls build() and
+        caches what it returns.
+
+        Args:
+            file_path (str): File the table is read from.
+            table (str): Name of the table. Must capture everything besides
+                the file that changes what build() returns.
+            build (Callable): Reads the table from the file.
+        """
+        return self.load_tables(file_path, [table], lambda: {table: build()})[table]
+
+    def load_tables(
+        self,
+        file_path,
+        tables: typing.List[str],
+        build: typing.Callable[[], typing.Dict[str, pd.DataFrame]],
+    ) -> typing.Dict[str, pd.DataFrame]:
+        """
+        Same as load() for several tables read out of the same file, so that
+        a miss on any of them costs a single read of the file.
+
+        Returns:
+            dfs (Dict[str, pd.DataFrame]): table -> df, for each of tables.
+        """
+        if not self.enabled:
+            return build()
+
+        cache_paths = {table: self.path(file_path, table) for table in tables}
+
+        if not self.refresh and all(path.is_file() for path in cache_paths.values()):
+            try:
+                dfs = {table: pd.read_parquet(path) for table, path in cache_paths.items()}
+                # Mark as recently used for the eviction.
+                for path in cache_paths.values():
+                    os.utime(path)
+                return dfs
+            except Exception as e:
+                print(f"Failed to read cached {tables} for {file_path}, re-reading. {e}")
+
+        dfs = build()
+        for table, path in cache_paths.items():
+            self.save(path, dfs[table])
+
+        return dfs
+
+    def save(self, cache_path: Path, df: pd.DataFrame) -> None:
+        """
+        Writes df to cache_path then evicts down to max_bytes. Failures to
+        write only cost the cache hit, so they are logged and not raised.
+        """
+        tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp")
+        try:
+            cache_path.parent.mkdir(parents=True, exist_ok=True)
+            df.reset_index(drop=True).to_parquet(tmp_path, compression="zstd", index=False)
+            # Atomic so that concurrent jobs never read a partial file.
+            os.replace(tmp_path, cache_path)
+            size = cache_path.stat().st_size
+        except Exception as e:
+            print(f"Failed to cache {cache_path}. {e}")
+            if tmp_path.exists():
+                tmp_path.unlink()
+            return None
+
+        if self.total_bytes is None:
+            self.evict()
+        else:
+            self.total_bytes += size
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+        return None
+
+    def evict(self) -> None:
+        """
+        Scans the whole cache and, if it is over max_bytes, deletes the least
+        recently used tables until it is under ROOT_TABLE_CACHE_LOW_WATER of
+        max_bytes. Resets total_bytes.
+        """
+        entries = []
+        for cache_path in self.cache_dir.glob("*/*.parquet"):
+            try:
+                stat = cache_path.stat()
+            except FileNotFoundError:
+                # Evicted by another job.
+                continue
+            entries.append((stat.st_mtime, stat.st_size, cache_path))
+
+        total_bytes = sum(size for mtime, size, cache_path in entries)
+
+        target_bytes = self.max_bytes
+        if total_bytes > self.max_bytes:
+            target_bytes = self.max_bytes * ROOT_TABLE_CACHE_LOW_WATER
+
+        for mtime, size, cache_path in sorted(entries, key=lambda entry: entry[0]):
+            if total_bytes <= target_bytes:
+                break
+            try:
+                cache_path.unlink()
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+
+        self.total_bytes = total_bytes
+
+        return None
+
+    def settings(self) -> tuple:
+        """
+        Arguments that build the same cache again, ex: in each worker process
+        (see init_process_root_table_cache()).
+        """
+        return (self.cache_dir, self.max_bytes, self.enabled, self.refresh)
+
+
+# RootTableCache of the current process, see init_process_root_table_cache().
+PROCESS_ROOT_TABLE_CACHE = None
+
+
+def init_process_root_table_cache(*settings) -> None:
+    """
+    Pool initializer (see parallel_map): builds the one RootTableCache of the
+    process from RootTableCache.settings(). All the files a worker reads share
+    it, so the cache is scanned once per process rather than once per file.
+    """
+    global PROCESS_ROOT_TABLE_CACHE
+    PROCESS_ROOT_TABLE_CACHE = RootTableCache(*settings)
+
+    return None
+
+
+def process_root_table_cache() -> RootTableCache:
+    """
+    The RootTableCache set up by init_process_root_table_cache().
+    """
+    if PROCESS_ROOT_TABLE_CACHE is None:
+        raise UserWarning("init_process_root_table_cache() wasn't called in this process.")
+
+    return PROCESS_ROOT_TABLE_CACHE
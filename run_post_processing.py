@@ -21,10 +21,8 @@ from typing import List
 
 from pathlib import Path
 import yaml
-import uproot
 
 import numpy as np
-from sklearn.cluster import DBSCAN
 from sklearn.preprocessing import StandardScaler
 
 # Local imports.
@@ -34,17 +32,77 @@ import he6_cres_spec_sims.spec_tools.spec_calc.spec_calc as sc
 
 # Local imports.
 from rocks_utility import (
-    he6cres_db_query,
     get_pst_time,
     set_permissions,
     check_if_exists,
     log_file_break,
+    parallel_map,
+    root_file_times,
+    write_atomic,
+    write_parquet_dataset,
+    PARQUET_COMPRESSION,
 )
+from root_utility import (
+    KatydidRootFile,
+    RootTableCache,
+    init_process_root_table_cache,
+    process_root_table_cache,
+)
+from caen_utility import COINCIDENCE_WINDOW_NS, offline_monitor_counts
+from env_utility import (
+    ENV_QUERIES,
+    check_one_file_per_id,
+    query_run_logs,
+    fetch_env_logs,
+    nearest_join,
+)
+from clustering_utility import dbscan_1d, dbscan_partitions
 
 # Import options.
 pd.set_option("display.max_columns", 100)
 pd.options.mode.chained_assignment = None  # Comment out if debugging.
 
+# Columns of the events csvs, one row per event.
+EVENT_COLS = [
+    "run_id",
+    "file_id",
+    "EventID",
+    "Acq_ID",
+    "EventStartTime",
+    "EventStartTimeInAcq",
+    "EventEndTime",
+    "EventEndTimeInAcq",
+    "EventStartFreq",
+    "EventEndFreq",
+    "EventTimeLength",
+    "EventFreqLength",
+    "EventTrackCoverage",
+    "EventSlope",
+    "EventNBins",
+    "EventTrackTot",
+    "EventFreqIntc",
+    "EventTimeIntc",
+    "EventFreqIntA",
+    "EventTimeIntA",
+    "mMeanSNR",
+    "sMeanSNR",
+    "mTotalSNR",
+    "sTotalSNR",
+    "mMaxSNR",
+    "sMaxSNR",
+    "mTotalNUP",
+    "sTotalNUP",
+    "mTotalPower",
+    "sTotalPower",
+    "mMeanSNR_Percentile",
+    "sMeanSNR_Percentile",
+    "field",
+    "set_field",
+    "arduino_monitor_rate",
+    "FieldAveSlope",
+    "EventPerpInt",
+]
+
 
 def main():
     """
@@ -147,6 +205,58 @@ def main():
         type=int,
         help="""0: Root file names only to second. %Y-%m-%d-%H-%M-%S use for rid 1570 and earlier!
                 1: Root file names to ms. "%Y-%m-%d-%H-%M-%S-%f
+                Kept for old job scripts, the precision is now read from each file name.
+            """,
+    )
+
+    arg(
+        "-workers",
+        "--workers",
+        type=int,
+        default=1,
+        help="number of worker processes used to read the root files of a stage 1 job.",
+    )
+    arg(
+        "-no_cache",
+        "--no-cache",
+        action="store_true",
+        help="read the root and slew files directly, without the root table cache.",
+    )
+    arg(
+        "-refresh_cache",
+        "--refresh-cache",
+        action="store_true",
+        help="re-read the root and slew files and overwrite their entries in the root table cache.",
+    )
+    arg(
+        "-nearest_on_server",
+        "--nearest-on-server",
+        action="store_true",
+        help="have he6cres_db pick the slow control rows nearest each file, instead of downloading whole run windows.",
+    )
+    arg(
+        "-coincidence_channels",
+        "--coincidence-channels",
+        nargs="+",
+        type=int,
+        default=None,
+        help="count offline beta monitor coincidences between these CAEN channels instead of single channel hits.",
+    )
+    arg(
+        "-coincidence_window_ns",
+        "--coincidence-window-ns",
+        type=int,
+        default=COINCIDENCE_WINDOW_NS,
+        help=f"max ns between hits on different channels of a coincidence (default {COINCIDENCE_WINDOW_NS}).",
+    )
+    arg(
+        "-output_format",
+        "--output-format",
+        type=str,
+        choices=["csv", "parquet"],
+        default="csv",
+        help="""csv: tracks and events as csvs.
+                parquet: as zstd parquet, partitioned by run_id after stage 2. Use the same value for stages 1 and 2.
             """,
     )
 
@@ -180,7 +290,14 @@ def main():
         args.stage,
         args.do_dbscan_clustering,
         args.count_beta_mon_events_offline,
-        args.ms_standard
+        args.ms_standard,
+        args.workers,
+        args.no_cache,
+        args.refresh_cache,
+        args.nearest_on_server,
+        args.coincidence_channels,
+        args.coincidence_window_ns,
+        args.output_format,
     )
 
     # Done at the beginning and end of main.
@@ -206,7 +323,14 @@ class PostProcessing:
         stage,
         do_dbscan_clustering,
         count_beta_mon_events_offline,
-        ms_standard
+        ms_standard,
+        workers=1,
+        no_cache=False,
+        refresh_cache=False,
+        nearest_on_server=False,
+        coincidence_channels=None,
+        coincidence_window_ns=COINCIDENCE_WINDOW_NS,
+        output_format="csv",
     ):
 
         self.run_ids = run_ids
@@ -219,11 +343,21 @@ class PostProcessing:
         self.do_dbscan_clustering = do_dbscan_clustering
         self.count_beta_mon_events_offline = count_beta_mon_events_offline
         self.ms_standard = ms_standard
+        self.workers = workers
+        self.root_table_cache = RootTableCache(enabled=not no_cache, refresh=refresh_cache)
+        self.nearest_on_server = nearest_on_server
+        self.coincidence_channels = coincidence_channels
+        self.coincidence_window_ns = coincidence_window_ns
+        self.output_format = output_format
 
         self.analysis_dir = self.get_analysis_dir()
         self.root_files_df_path = self.analysis_dir / Path(f"root_files.csv")
         self.tracks_df_path = self.analysis_dir / Path(f"tracks.csv")
         self.events_df_path = self.analysis_dir / Path(f"events.csv")
+        if self.output_format == "parquet":
+            # Directories of parquet files partitioned by run_id.
+            self.tracks_df_path = self.analysis_dir / Path(f"tracks")
+            self.events_df_path = self.analysis_dir / Path(f"events")
 
         # Default field-wise epss for clustering.
         # 6/1/23 (Drew): Note that this is hardcoded so won't work generically for all fields.
@@ -266,7 +400,7 @@ class PostProcessing:
 
             # Check to see if the event_i.csv file already exists.
             # If so, then we won't reprocess.
-            events_path = self.analysis_dir / Path(f"events_{self.file_id}.csv")
+            events_path = self.analysis_dir / Path(f"events_{self.file_id}.{self.output_format}")
             if events_path.is_file():
                 print(
                     f"No processing necessary. Events csv already processed: {events_path}"
@@ -283,7 +417,10 @@ class PostProcessing:
             # Start by opening and reading in the file_df.
             self.root_files_df = self.load_root_files_df()
 
-            self.merge_csvs()
+            if self.output_format == "parquet":
+                self.merge_parquets()
+            else:
+                self.merge_csvs()
             self.sanity_check()
 
         return None
@@ -377,7 +514,7 @@ class PostProcessing:
         # Write out tracks to csv for first nft file_ids (command line argument).
         if self.file_id < self.num_files_tracks:
 
-            self.write_to_csv(self.file_id, processed_tracks, file_name="tracks")
+            self.write_chunk(self.file_id, processed_tracks, file_name="tracks")
 
         print(f"\nProcessing file_id: {self.file_id}")
 
@@ -388,7 +525,7 @@ class PostProcessing:
         if self.file_id < self.num_files_events:
 
             events = self.get_event_data_from_tracks(processed_tracks)
-            self.write_to_csv(self.file_id, events, file_name="events")
+            self.write_chunk(self.file_id, events, file_name="events")
 
         return None
 
@@ -415,10 +552,13 @@ class PostProcessing:
 
         condition = root_files_df["root_file_exists"] == True
 
-        experiment_tracks_list = [
-            self.build_tracks_for_single_file(root_files_df_row)
-            for index, root_files_df_row in root_files_df[condition].iterrows()
-        ]
+        experiment_tracks_list = parallel_map(
+            build_tracks_for_single_file,
+            root_files_df[condition].to_dict("records"),
+            self.workers,
+            initializer=init_process_root_table_cache,
+            initargs=self.root_table_cache.settings(),
+        )
 
         tracks_df = pd.concat(experiment_tracks_list, axis=0).reset_index(drop=True)
 
@@ -430,61 +570,19 @@ class PostProcessing:
 
         condition = root_files_df["root_file_exists"] == True
 
-        experiment_slewtimes_list = [
-            self.build_slewtimes_for_single_file(root_files_df_row)
-            for index, root_files_df_row in root_files_df[condition].iterrows()
-        ]
+        experiment_slewtimes_list = parallel_map(
+            build_slewtimes_for_single_file,
+            root_files_df[condition].to_dict("records"),
+            self.workers,
+            initializer=init_process_root_table_cache,
+            initargs=self.root_table_cache.settings(),
+        )
 
         slewtimes_df = pd.concat(experiment_slewtimes_list, axis=0).reset_index(drop=True)
 
         return slewtimes_df
 
 
-    def build_tracks_for_single_file(self, root_files_df_row):
-        """
-        DOCUMENT.
-        """
-
-        tracks_df = pd.DataFrame()
-
-        rootfile = uproot.open(root_files_df_row["root_file_path"])
-
-        if "multiTrackEvents;1" in rootfile.keys():
-
-            tracks_root = rootfile["multiTrackEvents;1"]["Event"]["fTracks"]
-
-            for key, value in tracks_root.items():
-                # Slice the key so it drops the redundant "fTracks."
-                tracks_df[key[9:]] = self.flat(value.array())
-
-        tracks_df["run_id"] = root_files_df_row["run_id"]
-        tracks_df["file_id"] = root_files_df_row["file_id"]
-        tracks_df["root_file_path"] = root_files_df_row["root_file_path"]
-        tracks_df["field"] = root_files_df_row["field"]
-        tracks_df["arduino_monitor_rate"] = root_files_df_row["arduino_monitor_rate"]
-
-        return tracks_df.reset_index(drop=True)
-
-    def build_slewtimes_for_single_file(self, root_files_df_row):
-        """
-        check the lines in the csv of root files. Get the path to the SlewTimes.txt and read it as a csv
-        """
-        slewfile = open(root_files_df_row["slew_file_path"],"r")
-        slewtimes_df = pd.read_csv(slewfile, sep=',', header=0)
-        #print(slewtimes_df.head(2))
-        #print(slewtimes_df.keys())
-
-        #clean up
-        slewtimes_df["on_length"] = slewtimes_df["Time_Off"]-slewtimes_df["Time_On"]
-
-        # This is to clean up gaps in the slew times. Bring this back if you need to analyze data from before September 2024. (ie when we upgraded to ExB and moved Vaunix down to bin301)
-        #slewtimes_df = slewtimes_df.drop(slewtimes_df[slewtimes_df.on_length < 2e-3].index)
-        slewtimes_df["run_id"] = root_files_df_row["run_id"]
-        slewtimes_df["file_id"] = root_files_df_row["file_id"]
-
-
-        return slewtimes_df.reset_index(drop=True)
-
     def add_track_info(self, tracks, slewtimes):
 
         # Organize this function a bit.
@@ -513,28 +611,35 @@ class PostProcessing:
         # Apply the function within each bin group and add as a new column
         tracks['MeanTrackSNR_Percentile'] = tracks.groupby(['FrequencyBin','set_field'])['MeanTrackSNR'].transform(calculate_percentile) * 100
         
-        # Merge tracks with slewtimes on run_id and file_id
-        merged_df = pd.merge(tracks, slewtimes, on=["run_id", "file_id"])
-        # Keep rows where StartTimeInRunC is greater than or equal to Time_On
-        merged_df = merged_df[merged_df["StartTimeInRunC"] >= merged_df["Time_On"]]
-        merged_df_E = merged_df.copy()
-        # Rename the StartTimeInRunC column to Event_StartTimeInRunC before grouping
-        merged_df_E = merged_df_E.rename(columns={"StartTimeInRunC": "StartTimeInRunC_E"})
-        # Group by run_id, file_id, EventID to find the earliest StartTimeInRunC for each EventID
-        grouped_df = merged_df_E.groupby(["run_id", "file_id", "EventID"])
-        # Find the earliest StartTimeInRunC for each EventID within run_id and file_id
-        earliest_start_time = grouped_df["StartTimeInRunC_E"].min().reset_index()
-        # Merge back to get the rows with earliest StartTimeInRunC
-        merged_earliest = pd.merge(merged_df, earliest_start_time, on=["run_id", "file_id", "EventID"])
-        #this should keep only rows where the event the track is in has a later startTimeInRunC than the Time_On
-        merged_earliest = merged_earliest[merged_earliest["StartTimeInRunC_E"] >= merged_earliest["Time_On"]]
-        # Group by run_id, file_id, TrackID and calculate the cumulative count to create Acq_ID
-        merged_earliest['Acq_ID'] = merged_earliest.groupby(['run_id', 'file_id', 'TrackID']).cumcount() + 1
-        # Find the indices of the rows with the highest Acq_ID within each group
-        max_acq_id_indices = merged_earliest.groupby(['run_id', 'file_id', 'TrackID'])['Acq_ID'].idxmax()
-
-        # Filter the DataFrame to keep only the rows with the highest Acq_ID
-        tracks = merged_earliest.loc[max_acq_id_indices]
+        # Acquisitions (slew time windows) of each file in time order. Acq_ID counts them from 1.
+        slewtimes = slewtimes.sort_values(["run_id", "file_id", "Time_On"], kind="mergesort")
+        slewtimes["Acq_ID"] = slewtimes.groupby(["run_id", "file_id"]).cumcount() + 1
+
+        # Drop tracks that start before the first acquisition of their file (or whose file has none).
+        first_time_on = (
+            slewtimes.groupby(["run_id", "file_id"])["Time_On"].min().rename("first_Time_On").reset_index()
+        )
+        tracks = pd.merge(tracks, first_time_on, on=["run_id", "file_id"])
+        tracks = tracks[tracks["StartTimeInRunC"] >= tracks["first_Time_On"]]
+        tracks = tracks.drop(columns=["first_Time_On"])
+
+        # An event (and so all of its tracks) belongs to the acquisition its earliest track starts in.
+        tracks["StartTimeInRunC_E"] = tracks.groupby(["run_id", "file_id", "EventID"])[
+            "StartTimeInRunC"
+        ].transform("min")
+
+        # Last acquisition with Time_On <= the event start, found with a sorted lookup per file
+        # rather than merging every track with every slew time.
+        tracks = pd.merge_asof(
+            tracks.sort_values("StartTimeInRunC_E", kind="mergesort"),
+            slewtimes.sort_values("Time_On", kind="mergesort"),
+            left_on="StartTimeInRunC_E",
+            right_on="Time_On",
+            by=["run_id", "file_id"],
+            direction="backward",
+        )
+
+        tracks = tracks.sort_values(["run_id", "file_id", "TrackID"], kind="mergesort")
 
         # Drop the StartTimeInRunC_E column
         tracks = tracks.drop(columns=['StartTimeInRunC_E'])
@@ -616,11 +721,8 @@ class PostProcessing:
         # cluster
         events = self.cluster_events(events)
 
-        # cleanup
-        events = self.update_event_info(events)
-
-        # Ensures one row per unique EventID after clustering.
-        events = self.build_events(events)
+        # cleanup. Ensures one row per unique EventID after clustering.
+        events = self.merge_clustered_events(events)
 
         if diagnostics:
 
@@ -650,75 +752,73 @@ class PostProcessing:
         """
 
         events_copy = events.copy()
-        events_copy["event_label"] = np.NaN
+        events_copy["event_label"] = np.nan
 
         #DBSCAN is now only on events with the same run_id, file_id, Acq_ID. 
         #Note that EventID is now unique to an acquisition, not a second
-        for i, (name, group) in enumerate(events_copy.groupby(["run_id", "file_id", "Acq_ID"])):
+        grouped = events_copy.groupby(["run_id", "file_id", "Acq_ID"])
+        # -1 for events with no group (NaN key).
+        group_codes = grouped.ngroup().fillna(-1).to_numpy(dtype=np.int64)
 
-            #This is to try to be robust against set_field being wrong from user error when taking data.
-            #use field from NMR instead and round to hope you get one of the fields in the clustering params
-            set_field = group.field.mean().round(2)
+        #This is to try to be robust against set_field being wrong from user error when taking data.
+        #use field from NMR instead and round to hope you get one of the fields in the clustering params
+        set_fields = grouped.field.mean().round(2).to_numpy()
+        group_params = [self.clust_params[set_field] for set_field in set_fields]
 
-            condition = (events_copy.run_id == name[0]) & (events_copy.file_id == name[1]) & (events_copy.Acq_ID == name[2])
+        group_features = [tuple(params["features"]) for params in group_params]
+        group_eps = np.array([params["eps"] for params in group_params])
 
-            events_copy.loc[condition, "event_label"] = self.dbscan_clustering(
-                events_copy[condition],
-                features=self.clust_params[set_field]["features"],
-                eps=self.clust_params[set_field]["eps"],
-                min_samples=1,
-            )
-        events_copy["EventID"] = events_copy["event_label"] + 1
+        # Groups clustered on a single feature all go through one vectorized 1-D DBSCAN
+        # (min_samples=1).
+        labels = np.full(len(events_copy), np.nan)
 
-        return events_copy
+        for features in set(features for features in group_features if len(features) == 1):
 
-    def dbscan_clustering(self, df, features: list, eps: float, min_samples: int):
+            # Trailing False so that rows with no group (code -1) are left out.
+            in_features = np.array([f == features for f in group_features] + [False])
+            codes = np.where(in_features[group_codes], group_codes, -1)
 
-        # Previously (incorrectly) used the standardscaler but
-        # This meant there was a different normalization on each file!
-        # X_norm = StandardScaler().fit_transform(df[features])
+            clustered = codes >= 0
+            labels[clustered] = dbscan_1d(
+                events_copy[features[0]].to_numpy(), codes, group_eps[codes]
+            )[clustered]
 
-        # Compute DBSCAN
-        db = DBSCAN(eps=eps, min_samples=min_samples).fit(df[features])
-        labels = db.labels_
+        # Groups clustered on several features run through sklearn DBSCAN on the worker pool.
+        multi_features = set(features for features in group_features if len(features) != 1)
+        if multi_features:
 
-        return labels
+            # Rows of each group, in their original order.
+            group_order = np.argsort(group_codes, kind="stable")
+            group_order = group_order[group_codes[group_order] >= 0]
+            group_rows = np.split(group_order, np.cumsum(np.bincount(group_codes[group_order]))[:-1])
 
-    def update_event_info(self, events_in: pd.DataFrame) -> pd.DataFrame:
+        for features in multi_features:
 
-        events = events_in.copy()
-        events = events.loc[:, ~events.columns.duplicated()]
+            groups = [group for group, f in enumerate(group_features) if f == features]
+            partitions = [group_rows[group] for group in groups]
 
-        events["EventStartTime"] = events.groupby(["run_id", "file_id", "Acq_ID", "EventID"])[
-            "EventStartTime"
-        ].transform("min")
-
-        events["EventStartTimeInAcq"] = events.groupby(["run_id", "file_id", "Acq_ID", "EventID"])[
-            "EventStartTimeInAcq"
-        ].transform("min")
-
-        events["EventEndTime"] = events.groupby(["run_id", "file_id", "Acq_ID", "EventID"])[
-            "EventEndTime"
-        ].transform("max")
-
-        events["EventEndTimeInAcq"] = events.groupby(["run_id", "file_id", "Acq_ID", "EventID"])[
-            "EventEndTimeInAcq"
-        ].transform("max")
+            feature_labels = dbscan_partitions(
+                events_copy[list(features)].to_numpy(),
+                partitions,
+                group_eps[groups],
+                min_samples=1,
+                workers=self.workers,
+            )
+            for rows in partitions:
+                labels[rows] = feature_labels[rows]
 
-        events["EventStartFreq"] = events.groupby(["run_id", "file_id", "Acq_ID", "EventID"])[
-            "EventStartFreq"
-        ].transform("min")
-        events["EventEndFreq"] = events.groupby(["run_id", "file_id", "Acq_ID", "EventID"])[
-            "EventEndFreq"
-        ].transform("max")
+        events_copy["event_label"] = labels
+        events_copy["EventID"] = events_copy["event_label"] + 1
 
-        events["EventTimeLength"] = events["EventEndTime"] - events["EventStartTime"]
-        events["EventFreqLength"] = events["EventEndFreq"] - events["EventStartFreq"]
-        events["EventNBins"] = events.groupby(["run_id", "file_id", "Acq_ID", "EventID"])[
-            "EventNBins"
-        ].transform("sum")
+        return events_copy
 
-        events["EventSlope"] = events["EventFreqLength"] / events["EventTimeLength"]
+    def merge_clustered_events(self, events: pd.DataFrame) -> pd.DataFrame:
+        """
+        Merges the events that DBSCAN put in the same cluster (same new
+        EventID) into one row per event, with the EVENT_COLS columns. Done as
+        a single keyed reduction straight to the event rows.
+        """
+        event_key = ["run_id", "file_id", "Acq_ID", "EventID"]
 
         #Event Acq_ID is an average of component track Acq_ID, 
         #as these are assigned on the basis of that track's event, non-int Acq_ID indicats a bug
@@ -747,60 +847,32 @@ class PostProcessing:
             "FieldAveSlope",
             "EventPerpInt",
         ]
+        aggregations = {
+            "EventStartTime": ("EventStartTime", "min"),
+            "EventStartTimeInAcq": ("EventStartTimeInAcq", "min"),
+            "EventEndTime": ("EventEndTime", "max"),
+            "EventEndTimeInAcq": ("EventEndTimeInAcq", "max"),
+            "EventStartFreq": ("EventStartFreq", "min"),
+            "EventEndFreq": ("EventEndFreq", "max"),
+            "EventNBins": ("EventNBins", "sum"),
+        }
         for col in cols_to_average_over:
+            aggregations[col] = (col, "mean")
 
-            events[col] = events.groupby(["run_id", "file_id", "Acq_ID", "EventID"])[
-                col
-            ].transform("mean")
+        events = events.groupby(event_key).agg(**aggregations).reset_index()
 
-        return events
+        events["EventTimeLength"] = events["EventEndTime"] - events["EventStartTime"]
+        events["EventFreqLength"] = events["EventEndFreq"] - events["EventStartFreq"]
+        events["EventSlope"] = events["EventFreqLength"] / events["EventTimeLength"]
 
-    def build_events(self, events: pd.DataFrame) -> pd.DataFrame:
+        return events[EVENT_COLS]
 
-        event_cols = [
-            "run_id",
-            "file_id",
-            "EventID",
-            "Acq_ID",
-            "EventStartTime",
-            "EventStartTimeInAcq",
-            "EventEndTime",
-            "EventEndTimeInAcq",
-            "EventStartFreq",
-            "EventEndFreq",
-            "EventTimeLength",
-            "EventFreqLength",
-            "EventTrackCoverage",
-            "EventSlope",
-            "EventNBins",
-            "EventTrackTot",
-            "EventFreqIntc",
-            "EventTimeIntc",
-            "EventFreqIntA",
-            "EventTimeIntA",
-            "mMeanSNR",
-            "sMeanSNR",
-            "mTotalSNR",
-            "sTotalSNR",
-            "mMaxSNR",
-            "sMaxSNR",
-            "mTotalNUP",
-            "sTotalNUP",
-            "mTotalPower",
-            "sTotalPower",
-            "mMeanSNR_Percentile",
-            "sMeanSNR_Percentile",
-            "field",
-            "set_field",
-            "arduino_monitor_rate",
-            "FieldAveSlope",
-            "EventPerpInt",
-        ]
+    def build_events(self, events: pd.DataFrame) -> pd.DataFrame:
 
         events = (
             events.groupby(["run_id", "file_id", "Acq_ID", "EventID"])
             .first()
-            .reset_index()[event_cols]
+            .reset_index()[EVENT_COLS]
         )
 
         return events
@@ -810,94 +882,77 @@ class PostProcessing:
 
         tracks = tracks_in.copy()
 
-        tracks["Acq_ID"] = tracks.groupby(["run_id", "file_id", "EventID"])[
-            "Acq_ID"
-        ].transform("mean")
-
-        tracks["EventStartTime"] = tracks.groupby(["run_id", "file_id", "EventID"])[
-            "StartTimeInRunC"
-        ].transform("min")
-        
-        tracks["EventStartTimeInAcq"] = tracks.groupby(["run_id", "file_id", "EventID"])[
-            "StartTimeInAcq"
-        ].transform("min")
-
-        tracks["EventEndTime"] = tracks.groupby(["run_id", "file_id", "EventID"])[
-            "EndTimeInRunC"
-        ].transform("max")
+        # All the event level reductions in one pass over the event groups,
+        # then broadcast back to the tracks of each event.
+        grouped = tracks.groupby(["run_id", "file_id", "EventID"])
+        event_info = grouped.agg(
+            Acq_ID=("Acq_ID", "mean"),
+            EventStartTime=("StartTimeInRunC", "min"),
+            EventStartTimeInAcq=("StartTimeInAcq", "min"),
+            EventEndTime=("EndTimeInRunC", "max"),
+            EventEndTimeInAcq=("EndTimeInAcq", "max"),
+            EventStartFreq=("StartFrequency", "min"),
+            EventEndFreq=("EndFrequency", "max"),
+            EventNBins=("NTrackBins", "sum"),
+            EventTrackTimeLength=("TimeLength", "sum"),
+            mMeanSNR=("MeanTrackSNR", "mean"),
+            sMeanSNR=("MeanTrackSNR", "std"),
+            mTotalSNR=("TotalTrackSNR", "mean"),
+            sTotalSNR=("TotalTrackSNR", "std"),
+            mMaxSNR=("MaxTrackSNR", "mean"),
+            sMaxSNR=("MaxTrackSNR", "std"),
+            mTotalNUP=("TotalTrackNUP", "mean"),
+            sTotalNUP=("TotalTrackNUP", "std"),
+            mTotalPower=("TotalPower", "mean"),
+            sTotalPower=("TotalPower", "std"),
+            mMeanSNR_Percentile=("MeanTrackSNR_Percentile", "mean"),
+            sMeanSNR_Percentile=("MeanTrackSNR_Percentile", "std"),
+            EventTrackTot=("EventSequenceID", "count"),
+        )
+        # Row of event_info for each track (ngroup follows the same sorted group order).
+        event_index = grouped.ngroup().to_numpy()
 
-        tracks["EventEndTimeInAcq"] = tracks.groupby(["run_id", "file_id", "EventID"])[
-            "EndTimeInAcq"
-        ].transform("max")
+        def broadcast(column):
+            return event_info[column].to_numpy()[event_index]
 
-        tracks["EventStartFreq"] = tracks.groupby(["run_id", "file_id", "EventID"])[
-            "StartFrequency"
-        ].transform("min")
-        tracks["EventEndFreq"] = tracks.groupby(["run_id", "file_id", "EventID"])[
-            "EndFrequency"
-        ].transform("max")
+        for column in [
+            "Acq_ID",
+            "EventStartTime",
+            "EventStartTimeInAcq",
+            "EventEndTime",
+            "EventEndTimeInAcq",
+            "EventStartFreq",
+            "EventEndFreq",
+        ]:
+            tracks[column] = broadcast(column)
 
         tracks["EventTimeLength"] = tracks["EventEndTime"] - tracks["EventStartTime"]
         tracks["EventFreqLength"] = tracks["EventEndFreq"] - tracks["EventStartFreq"]
-        tracks["EventNBins"] = tracks.groupby(["run_id", "file_id", "EventID"])[
-            "NTrackBins"
-        ].transform("sum")
+        tracks["EventNBins"] = broadcast("EventNBins")
 
         tracks["EventSlope"] = tracks["EventFreqLength"] / tracks["EventTimeLength"]
 
         tracks["EventTrackCoverage"] = (
-            tracks.groupby(["run_id", "file_id", "EventID"])["TimeLength"].transform(
-                "sum"
-            )
-            / tracks["EventTimeLength"]
+            broadcast("EventTrackTimeLength") / tracks["EventTimeLength"]
         )
 
         # Power/SNR metrics.
-        tracks["mMeanSNR"] = tracks.groupby(["run_id", "file_id", "EventID"])[
-            "MeanTrackSNR"
-        ].transform("mean")
-        tracks["sMeanSNR"] = tracks.groupby(["run_id", "file_id", "EventID"])[
-            "MeanTrackSNR"
-        ].transform("std")
-
-        tracks["mTotalSNR"] = tracks.groupby(["run_id", "file_id", "EventID"])[
-            "TotalTrackSNR"
-        ].transform("mean")
-        tracks["sTotalSNR"] = tracks.groupby(["run_id", "file_id", "EventID"])[
-            "TotalTrackSNR"
-        ].transform("std")
-
-        tracks["mMaxSNR"] = tracks.groupby(["run_id", "file_id", "EventID"])[
-            "MaxTrackSNR"
-        ].transform("mean")
-        tracks["sMaxSNR"] = tracks.groupby(["run_id", "file_id", "EventID"])[
-            "MaxTrackSNR"
-        ].transform("std")
-
-        tracks["mTotalNUP"] = tracks.groupby(["run_id", "file_id", "EventID"])[
-            "TotalTrackNUP"
-        ].transform("mean")
-        tracks["sTotalNUP"] = tracks.groupby(["run_id", "file_id", "EventID"])[
-            "TotalTrackNUP"
-        ].transform("std")
-
-        tracks["mTotalPower"] = tracks.groupby(["run_id", "file_id", "EventID"])[
-            "TotalPower"
-        ].transform("mean")
-        tracks["sTotalPower"] = tracks.groupby(["run_id", "file_id", "EventID"])[
-            "TotalPower"
-        ].transform("std")
-
-        tracks["mMeanSNR_Percentile"] = tracks.groupby(["run_id", "file_id", "EventID"])[
-            "MeanTrackSNR_Percentile"
-        ].transform("mean")
-        tracks["sMeanSNR_Percentile"] = tracks.groupby(["run_id", "file_id", "EventID"])[
-            "MeanTrackSNR_Percentile"
-        ].transform("std")
-
-        tracks["EventTrackTot"] = tracks.groupby(
-            ["run_id", "file_id", "EventID"]
-        ).EventSequenceID.transform("count")
+        for column in [
+            "mMeanSNR",
+            "sMeanSNR",
+            "mTotalSNR",
+            "sTotalSNR",
+            "mMaxSNR",
+            "sMaxSNR",
+            "mTotalNUP",
+            "sTotalNUP",
+            "mTotalPower",
+            "sTotalPower",
+            "mMeanSNR_Percentile",
+            "sMeanSNR_Percentile",
+            "EventTrackTot",
+        ]:
+            tracks[column] = broadcast(column)
 
         tracks["EventFreqIntc"] = (
             tracks["EventEndFreq"] - tracks["EventEndTime"] * tracks["EventSlope"]
@@ -933,91 +988,43 @@ class PostProcessing:
     def add_env_data(self, root_files_df):
 
         # Step 0: Make sure the root_files_df has a tz aware dt column.
-        root_files_df["pst_time"] = root_files_df["root_file_path"].apply(
-            lambda x: self.get_utc_time(x)
-        )
+        root_files_df["pst_time"] = root_file_times(root_files_df["root_file_path"])
         root_files_df["pst_time"] = root_files_df["pst_time"].dt.tz_localize(
             "US/Pacific"
         )
         root_files_df["utc_time"] = root_files_df["pst_time"].dt.tz_convert("UTC")
 
-        # Step 1: Add the monitor rate/field data to each file.
-        root_files_df = self.add_arduino_monitor_rate(root_files_df)
-        root_files_df = self.add_field(root_files_df)
+        # Step 1: Fetch the slow control logs at the same time, then add the monitor rate/field data to each file.
+        logs = fetch_env_logs(
+            root_files_df,
+            ["monitor", "nmr", "rga", "endpoint"],
+            nearest_on_server=self.nearest_on_server,
+        )
+
+        root_files_df = self.add_arduino_monitor_rate(root_files_df, logs["monitor"])
+        root_files_df = self.add_field(root_files_df, logs["nmr"])
         if self.count_beta_mon_events_offline:
             root_files_df = self.add_offline_monitor_counts(root_files_df)
-        root_files_df = self.add_pressures(root_files_df)
-        root_files_df = self.add_temps(root_files_df)
+        root_files_df = self.add_pressures(root_files_df, logs["rga"])
+        root_files_df = self.add_temps(root_files_df, logs["endpoint"])
 
         # Step 3. Add the set_field by rounding to nearest 100th place.
         root_files_df["set_field"] = root_files_df["field"].round(decimals=2)
 
         return root_files_df
 
-    def get_utc_time(self, root_file_path):
+    def add_arduino_monitor_rate(self, root_files_df, monitor_log=None):
         # USED in add_env_data()
-        if self.ms_standard:
-            #print("User specified run_ids are all in ms standard.")
-            time_str = root_file_path[-32:-9]
-            time_str_padded = time_str + "000"  # Pad with zeros to get microseconds
-            datetime_object = datetime.datetime.strptime(time_str, "%Y-%m-%d-%H-%M-%S-%f")
+        check_one_file_per_id(root_files_df)
 
-        else:
-            print("User specified run_ids are all in second standard.")
-            time_str = root_file_path[-28:-9]
-            datetime_object = datetime.datetime.strptime(time_str, "%Y-%m-%d-%H-%M-%S")
+        # One query for all the run_ids, then one nearest-time join for all files.
+        if monitor_log is None:
+            monitor_log = query_run_logs(root_files_df, *ENV_QUERIES["monitor"])
 
-        return datetime_object
-
-    def get_nearest(self, df, dt):
-        # USED in add_env_data()
-        # created_at column is the dt column.
-        minidx = (dt - df["created_at"]).abs().idxmin()
-
-        return df.loc[[minidx]].iloc[0]
-
-    def add_arduino_monitor_rate(self, root_files_df):
-        # USED in add_env_data()
-        root_files_df["arduino_monitor_rate"] = np.nan
-
-        # Step 0. Group by run_id.
-        for rid, root_files_df_gb in root_files_df.groupby(["run_id"]):
-
-            # Step 1. Find the extreme times present in the given run_id.
-            # The idea is that we want to be careful about the amount of queries we do to get this info.
-            # Here we only do one query per run_id (instead of one per file)
-
-            dt_max = root_files_df_gb.utc_time.max().floor("min").tz_localize(None)
-            dt_min = root_files_df_gb.utc_time.min().floor("min").tz_localize(None)
-
-            # There is an issue here right now but this will be useful later.
-            query = """SELECT m.monitor_id, m.created_at, m.rate
-                       FROM he6cres_runs.monitor as m 
-                       WHERE m.created_at >= '{}'::timestamp
-                           AND m.created_at <= '{}'::timestamp + interval '1 minute'
-                    """.format(
-                dt_min, dt_max
-            )
-
-            monitor_log = he6cres_db_query(query)
-            monitor_log["created_at"] = monitor_log["created_at"].dt.tz_localize("UTC")
-
-            for fid, file_path in root_files_df_gb.groupby(["file_id"]):
-
-                if len(file_path) != 1:
-                    raise UserWarning(
-                        f"There should be only one file with run_id = {rid} and file_id = {fid}."
-                    )
-
-                # Get arduino_monitor_rate during run.
-                arduino_monitor_rate = self.get_nearest(
-                    monitor_log, file_path.utc_time.iloc[0]
-                ).rate
-
-                condition = (root_files_df["run_id"] == rid) & (
-                    root_files_df["file_id"] == fid
-                )
-                root_files_df["arduino_monitor_rate"][condition] = arduino_monitor_rate
+        # Get arduino_monitor_rate during run.
+        root_files_df["arduino_monitor_rate"] = nearest_join(
+            root_files_df, monitor_log, ["rate"], by=["run_id"]
+        )["rate"]
 
         if root_files_df["arduino_monitor_rate"].isnull().values.any():
             raise UserWarning(f"Some arduino_monitor_rate data was not collected.")
@@ -1025,258 +1032,111 @@ class PostProcessing:
         return root_files_df
 
     def add_offline_monitor_counts(self, root_files_df):
-        # For now works with just the trigger channel (CH4)
-        # Does not computer offline coincidence!
+        # Counts the trigger channel (CH4), or with coincidence_channels the
+        # offline coincidences between those channels (see coincidence_times).
         # USED in add_env_data()
-        root_files_df["offline_monitor_counts"] = np.nan
-
-        # Step 0. Group by run_id.
-        for rid, root_files_df_gb in root_files_df.groupby(["run_id"]):
-
-            # Step 1. Find the ealiest UTC time present in the given run_id.
-            dt_min = root_files_df_gb.utc_time.min().floor("min").tz_localize(None)
-
-            # Get runname in caen_runs table nearest before the earliest time in run_id. logged_at also UTC
-            query = """SELECT cr.caen_run_id, cr.runname, cr.logged_at
-                       FROM he6cres_runs.caen_runs as cr 
-                       WHERE cr.logged_at <= '{}'::timestamp
-                       ORDER BY cr.caen_run_id DESC LIMIT 1
-                    """.format(dt_min)
+        # Each file is counted in every CAEN run that overlaps its second, found
+        # in the CAEN run index (see offline_monitor_counts).
+        root_files_df["offline_monitor_counts"] = offline_monitor_counts(
+            root_files_df["utc_time"],
+            channel=4,
+            coincidence_channels=self.coincidence_channels,
+            coincidence_window_ns=self.coincidence_window_ns,
+        )
 
-            caen_log = he6cres_db_query(query)
-            if caen_log.empty:
-                raise UserWarning("No matching caen_run found in the database.")
-            else:
-                caen_run_path = Path(caen_log['runname'].iloc[0])
-
-                # Build path to run.info on rocks
-                rocks_caen_run_info_path = Path('/data/raid2/eliza4/he6_cres/betamon/caen') / caen_run_path.name / Path('run.info')
-
-                # Read in run.info and extract time.start
-                time_start = None
-                if rocks_caen_run_info_path.exists():
-                    with rocks_caen_run_info_path.open('r') as f:
-                        for line in f:
-                            if line.startswith('time.start='):
-                                time_start = line.split('=')[1].strip()
-                                break
-                # Define the format of the input string
-                time_format = "%Y/%m/%d %H:%M:%S.%f%z"
-
-                # Convert to a datetime object. includes the parsed time and timezone offset for PST
-                dt = datetime.datetime.strptime(time_start, time_format)
-                # Convert to UTC
-                dt_utc = dt.astimezone(datetime.timezone.utc)
-                # Convert to numpy.datetime64
-                caen_run_time_start = np.datetime64(dt_utc)
-
-                # Build path to compass data csv on rocks
-                rocks_caen_run_data_path = Path('/data/raid2/eliza4/he6_cres/betamon/caen') / caen_run_path.name / Path(f'RAW/DataR_CH4@DT5725_1146_{caen_run_path.name}.csv')
-                # Read in the compass data csv to caen_df
-                caen_df = pd.read_csv(rocks_caen_run_data_path, index_col=0, sep=';')
-
-                # Add new column to caen_df for absolute UTC timestamp for each hit
-                # Convert TIMETAG from picoseconds to nanoseconds
-                caen_df['TIMETAG_ns'] = caen_df['TIMETAG'] / 1_000
-                # Use 'ns' as the unit
-                caen_df['TIMETAG_abs'] = caen_run_time_start + pd.to_timedelta(caen_df['TIMETAG_ns'], unit='ns')
-                caen_df['TIMETAG_abs'] = caen_df['TIMETAG_abs'].dt.tz_localize("UTC")
-                # print(caen_df)
-
-                condition = (root_files_df["run_id"] == rid)
-                # Apply the monitor event counting function to each row (ie each 1s CRES file) in this run_id
-                root_files_df.loc[condition, 'offline_monitor_counts'] = root_files_df_gb.apply(self.count_events, caen_df=caen_df, axis=1)
+        if root_files_df["offline_monitor_counts"].isnull().values.any():
+            print("Some files are outside of all the CAEN runs, no offline monitor counts.")
 
         return root_files_df
 
-    # Define a function to count events for each row in df_A
-    def count_events(self, row, caen_df):
-        end_time = row['utc_time'] #spec(k) file name is immediatly after write time, not before
-        start_time = end_time - pd.Timedelta(seconds=1)
-        #print("start time: ", start_time, " end time: ", end_time)
-        #Works fine to compare datetime and np.datetime64 objects!
-        #print(caen_df[(caen_df['TIMETAG_abs'] > start_time) & (caen_df['TIMETAG_abs'] < end_time)])
-        return caen_df[(caen_df['TIMETAG_abs'] > start_time) & (caen_df['TIMETAG_abs'] < end_time)].shape[0]
-
-    def count_events_efficient(self, row, caen_df):
-        # Ensure TIMETAG_abs is a NumPy datetime64 array
-        timetag_values = caen_df['TIMETAG_abs'].to_numpy()
-
-        # Convert start_time and end_time to NumPy datetime64
-        start_time = np.datetime64(row['utc_time'])
-        end_time = start_time + np.timedelta64(1, 's')  # Add 1 second
-        print("start time: ", start_time, " end time: ", end_time)
-        # Use searchsorted to find the indices
-        start_idx = np.searchsorted(timetag_values, start_time, side='left')
-        end_idx = np.searchsorted(timetag_values, end_time, side='right')
-        print(timetag_values[start_idx])
-        print(timetag_values[end_idx])
-        # Return the count of events within the range
-        return end_idx - start_idx        
-
-    def add_field(self, root_files_df):
-
-        root_files_df["field"] = np.nan
-
-        # Step 0. Group by run_id.
-        for rid, root_files_df_gb in root_files_df.groupby(["run_id"]):
-
-            # Step 1. Find the extreme times present in the given run_id.
-            # The idea is that we want to be careful about the amount of queries we do to get this info.
-            # Here we only do one query per run_id (instead of one per file)
-            dt_max = root_files_df_gb.utc_time.max().floor("min").tz_localize(None)
-            dt_min = root_files_df_gb.utc_time.min().floor("min").tz_localize(None)
-
-            # Note that I also need to make sure the field probe was locked!
-            query = """SELECT n.nmr_id, n.created_at, n.field
-                       FROM he6cres_runs.nmr as n 
-                       WHERE n.created_at >= '{}'::timestamp
-                           AND n.created_at <= '{}'::timestamp + interval '1 minute'
-                           AND n.locked = TRUE
-                    """.format(
-                dt_min, dt_max
-            )
-
-            field_log = he6cres_db_query(query)
-            if field_log.empty:
-                field_log["created_at"] = np.nan
-            else:    
-                field_log["created_at"] = field_log["created_at"].dt.tz_localize("UTC")
+    def add_field(self, root_files_df, field_log=None):
+        check_one_file_per_id(root_files_df)
 
-                for fid, file_path in root_files_df_gb.groupby(["file_id"]):
+        if field_log is None:
+            field_log = query_run_logs(root_files_df, *ENV_QUERIES["nmr"])
 
-                    if len(file_path) != 1:
-                        raise UserWarning(
-                            f"There should be only one file with run_id = {rid} and file_id = {fid}."
-                        )
+        # Get field during second of data
+        root_files_df["field"] = nearest_join(
+            root_files_df, field_log, ["field"], by=["run_id"], require="locked"
+        )["field"]
 
-                    # Get field during second of data
-                    field = self.get_nearest(field_log, file_path.utc_time.iloc[0]).field
-
-                    # Now get the nearest rate for each file_id and fill those in!! Then this gets joined with the whole table.
-                    condition = (root_files_df["run_id"] == rid) & (
-                        root_files_df["file_id"] == fid
-                    )
-                    root_files_df["field"][condition] = field
-
-            if root_files_df["field"].isnull().values.any():
-                #raise UserWarning(f"Some rate data was not collected.")
-                print("Some nmr data was not collected.")
+        if root_files_df["field"].isnull().values.any():
+            #raise UserWarning(f"Some rate data was not collected.")
+            print("Some nmr data was not collected.")
 
         return root_files_df
 
-    def add_pressures(self, root_files_df):
+    def add_pressures(self, root_files_df, rga_log=None):
         # Define the list of gases
         gases = [
             "nitrogen", "helium", "co2", "hydrogen", 
             "water", "oxygen", "krypton", "argon", 
             "cf3", "a19", "total"
         ]
+        check_one_file_per_id(root_files_df)
 
-        # Initialize the columns for each gas with NaN
-        root_files_df = root_files_df.assign(**{gas: np.nan for gas in gases})
-
-
-        # Step 0. Group by run_id.
-        for rid, root_files_df_gb in root_files_df.groupby(["run_id"]):
-
-            # Step 1. Find the extreme times present in the given run_id.
-            # The idea is that we want to be careful about the amount of queries we do to get this info.
-            # Here we only do one query per run_id (instead of one per file)
-            dt_max = root_files_df_gb.utc_time.max().floor("min").tz_localize(None)
-            dt_min = root_files_df_gb.utc_time.min().floor("min").tz_localize(None)
-
-            # Note that I also need to make sure the field probe was locked!
-            query = """SELECT r.utc_write_time, r.nitrogen, r.helium, r.co2, r.hydrogen, r.water, r.oxygen, r.krypton, r.argon, r.cf3, r.a19, r.total
-                       FROM he6cres_runs.rga as r 
-                       WHERE r.utc_write_time >= '{}'::timestamp
-                           AND r.utc_write_time <= '{}'::timestamp + interval '1 minute'
-                           AND r.time_since_write < 60.0
-                    """.format(
-                dt_min, dt_max
-            )
-
-            rga_log = he6cres_db_query(query)
-            if rga_log.empty:
-                rga_log["created_at"] = np.nan
-            else:    
-                # This is NOT the same as the created_at field in the db, I'm re-naming the more accurate utc_write_time
-                # to created_at for consistancy in get_nearest()
-                rga_log["created_at"] = rga_log["utc_write_time"].dt.tz_localize("UTC")
-
-                for fid, file_path in root_files_df_gb.groupby(["file_id"]):
-
-                    if len(file_path) != 1:
-                        raise UserWarning(
-                            f"There should be only one file with run_id = {rid} and file_id = {fid}."
-                        )
-
-                    nearest_row = self.get_nearest(rga_log, file_path.utc_time.iloc[0])
-                    # Assign values for all gases at once
-                    condition = (root_files_df["run_id"] == rid) & (root_files_df["file_id"] == fid)
-                    root_files_df.loc[condition, gases] = nearest_row[gases].values
+        if rga_log is None:
+            rga_log = query_run_logs(root_files_df, *ENV_QUERIES["rga"])
 
+        # Assign values for all gases at once
+        root_files_df = root_files_df.assign(
+            **nearest_join(root_files_df, rga_log, gases, by=["run_id"])
+        )
 
-            if root_files_df["total"].isnull().values.any():
-                print("Some rga data was not collected.")
+        if root_files_df["total"].isnull().values.any():
+            print("Some rga data was not collected.")
 
         return root_files_df
 
-    def add_temps(self, root_files_df):
+    def add_temps(self, root_files_df, temp_log=None):
         # Define the list of endpoints
         epts = [7,8,9,10,11,12,13,14]
         sensor_names = ['A','B','C','D','E','F','G','H']
+        check_one_file_per_id(root_files_df)
 
-        # Initialize the columns for each endpoint with NaN
-        root_files_df = root_files_df.assign(**{sensor: np.nan for sensor in sensor_names})
-
-        # Step 0. Group by run_id.
-        for rid, root_files_df_gb in root_files_df.groupby(["run_id"]):
-
-            # Step 1. Find the extreme times present in the given run_id.
-            # The idea is that we want to be careful about the amount of queries we do to get this info.
-            # Here we only do one query per run_id (instead of one per file)
-            dt_max = root_files_df_gb.utc_time.max().floor("min").tz_localize(None)
-            dt_min = root_files_df_gb.utc_time.min().floor("min").tz_localize(None)
-
-            # 
-            query = """SELECT e.endpoint_id, e.timestamp, e.value_raw
-                       FROM public.endpoint_numeric_data as e
-                       WHERE e.timestamp >= '{}'::timestamp
-                           AND e.timestamp <= '{}'::timestamp + interval '1 minute'
-                    """.format(
-                dt_min, dt_max
-            )
+        if temp_log is None:
+            temp_log = query_run_logs(root_files_df, *ENV_QUERIES["endpoint"])
 
-            rga_log = he6cres_db_query(query)
+        # Match each file to the nearest reading of each endpoint.
+        endpoints = pd.DataFrame({"endpoint_id": epts, "sensor": sensor_names})
+        files = root_files_df[["run_id", "utc_time"]].reset_index(drop=True)
+        file_endpoints = files.assign(row=files.index).merge(endpoints, how="cross")
+        file_endpoints["temp"] = nearest_join(
+            file_endpoints, temp_log, ["value_raw"], by=["run_id", "endpoint_id"]
+        )["value_raw"].to_numpy()
 
-            if not rga_log.empty:
-                rga_log["created_at"] = rga_log["timestamp"].dt.tz_localize("UTC")
+        temps = file_endpoints.pivot(index="row", columns="sensor", values="temp")
+        temps = temps.reindex(index=files.index, columns=sensor_names)
+        temps.index = root_files_df.index
+        root_files_df = root_files_df.assign(**temps)
 
-                # Filter and group `rga_log` by `endpoint_id` once
-                rga_log_grouped = {ept: grp for ept, grp in rga_log.groupby("endpoint_id")}
+        # Check for missing data
+        if root_files_df[sensor_names].isnull().any().any():
+            print("Some temp data was not collected.")
 
-                for fid, file_path in root_files_df_gb.groupby("file_id"):
-                    if len(file_path) != 1:
-                        raise UserWarning(f"There should be only one file with run_id = {rid} and file_id = {fid}.")
+        return root_files_df
 
-                    file_time = file_path.utc_time.iloc[0]
+    def write_chunk(self, file_id, df_chunk, file_name):
+        if self.output_format == "parquet":
+            self.write_to_parquet(file_id, df_chunk, file_name)
+        else:
+            self.write_to_csv(file_id, df_chunk, file_name)
 
-                    # Iterate over the endpoints and assign temperatures
-                    for i, ept in enumerate(epts):
-                        rga_log_ept = rga_log_grouped.get(ept)
-                        if rga_log_ept is not None:
-                            temp_value = self.get_nearest(rga_log_ept, file_time)["value_raw"]
+        return None
 
-                            # Apply the value to the relevant rows
-                            condition = (root_files_df["run_id"] == rid) & (root_files_df["file_id"] == fid)
-                            root_files_df.loc[condition, sensor_names[i]] = temp_value
+    def write_to_parquet(self, file_id, df_chunk, file_name):
+        print(f"Writing {file_name} data to disk (parquet) for file_id {file_id}.")
+        write_path = self.analysis_dir / Path(f"{file_name}_{file_id}.parquet")
 
-        # Check for missing data
-        if root_files_df[sensor_names].isnull().any().any():
-            print("Some temp data was not collected.")
+        # Atomic since the file marks the file_id as processed.
+        write_atomic(
+            write_path,
+            lambda tmp_path: df_chunk.to_parquet(
+                tmp_path, compression=PARQUET_COMPRESSION, index=False
+            ),
+        )
 
-        return root_files_df
+        return None
 
     def write_to_csv(self, file_id, df_chunk, file_name):
         print(f"Writing {file_name} data to disk for file_id {file_id}.")
@@ -1352,6 +1212,45 @@ class PostProcessing:
 
         return None
 
+    def merge_parquets(self):
+
+        # Same as in merge_csvs().
+        max_fid = self.root_files_df.file_id.max()
+        if self.num_files_events > max_fid:
+            self.num_files_events = max_fid + 1
+
+        self.merge_parquet_chunks("tracks", self.num_files_tracks, self.tracks_df_path)
+        self.merge_parquet_chunks("events", self.num_files_events, self.events_df_path)
+
+        return None
+
+    def merge_parquet_chunks(self, file_name, num_files, dataset_path):
+        chunk_path_list = [
+            self.analysis_dir / Path(f"{file_name}_{i}.parquet") for i in range(num_files)
+        ]
+
+        if not all(path.is_file() for path in chunk_path_list):
+            print(f"Not all {num_files} {file_name} parquets are present for merging.")
+
+        # Filter the list to include only the paths that exist
+        chunk_path_list = [path for path in chunk_path_list if path.is_file()]
+
+        dfs = [pd.read_parquet(chunk_path) for chunk_path in chunk_path_list]
+        df = pd.concat(dfs, ignore_index=True)
+        lens = [len(chunk_df) for chunk_df in dfs]
+        print(f"\nCombining set of {file_name} dfs.\n")
+        print("lengths: ", lens)
+        print("sum: ", sum(lens))
+        print("len single dataset (sanity check): ", len(df))
+        print(f"{file_name} cols: ", df.columns)
+
+        write_parquet_dataset(df, dataset_path, partition_cols=["run_id"])
+
+        for chunk_path in chunk_path_list:
+            chunk_path.unlink()
+
+        return None
+
     def sanity_check(self):
 
         desired_path_list = [
@@ -1359,7 +1258,9 @@ class PostProcessing:
             self.tracks_df_path,
             self.events_df_path,
         ]
-        real_path_list = self.analysis_dir.glob("*.csv")
+        real_path_list = list(self.analysis_dir.glob("*.csv")) + list(
+            self.analysis_dir.glob("*.parquet")
+        )
         remove_list = list(set(real_path_list) - set(desired_path_list))
 
         if len(remove_list) == 0:
@@ -1378,23 +1279,6 @@ class PostProcessing:
 
         return None
 
-    def flat(self, jaggedarray) -> np.ndarray:
-        """
-        Given jagged array (common in root), it returns a flattened array.
-
-        Args:
-            jaggedarray (awkward array): No specifications.
-
-        Returns:
-            array (np.ndarray): No specifications.
-
-        """
-        flatarray = np.array([])
-        for a in jaggedarray.tolist():
-            flatarray = np.append(flatarray, a)
-
-        return flatarray
-
     def get_slope(self, true_field, frequency: float = 19.15e9):
 
         approx_power = sc.power_larmor(true_field, frequency)
@@ -1404,5 +1288,52 @@ class PostProcessing:
         return approx_slope
 
 
+def build_tracks_for_single_file(root_files_df_row):
+    """
+    Tracks of one root file (from the root table cache of the process) with
+    the per-file info of its root_files_df row (dict) attached. Module level
+    so that the -workers pool only pickles the row.
+    """
+
+    root_file_path = root_files_df_row["root_file_path"]
+
+    def read_root_file():
+        with KatydidRootFile(root_file_path, tree_types=("multiTrackEvents",)) as root_file:
+            return root_file.tracks()
+
+    tracks_df = process_root_table_cache().load(root_file_path, "multiTrackEvents", read_root_file)
+
+    tracks_df["run_id"] = root_files_df_row["run_id"]
+    tracks_df["file_id"] = root_files_df_row["file_id"]
+    tracks_df["root_file_path"] = root_files_df_row["root_file_path"]
+    tracks_df["field"] = root_files_df_row["field"]
+    tracks_df["arduino_monitor_rate"] = root_files_df_row["arduino_monitor_rate"]
+
+    return tracks_df.reset_index(drop=True)
+
+
+def build_slewtimes_for_single_file(root_files_df_row):
+    """
+    check the lines in the csv of root files. Get the path to the SlewTimes.txt and read it as a csv
+    """
+    slew_file_path = root_files_df_row["slew_file_path"]
+    slewtimes_df = process_root_table_cache().load(
+        slew_file_path, "slewtimes", lambda: pd.read_csv(slew_file_path, sep=',', header=0)
+    )
+    #print(slewtimes_df.head(2))
+    #print(slewtimes_df.keys())
+
+    #clean up
+    slewtimes_df["on_length"] = slewtimes_df["Time_Off"]-slewtimes_df["Time_On"]
+
+    # This is to clean up gaps in the slew times. Bring this back if you need to analyze data from before September 2024. (ie when we upgraded to ExB and moved Vaunix down to bin301)
+    #slewtimes_df = slewtimes_df.drop(slewtimes_df[slewtimes_df.on_length < 2e-3].index)
+    slewtimes_df["run_id"] = root_files_df_row["run_id"]
+    slewtimes_df["file_id"] = root_files_df_row["file_id"]
+
+
+    return slewtimes_df.reset_index(drop=True)
+
+
 if __name__ == "__main__":
     main()
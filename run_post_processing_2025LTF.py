@@ -18,10 +18,12 @@ import psycopg2
 from psycopg2 import Error
 import typing
 from typing import List
+from functools import partial
 
 from pathlib import Path
 import yaml
-import uproot
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 import numpy as np
 from sklearn.cluster import DBSCAN
@@ -34,11 +36,32 @@ import he6_cres_spec_sims.spec_tools.spec_calc.spec_calc as sc
 
 # Local imports.
 from rocks_utility import (
-    he6cres_db_query,
     get_pst_time,
     set_permissions,
     check_if_exists,
     log_file_break,
+    parallel_map,
+    root_file_times,
+    write_atomic,
+    write_parquet_dataset,
+    PARQUET_COMPRESSION,
+)
+from root_utility import (
+    KatydidRootFile,
+    RootTableCache,
+    init_process_root_table_cache,
+    process_root_table_cache,
+)
+from caen_utility import COINCIDENCE_WINDOW_NS, offline_monitor_counts
+from env_utility import (
+    ENV_TABLES,
+    fetch_env_logs,
+    add_env_logs,
+    add_arduino_monitor_rate,
+    add_field,
+    add_pressures,
+    add_temps,
+    add_voltage,
 )
 
 # Import options.
@@ -133,11 +156,76 @@ def main():
         type=int,
         help="""0: Root file names only to second. %Y-%m-%d-%H-%M-%S use for rid 1570 and earlier!
                 1: Root file names to ms. "%Y-%m-%d-%H-%M-%S-%f
+                Kept for old job scripts, the precision is now read from each file name.
+            """,
+    )
+
+    arg(
+        "-step_size",
+        "--step-size",
+        type=str,
+        default=None,
+        help="""stream the track points to disk in chunks of this many entries (ex: 10000) 
+                or bytes (ex: 100MB) to bound the memory of stage 1. Default: read whole files.
+            """,
+    )
+    arg(
+        "-workers",
+        "--workers",
+        type=int,
+        default=1,
+        help="number of worker processes used to read the root files of a stage 1 job.",
+    )
+    arg(
+        "-no_cache",
+        "--no-cache",
+        action="store_true",
+        help="read the root files directly, without the root table cache.",
+    )
+    arg(
+        "-refresh_cache",
+        "--refresh-cache",
+        action="store_true",
+        help="re-read the root files and overwrite their entries in the root table cache.",
+    )
+    arg(
+        "-nearest_on_server",
+        "--nearest-on-server",
+        action="store_true",
+        help="have he6cres_db pick the slow control rows nearest each file, instead of downloading whole run windows.",
+    )
+    arg(
+        "-coincidence_channels",
+        "--coincidence-channels",
+        nargs="+",
+        type=int,
+        default=None,
+        help="count offline beta monitor coincidences between these CAEN channels instead of single channel hits.",
+    )
+    arg(
+        "-coincidence_window_ns",
+        "--coincidence-window-ns",
+        type=int,
+        default=COINCIDENCE_WINDOW_NS,
+        help=f"max ns between hits on different channels of a coincidence (default {COINCIDENCE_WINDOW_NS}).",
+    )
+    arg(
+        "-output_format",
+        "--output-format",
+        type=str,
+        choices=["csv", "parquet"],
+        default="csv",
+        help="""csv: tracks and track points as csvs.
+                parquet: as zstd parquet, partitioned by run_id after stage 2. Use the same value for stages 1 and 2.
             """,
     )
 
     args = par.parse_args()
 
+    # uproot takes a number of entries as an int, or a memory size as a string.
+    if args.step_size is not None and args.step_size.isdigit():
+        args.step_size = int(args.step_size)
+
     print(
         f"\nPost Processing Stage {args.stage} STARTING at PST time: {get_pst_time()}\n"
     )
@@ -164,7 +252,15 @@ def main():
         args.num_files_points,
         args.file_id,
         args.stage,
-        args.ms_standard
+        args.ms_standard,
+        args.workers,
+        args.step_size,
+        args.no_cache,
+        args.refresh_cache,
+        args.nearest_on_server,
+        args.coincidence_channels,
+        args.coincidence_window_ns,
+        args.output_format,
     )
 
     # Done at the beginning and end of main.
@@ -188,7 +284,15 @@ class PostProcessing:
         num_files_points,
         file_id,
         stage,
-        ms_standard
+        ms_standard,
+        workers=1,
+        step_size=None,
+        no_cache=False,
+        refresh_cache=False,
+        nearest_on_server=False,
+        coincidence_channels=None,
+        coincidence_window_ns=COINCIDENCE_WINDOW_NS,
+        output_format="csv",
     ):
 
         self.run_ids = run_ids
@@ -200,11 +304,22 @@ class PostProcessing:
         self.stage = stage
         #self.count_beta_mon_events_offline = count_beta_mon_events_offline
         self.ms_standard = ms_standard
+        self.workers = workers
+        self.step_size = step_size
+        self.root_table_cache = RootTableCache(enabled=not no_cache, refresh=refresh_cache)
+        self.nearest_on_server = nearest_on_server
+        self.coincidence_channels = coincidence_channels
+        self.coincidence_window_ns = coincidence_window_ns
+        self.output_format = output_format
 
         self.analysis_dir = self.get_analysis_dir()
         self.root_files_df_path = self.analysis_dir / Path(f"root_files.csv")
         self.tracks_df_path = self.analysis_dir / Path(f"tracks.csv")
         self.track_points_df_path = self.analysis_dir / Path(f"track_points.csv")
+        if self.output_format == "parquet":
+            # Directories of parquet files partitioned by run_id.
+            self.tracks_df_path = self.analysis_dir / Path(f"tracks")
+            self.track_points_df_path = self.analysis_dir / Path(f"track_points")
 
         print(f"PostProcessing instance attributes:\n")
         for key, value in self.__dict__.items():
@@ -265,7 +380,7 @@ class PostProcessing:
 
             # Check to see if the tracks_i.csv file already exists.
             # If so, then we won't reprocess.
-            tracks_path = self.analysis_dir / Path(f"tracks_{self.file_id}.csv")
+            tracks_path = self.analysis_dir / Path(f"tracks_{self.file_id}.{self.output_format}")
             if tracks_path.is_file():
                 print(
                     f"No processing necessary. tracks csv already processed: {tracks_path}"
@@ -282,7 +397,10 @@ class PostProcessing:
             # Start by opening and reading in the file_df.
             self.root_files_df = self.load_root_files_df()
 
-            self.merge_csvs()
+            if self.output_format == "parquet":
+                self.merge_parquets()
+            else:
+                self.merge_csvs()
             self.sanity_check()
 
         return None
@@ -399,8 +517,20 @@ class PostProcessing:
             raise UserWarning(
                 f"There is no file_id = {self.file_id} in aid = {self.analysis_id}"
             )
-        tracks = self.get_track_data_from_files(root_files_df_chunk)
-        track_points = self.get_track_points_data_from_files(root_files_df_chunk)
+        # Only read the track points if they are going to be written out.
+        write_track_points = self.file_id < self.num_files_points
+
+        # With -step_size the track points are streamed to disk chunk by chunk
+        # instead of being held in memory.
+        stream_track_points = write_track_points and self.step_size is not None
+
+        tracks, track_points = self.get_track_data_from_files(
+            root_files_df_chunk, track_points=write_track_points and not stream_track_points
+        )
+
+        if stream_track_points:
+            # Done before the tracks csv is written since that marks the file_id as processed.
+            self.stream_track_points_to_disk(self.file_id, root_files_df_chunk)
 
         #clean tracks. Add column IsCutPP which is a boolian if it was cut in post processing (here)
         # This trims "barnicles" and bad frequencies
@@ -409,9 +539,9 @@ class PostProcessing:
 
         # Write out tracks to csv for first nft file_ids, and write out points for first ntp
         if self.file_id < self.num_files_tracks:
-            self.write_to_csv(self.file_id, processed_tracks, file_name="tracks")
-        if self.file_id < self.num_files_points:
-            self.write_to_csv(self.file_id, track_points, file_name="track_points")
+            self.write_chunk(self.file_id, processed_tracks, file_name="tracks")
+        if write_track_points and not stream_track_points:
+            self.write_chunk(self.file_id, track_points, file_name="track_points")
 
         print(f"\nProcessing file_id: {self.file_id}")
 
@@ -420,123 +550,86 @@ class PostProcessing:
 
         return None
 
-    def get_track_data_from_files(self, root_files_df):
+    def get_track_data_from_files(self, root_files_df, track_points=True):
 
         condition = root_files_df["root_file_exists"] == True
 
-        experiment_tracks_list = [
-            self.build_bulk_track_params_for_single_file(root_files_df_row)
-            for index, root_files_df_row in root_files_df[condition].iterrows()
-        ]
+        # The files are read in parallel with -workers > 1 but come back in order.
+        file_dfs = parallel_map(
+            partial(build_tracks_for_single_file, track_points=track_points),
+            root_files_df[condition].to_dict("records"),
+            self.workers,
+            initializer=init_process_root_table_cache,
+            initargs=self.root_table_cache.settings(),
+        )
+        experiment_tracks_list = [tracks_df for tracks_df, track_points_df in file_dfs]
+        experiment_track_points_list = [track_points_df for tracks_df, track_points_df in file_dfs]
 
         tracks_df = pd.concat(experiment_tracks_list, axis=0).reset_index(drop=True)
 
-        return tracks_df
-
-    def get_track_points_data_from_files(self, root_files_df):
-
-        condition = root_files_df["root_file_exists"] == True
-
-        experiment_track_points_list = [
-            self.build_track_points_for_single_file(root_files_df_row)
-            for index, root_files_df_row in root_files_df[condition].iterrows()
-        ]
+        if not track_points:
+            return tracks_df, None
 
         track_points_df = pd.concat(experiment_track_points_list, axis=0).reset_index(drop=True)
 
-        return track_points_df
-
+        return tracks_df, track_points_df
 
-    def build_bulk_track_params_for_single_file(self, root_files_df_row):
+    def stream_track_points_to_disk(self, file_id, root_files_df):
         """
-        DOCUMENT.
+        Writes the track points of all the files out in chunks of -step_size
+        entries so that peak memory is set by the step size, not the file size.
+        With -output_format parquet each chunk is a row group of one file.
         """
+        print(f"Streaming track_points data to disk for file_id {file_id}.")
+        write_path = self.analysis_dir / Path(f"track_points_{file_id}.{self.output_format}")
 
-        tracks_df = pd.DataFrame()
-
-        rootfile = uproot.open(root_files_df_row["root_file_path"])
-        #If present, use MBEB TTree
-        if "MB-events;1" in rootfile.keys():
-            tracks_root = rootfile["MB-events;1"]["MultiBandEvent"]["fTracks"]
-            cols = {}
-            for key, branch in tracks_root.items():
-                # Skip object/pointer branches that trigger the “arbitrary pointer” error
-                if branch.interpretation.__class__.__name__ == "AsObjects":
-                    continue
-
-                tracks_df[key[9:]] = self.flat(branch.array())
-
-            if cols:
-                tracks_df = pd.DataFrame(cols)
-        #If not present, get tracks from tracks TTree
-        elif "tracks;1" in rootfile.keys():
-            tracks_root = rootfile["tracks;1"]["Track"]
-            print(list(tracks_root.keys()))
-            cols = {}
-            for key, branch in tracks_root.items():
-                if str(key).startswith('fPoints'):
-                    continue
-                # Skip object/pointer branches that trigger the “arbitrary pointer” error
-                if branch.interpretation.__class__.__name__ == "AsObjects":
-                    continue
-
-                tracks_df[key[1:]] = self.flat(branch.array())
-
-            if cols:
-                tracks_df = pd.DataFrame(cols)
-
-        tracks_df["run_id"] = root_files_df_row["run_id"]
-        tracks_df["file_id"] = root_files_df_row["file_id"]
-        tracks_df["root_file_path"] = root_files_df_row["root_file_path"]
-        tracks_df["field"] = root_files_df_row["field"]
-        tracks_df["true_voltage"] = root_files_df_row["voltage"]
-        tracks_df["arduino_monitor_rate"] = root_files_df_row["arduino_monitor_rate"]
-        tracks_df["nitrogen"] = root_files_df_row["nitrogen"]
-        tracks_df["helium"] = root_files_df_row["helium"]
-        tracks_df["hydrogen"] = root_files_df_row["hydrogen"]
-        tracks_df["water"] = root_files_df_row["water"]
-        tracks_df["a19"] = root_files_df_row["a19"]
-        tracks_df["total"] = root_files_df_row["total"]
-        tracks_df["A_temp"] = root_files_df_row["A"]
-        tracks_df["B_temp"] = root_files_df_row["B"]
-        tracks_df["C_temp"] = root_files_df_row["C"]
-        tracks_df["D_temp"] = root_files_df_row["D"]
-        tracks_df["E_temp"] = root_files_df_row["E"]
-        tracks_df["F_temp"] = root_files_df_row["F"]
-        tracks_df["G_temp"] = root_files_df_row["G"]
-        tracks_df["H_temp"] = root_files_df_row["H"]
-
-        return tracks_df.reset_index(drop=True)
-
-    def build_track_points_for_single_file(self, root_files_df_row):
-        """
-        DOCUMENT.
-        """
-
-        track_points_df = pd.DataFrame()
-
-        rootfile = uproot.open(root_files_df_row["root_file_path"])
-
-        if "tracks;1" in rootfile.keys():
-            track_points_root = rootfile["tracks;1"]["Track"]["fPoints"]
-            cols = {}
-            for key, branch in track_points_root.items():
-                # Skip object/pointer branches that trigger the “arbitrary pointer” error
-                if branch.interpretation.__class__.__name__ == "AsObjects":
-                    continue
-
-                track_points_df[key[9:]] = self.flat(branch.array())
+        condition = root_files_df["root_file_exists"] == True
 
-            if cols:
-                track_points_df = pd.DataFrame(cols)
+        columns = None
+        parquet_writer = None
+        n_written = 0
+        for index, root_files_df_row in root_files_df[condition].iterrows():
+            with KatydidRootFile(root_files_df_row["root_file_path"]) as root_file:
+                for track_points_df in root_file.iter_track_points(self.step_size):
 
-        track_points_df["run_id"] = root_files_df_row["run_id"]
-        track_points_df["file_id"] = root_files_df_row["file_id"]
-        track_points_df["root_file_path"] = root_files_df_row["root_file_path"]
-        track_points_df["field"] = root_files_df_row["field"]
-        track_points_df["arduino_monitor_rate"] = root_files_df_row["arduino_monitor_rate"]
+                    track_points_df = build_track_points_for_single_file(
+                        root_files_df_row, track_points_df
+                    )
+                    track_points_df.index += n_written
+
+                    # Keep the columns of the first chunk so the appended rows line up.
+                    if columns is None:
+                        columns = track_points_df.columns
+                    else:
+                        track_points_df = track_points_df.reindex(columns=columns)
+
+                    if self.output_format == "parquet":
+                        if parquet_writer is None:
+                            table = pa.Table.from_pandas(track_points_df, preserve_index=False)
+                            parquet_writer = pq.ParquetWriter(
+                                write_path, table.schema, compression=PARQUET_COMPRESSION
+                            )
+                        else:
+                            table = pa.Table.from_pandas(
+                                track_points_df, schema=parquet_writer.schema, preserve_index=False
+                            )
+                        parquet_writer.write_table(table)
+                    elif n_written == 0:
+                        track_points_df.to_csv(write_path)
+                    else:
+                        track_points_df.to_csv(write_path, mode="a", header=False)
+                    n_written += len(track_points_df)
+
+        if parquet_writer is not None:
+            parquet_writer.close()
+        elif columns is None and self.output_format == "parquet":
+            pd.DataFrame().to_parquet(write_path, index=False)
+        elif columns is None:
+            pd.DataFrame().to_csv(write_path)
+
+        print(f"Wrote {n_written} track points to {write_path}")
 
-        return track_points_df.reset_index(drop=True)
+        return None
 
     def clean_up_tracks(
         self, tracks, cols=["TimeIntc", "TimeLength", "Slope"], cut_levels=[2, 2, 2]
@@ -575,416 +668,83 @@ class PostProcessing:
     def add_env_data(self, root_files_df):
         print("adding environmental data!")
         # Step 0: Make sure the root_files_df has a tz aware dt column.
-        root_files_df["pst_time"] = root_files_df["root_file_path"].apply(
-            lambda x: self.get_pst_time(x)
-        )
+        root_files_df["pst_time"] = root_file_times(root_files_df["root_file_path"])
         root_files_df["pst_time"] = root_files_df["pst_time"].dt.tz_localize(
             "US/Pacific"
         )
         root_files_df["utc_time"] = root_files_df["pst_time"].dt.tz_convert("UTC")
 
-        # Step 1: Add the monitor rate/field data to each file.
-        root_files_df = self.add_field(root_files_df)
-
-        # Beta monitor not working for Kr DON'T ADD BETA MONITOR!
-        # root_files_df["arduino_monitor_rate"] = 1
-        
-        root_files_df = self.add_arduino_monitor_rate(root_files_df)
+        # Step 1: Fetch the slow control logs at the same time, then add the monitor rate/field data to each file.
+        logs = fetch_env_logs(
+            root_files_df,
+            ENV_TABLES,
+            nearest_on_server=self.nearest_on_server,
+        )
         '''
         if self.count_beta_mon_events_offline:
             root_files_df = self.add_offline_monitor_counts(root_files_df)
         '''
-        root_files_df = self.add_pressures(root_files_df)
-        root_files_df = self.add_temps(root_files_df)
-        root_files_df = self.add_voltage(root_files_df)
-
-        # Step 3. Add the set_field by rounding to nearest 100th place.
-        root_files_df["set_field"] = root_files_df["field"].round(decimals=2)
-
-        return root_files_df
-
-    def get_pst_time(self, root_file_path):
-        # USED in add_env_data()
-        # Makes a naive datetime object from the root file name. Note that the ms padding is very important!
-        if self.ms_standard:
-            #print("User specified run_ids are all in ms standard.")
-            # root file name is in local PST!
-            time_str = root_file_path[-32:-9]
-            time_str_padded = time_str + "000"  # Pad with zeros to get microseconds
-            datetime_object = datetime.datetime.strptime(time_str_padded, "%Y-%m-%d-%H-%M-%S-%f")
-
-        else:
-            print("User specified run_ids are all in second standard.")
-            time_str = root_file_path[-28:-9]
-            datetime_object = datetime.datetime.strptime(time_str, "%Y-%m-%d-%H-%M-%S")
+        # Step 2: Add the field, monitor rate, pressures, temps, voltage and set_field.
+        return add_env_logs(root_files_df, logs)
 
-        return datetime_object
-
-    def get_nearest(self, df, dt):
-        # USED in add_env_data()
-        # created_at column is the dt column.
-        minidx = (dt - df["created_at"]).abs().idxmin()
-
-        return df.loc[[minidx]].iloc[0]
-
-    def add_arduino_monitor_rate(self, root_files_df):
-        # USED in add_env_data()
-        root_files_df["arduino_monitor_rate"] = np.nan
-
-        # Step 0. Group by run_id.
-        for rid, root_files_df_gb in root_files_df.groupby(["run_id"]):
-
-            # Step 1. Find the extreme times present in the given run_id.
-            # The idea is that we want to be careful about the amount of queries we do to get this info.
-            # Here we only do one query per run_id (instead of one per file)
-
-            dt_max = root_files_df_gb.utc_time.max().floor("min").tz_localize(None)
-            dt_min = root_files_df_gb.utc_time.min().floor("min").tz_localize(None)
-
-            # There is an issue here right now but this will be useful later.
-            query = """SELECT m.monitor_id, m.created_at, m.rate
-                       FROM he6cres_runs.monitor as m 
-                       WHERE m.created_at >= '{}'::timestamp
-                           AND m.created_at <= '{}'::timestamp + interval '1 minute'
-                    """.format(
-                dt_min, dt_max
-            )
-
-            monitor_log = he6cres_db_query(query)
-            monitor_log["created_at"] = monitor_log["created_at"].dt.tz_localize("UTC")
-
-            for fid, file_path in root_files_df_gb.groupby(["file_id"]):
-
-                if len(file_path) != 1:
-                    raise UserWarning(
-                        f"There should be only one file with run_id = {rid} and file_id = {fid}."
-                    )
-
-                # Get arduino_monitor_rate during run.
-                arduino_monitor_rate = self.get_nearest(
-                    monitor_log, file_path.utc_time.iloc[0]
-                ).rate
-
-                condition = (root_files_df["run_id"] == rid) & (
-                    root_files_df["file_id"] == fid
-                )
-                root_files_df.loc[condition, "arduino_monitor_rate"] = arduino_monitor_rate
-
-        if root_files_df["arduino_monitor_rate"].isnull().values.any():
-            raise UserWarning(f"Some arduino_monitor_rate data was not collected.")
-
-        return root_files_df
+    def add_arduino_monitor_rate(self, root_files_df, monitor_log=None):
+        # USED in add_env_data() (see env_utility.add_env_logs)
+        return add_arduino_monitor_rate(root_files_df, monitor_log)
 
     def add_offline_monitor_counts(self, root_files_df):
-        # For now works with just the trigger channel (CH0)
-        # Does not computer offline coincidence!
+        # Counts the trigger channel (CH0), or with coincidence_channels the
+        # offline coincidences between those channels (see coincidence_times).
         # 10/09/2025 Checked for timestamp consistency. All clear! 
         # USED in add_env_data()
-        root_files_df["offline_monitor_counts"] = np.nan
-
-        # Step 0. Group by run_id.
-        for rid, root_files_df_gb in root_files_df.groupby(["run_id"]):
-            print(f"Finding offline beta monitor rate for files in rid {rid}")
-            # Step 1. Find the ealiest UTC time present in the given run_id.
-            dt_min = root_files_df_gb.utc_time.min().floor("min").tz_localize(None)
-
-            # Get runname in caen_runs table  most recent to earliest time in run_id. logged_at also UTC
-
-            query = """SELECT cr.caen_run_id, cr.runname, cr.logged_at
-                        FROM he6cres_runs.caen_runs AS cr
-                        ORDER BY ABS(EXTRACT(EPOCH FROM (cr.logged_at - '{}'::timestamp))) ASC
-                        LIMIT 1
-                    """.format(dt_min)
-
-            caen_log = he6cres_db_query(query)
-            if caen_log.empty:
-                raise UserWarning("No matching caen_run found in the database.")
-            else:
-                caen_run_path = Path(caen_log['runname'].iloc[0])
-                print("caen run path:", caen_run_path)
-
-                # Build path to run.info on rocks
-                rocks_caen_run_info_path = Path('/data/raid2/eliza4/he6_cres/betamon/caen') / caen_run_path.name / Path('run.info')
-
-                # Read in run.info and extract time.start
-                time_start = None
-                if rocks_caen_run_info_path.exists():
-                    with rocks_caen_run_info_path.open('r') as f:
-                        for line in f:
-                            if line.startswith('time.start='):
-                                time_start = line.split('=')[1].strip()
-                                break
-                # Define the format of the input string
-                time_format = "%Y/%m/%d %H:%M:%S.%f%z"
-
-                # Convert to a datetime object. includes the parsed time and timezone offset for PST
-                dt = datetime.datetime.strptime(time_start, time_format)
-                # Convert to UTC
-                dt_utc = dt.astimezone(datetime.timezone.utc)
-                # Convert to numpy.datetime64
-                caen_run_time_start = np.datetime64(dt_utc)
-
-                # Build path to compass data csv on rocks
-                rocks_caen_run_data_path = Path('/data/raid2/eliza4/he6_cres/betamon/caen') / caen_run_path.name / Path(f'RAW/DataR_CH0@DT5725_1146_{caen_run_path.name}.csv')
-                # Read in the compass data csv to caen_df
-                caen_df = pd.read_csv(rocks_caen_run_data_path, index_col=0, sep=';')
-
-                #add a naive cut above the 511s? At ADC 4000
-                caen_df = caen_df[caen_df['ENERGY']>4000]
-
-                # Add new column to caen_df for absolute UTC timestamp for each hit
-                # Convert TIMETAG from picoseconds to nanoseconds
-                caen_df['TIMETAG_ns'] = caen_df['TIMETAG'] / 1_000
-                # Use 'ns' as the unit
-                caen_df['TIMETAG_abs'] = caen_run_time_start + pd.to_timedelta(caen_df['TIMETAG_ns'], unit='ns')
-                caen_df['TIMETAG_abs'] = caen_df['TIMETAG_abs'].dt.tz_localize("UTC")
-                # print(caen_df)
-
-                condition = (root_files_df["run_id"] == rid)
-                # Apply the monitor event counting function to each row (ie each 1s CRES file) in this run_id
-                root_files_df.loc[condition, 'offline_monitor_counts'] = root_files_df_gb.apply(self.count_events, caen_df=caen_df, axis=1)
-
-        return root_files_df
-
-    # Define a function to count events for each row in df_A
-    def count_events(self, row, caen_df):
-        # 10/09/2025 Checked for timestamp consistency. All clear! 
-        end_time = row['utc_time'] #spec(k) file name is immediatly after write time, not before
-        start_time = end_time - pd.Timedelta(seconds=1)
-        #print("start time: ", start_time, " end time: ", end_time)
-        #Works fine to compare datetime and np.datetime64 objects!
-        #print(caen_df[(caen_df['TIMETAG_abs'] > start_time) & (caen_df['TIMETAG_abs'] < end_time)])
-        return caen_df[(caen_df['TIMETAG_abs'] > start_time) & (caen_df['TIMETAG_abs'] < end_time)].shape[0]
-
-    def count_events_efficient(self, row, caen_df):
-        # Ensure TIMETAG_abs is a NumPy datetime64 array
-        timetag_values = caen_df['TIMETAG_abs'].to_numpy()
-
-        # Convert start_time and end_time to NumPy datetime64
-        start_time = np.datetime64(row['utc_time'])
-        end_time = start_time + np.timedelta64(1, 's')  # Add 1 second
-        print("start time: ", start_time, " end time: ", end_time)
-        # Use searchsorted to find the indices
-        start_idx = np.searchsorted(timetag_values, start_time, side='left')
-        end_idx = np.searchsorted(timetag_values, end_time, side='right')
-        print(timetag_values[start_idx])
-        print(timetag_values[end_idx])
-        # Return the count of events within the range
-        return end_idx - start_idx        
-
-    def add_field(self, root_files_df):
-
-        root_files_df["field"] = np.nan
-
-        # Step 0. Group by run_id.
-        for rid, root_files_df_gb in root_files_df.groupby(["run_id"]):
-
-            # Step 1. Find the extreme times present in the given run_id.
-            # The idea is that we want to be careful about the amount of queries we do to get this info.
-            # Here we only do one query per run_id (instead of one per file)
-            dt_max = root_files_df_gb.utc_time.max().floor("min").tz_localize(None)
-            dt_min = root_files_df_gb.utc_time.min().floor("min").tz_localize(None)
-
-            # Note that I also need to make sure the field probe was locked!
-            query = """SELECT n.nmr_id, n.created_at, n.field
-                       FROM he6cres_runs.nmr as n 
-                       WHERE n.created_at >= '{}'::timestamp
-                           AND n.created_at <= '{}'::timestamp + interval '1 minute'
-                           AND n.locked = TRUE
-                    """.format(
-                dt_min, dt_max
-            )
-            #print(query)
-            field_log = he6cres_db_query(query)
-            if field_log.empty:
-                field_log["created_at"] = np.nan
-            else:    
-                field_log["created_at"] = field_log["created_at"].dt.tz_localize("UTC")
-
-                for fid, file_path in root_files_df_gb.groupby(["file_id"]):
-
-                    if len(file_path) != 1:
-                        raise UserWarning(
-                            f"There should be only one file with run_id = {rid} and file_id = {fid}."
-                        )
-
-                    # Get field during second of data
-                    field = self.get_nearest(field_log, file_path.utc_time.iloc[0]).field
-
-                    # Now get the nearest rate for each file_id and fill those in!! Then this gets joined with the whole table.
-                    condition = (root_files_df["run_id"] == rid) & (
-                        root_files_df["file_id"] == fid
-                    )
-                    root_files_df["field"][condition] = field
-
-        if root_files_df["field"].isnull().values.any():
-            #raise UserWarning(f"Some rate data was not collected.")
-            print("Some nmr data was not collected.")
-
-        return root_files_df
-
-    def add_pressures(self, root_files_df):
-        # Define the list of gases
-        gases = [
-            "nitrogen", "helium", "co2", "hydrogen", 
-            "water", "oxygen", "krypton", "argon", 
-            "cf3", "a19", "total"
-        ]
-
-        # Initialize the columns for each gas with NaN
-        root_files_df = root_files_df.assign(**{gas: np.nan for gas in gases})
-
-
-        # Step 0. Group by run_id.
-        for rid, root_files_df_gb in root_files_df.groupby(["run_id"]):
-
-            # Step 1. Find the extreme times present in the given run_id.
-            # The idea is that we want to be careful about the amount of queries we do to get this info.
-            # Here we only do one query per run_id (instead of one per file)
-            dt_max = root_files_df_gb.utc_time.max().floor("min").tz_localize(None)
-            dt_min = root_files_df_gb.utc_time.min().floor("min").tz_localize(None)
-
-            # Note that I also need to make sure the field probe was locked!
-            query = """SELECT r.utc_write_time, r.nitrogen, r.helium, r.co2, r.hydrogen, r.water, r.oxygen, r.krypton, r.argon, r.cf3, r.a19, r.total
-                       FROM he6cres_runs.rga as r 
-                       WHERE r.utc_write_time >= '{}'::timestamp
-                           AND r.utc_write_time <= '{}'::timestamp + interval '1 minute'
-                           AND r.time_since_write < 60.0
-                    """.format(
-                dt_min, dt_max
-            )
-            #print(query)
-            rga_log = he6cres_db_query(query)
-            if rga_log.empty:
-                rga_log["created_at"] = np.nan
-            else:    
-                # This is NOT the same as the created_at field in the db, I'm re-naming the more accurate utc_write_time
-                # to created_at for consistancy in get_nearest()
-                rga_log["created_at"] = rga_log["utc_write_time"].dt.tz_localize("UTC")
-
-                for fid, file_path in root_files_df_gb.groupby(["file_id"]):
-
-                    if len(file_path) != 1:
-                        raise UserWarning(
-                            f"There should be only one file with run_id = {rid} and file_id = {fid}."
-                        )
-
-                    nearest_row = self.get_nearest(rga_log, file_path.utc_time.iloc[0])
-                    # Assign values for all gases at once
-                    condition = (root_files_df["run_id"] == rid) & (root_files_df["file_id"] == fid)
-                    root_files_df.loc[condition, gases] = nearest_row[gases].values
-
+        # Each file is counted in every CAEN run that overlaps its second, found
+        # in the CAEN run index (see offline_monitor_counts).
+        root_files_df["offline_monitor_counts"] = offline_monitor_counts(
+            root_files_df["utc_time"],
+            channel=0,
+            # Naive cut above the 511s at ADC 4000.
+            min_energy=4000,
+            coincidence_channels=self.coincidence_channels,
+            coincidence_window_ns=self.coincidence_window_ns,
+        )
 
-        if root_files_df["total"].isnull().values.any():
-            print("Some rga data was not collected.")
+        if root_files_df["offline_monitor_counts"].isnull().values.any():
+            print("Some files are outside of all the CAEN runs, no offline monitor counts.")
 
         return root_files_df
 
-    def add_temps(self, root_files_df):
-        # Define the list of endpoints
-        epts = [7,8,9,10,11,12,13,14]
-        sensor_names = ['A','B','C','D','E','F','G','H']
-
-        # Initialize the columns for each endpoint with NaN
-        root_files_df = root_files_df.assign(**{sensor: np.nan for sensor in sensor_names})
-
-        # Step 0. Group by run_id.
-        for rid, root_files_df_gb in root_files_df.groupby(["run_id"]):
-
-            # Step 1. Find the extreme times present in the given run_id.
-            # The idea is that we want to be careful about the amount of queries we do to get this info.
-            # Here we only do one query per run_id (instead of one per file)
-            dt_max = root_files_df_gb.utc_time.max().floor("min").tz_localize(None)
-            dt_min = root_files_df_gb.utc_time.min().floor("min").tz_localize(None)
-
-            # 
-            query = """SELECT e.endpoint_id, e.timestamp, e.value_raw
-                       FROM public.endpoint_numeric_data as e
-                       WHERE e.timestamp >= '{}'::timestamp
-                           AND e.timestamp <= '{}'::timestamp + interval '1 minute'
-                    """.format(
-                dt_min, dt_max
-            )
-            #print(query)
-            rga_log = he6cres_db_query(query)
-
-            if not rga_log.empty:
-                rga_log["created_at"] = rga_log["timestamp"].dt.tz_localize("UTC")
-
-                # Filter and group `rga_log` by `endpoint_id` once
-                rga_log_grouped = {ept: grp for ept, grp in rga_log.groupby("endpoint_id")}
-
-                for fid, file_path in root_files_df_gb.groupby("file_id"):
-                    if len(file_path) != 1:
-                        raise UserWarning(f"There should be only one file with run_id = {rid} and file_id = {fid}.")
-
-                    file_time = file_path.utc_time.iloc[0]
-
-                    # Iterate over the endpoints and assign temperatures
-                    for i, ept in enumerate(epts):
-                        rga_log_ept = rga_log_grouped.get(ept)
-                        if rga_log_ept is not None:
-                            temp_value = self.get_nearest(rga_log_ept, file_time)["value_raw"]
+    def add_field(self, root_files_df, field_log=None):
+        return add_field(root_files_df, field_log)
 
-                            # Apply the value to the relevant rows
-                            condition = (root_files_df["run_id"] == rid) & (root_files_df["file_id"] == fid)
-                            root_files_df.loc[condition, sensor_names[i]] = temp_value
+    def add_pressures(self, root_files_df, rga_log=None):
+        return add_pressures(root_files_df, rga_log)
 
-        # Check for missing data
-        if root_files_df[sensor_names].isnull().any().any():
-            print("Some temp data was not collected.")
+    def add_temps(self, root_files_df, temp_log=None):
+        return add_temps(root_files_df, temp_log)
 
-        return root_files_df
-
-    def add_voltage(self, root_files_df):
-
-        root_files_df["voltage"] = np.nan
+    def add_voltage(self, root_files_df, voltage_log=None):
+        return add_voltage(root_files_df, voltage_log)
 
-        # Step 0. Group by run_id.
-        for rid, root_files_df_gb in root_files_df.groupby(["run_id"]):
+    def write_chunk(self, file_id, df_chunk, file_name):
+        if self.output_format == "parquet":
+            self.write_to_parquet(file_id, df_chunk, file_name)
+        else:
+            self.write_to_csv(file_id, df_chunk, file_name)
 
-            # Step 1. Find the extreme times present in the given run_id.
-            # The idea is that we want to be careful about the amount of queries we do to get this info.
-            # Here we only do one query per run_id (instead of one per file)
-            dt_max = root_files_df_gb.utc_time.max().floor("min").tz_localize(None)
-            dt_min = root_files_df_gb.utc_time.min().floor("min").tz_localize(None)
+        return None
 
-            query = """SELECT n.dmm_id, n.utc_write_time, n.voltage
-                       FROM he6cres_runs.dmm as n 
-                       WHERE n.utc_write_time >= '{}'::timestamp
-                           AND n.utc_write_time <= '{}'::timestamp + interval '1 minute'
-                    """.format(
-                dt_min, dt_max
-            )
-            print(query)
-            voltage_log = he6cres_db_query(query)
-            # This is NOT the same as the created_at field in the db, I'm re-naming the more accurate utc_write_time
-            # to created_at for consistancy in get_nearest()
-            if voltage_log.empty:
-                voltage_log["created_at"] = np.nan
-            else:    
-                voltage_log["created_at"] = voltage_log["utc_write_time"].dt.tz_localize("UTC")
-
-                for fid, file_path in root_files_df_gb.groupby(["file_id"]):
-
-                    if len(file_path) != 1:
-                        raise UserWarning(
-                            f"There should be only one file with run_id = {rid} and file_id = {fid}."
-                        )
-
-                    # Get voltage during second of data
-                    voltage = self.get_nearest(voltage_log, file_path.utc_time.iloc[0]).voltage
-
-                    # Now get the nearest voltage for each file_id and fill those in!! Then this gets joined with the whole table.
-                    condition = (root_files_df["run_id"] == rid) & (
-                        root_files_df["file_id"] == fid
-                    )
-                    root_files_df.loc[condition, "voltage"] = voltage
+    def write_to_parquet(self, file_id, df_chunk, file_name):
+        print(f"Writing {file_name} data to disk (parquet) for file_id {file_id}.")
+        write_path = self.analysis_dir / Path(f"{file_name}_{file_id}.parquet")
 
-        if root_files_df["voltage"].isnull().values.any():
-            print("Some voltage data was not collected.")
+        # Atomic since the tracks file marks the file_id as processed.
+        write_atomic(
+            write_path,
+            lambda tmp_path: df_chunk.to_parquet(
+                tmp_path, compression=PARQUET_COMPRESSION, index=False
+            ),
+        )
 
-        return root_files_df
+        return None
 
     def write_to_csv(self, file_id, df_chunk, file_name):
         print(f"Writing {file_name} data to disk for file_id {file_id}.")
@@ -1058,6 +818,40 @@ class PostProcessing:
 
         return None
 
+    def merge_parquets(self):
+
+        self.merge_parquet_chunks("tracks", self.num_files_tracks, self.tracks_df_path)
+        self.merge_parquet_chunks("track_points", self.num_files_points, self.track_points_df_path)
+
+        return None
+
+    def merge_parquet_chunks(self, file_name, num_files, dataset_path):
+        chunk_path_list = [
+            self.analysis_dir / Path(f"{file_name}_{i}.parquet") for i in range(num_files)
+        ]
+
+        if not all(path.is_file() for path in chunk_path_list):
+            print(f"Not all {num_files} {file_name} parquets are present for merging.")
+
+        # Filter the list to include only the paths that exist
+        chunk_path_list = [path for path in chunk_path_list if path.is_file()]
+
+        dfs = [pd.read_parquet(chunk_path) for chunk_path in chunk_path_list]
+        df = pd.concat(dfs, ignore_index=True)
+        lens = [len(chunk_df) for chunk_df in dfs]
+        print(f"\nCombining set of {file_name} dfs.\n")
+        print("lengths: ", lens)
+        print("sum: ", sum(lens))
+        print("len single dataset (sanity check): ", len(df))
+        print(f"{file_name} cols: ", df.columns)
+
+        write_parquet_dataset(df, dataset_path, partition_cols=["run_id"])
+
+        for chunk_path in chunk_path_list:
+            chunk_path.unlink()
+
+        return None
+
     def sanity_check(self):
 
         desired_path_list = [
@@ -1065,7 +859,9 @@ class PostProcessing:
             self.tracks_df_path,
             self.track_points_df_path,
         ]
-        real_path_list = self.analysis_dir.glob("*.csv")
+        real_path_list = list(self.analysis_dir.glob("*.csv")) + list(
+            self.analysis_dir.glob("*.parquet")
+        )
         remove_list = list(set(real_path_list) - set(desired_path_list))
 
         if len(remove_list) == 0:
@@ -1084,23 +880,6 @@ class PostProcessing:
 
         return None
 
-    def flat(self, jaggedarray) -> np.ndarray:
-        """
-        Given jagged array (common in root), it returns a flattened array.
-
-        Args:
-            jaggedarray (awkward array): No specifications.
-
-        Returns:
-            array (np.ndarray): No specifications.
-
-        """
-        flatarray = np.array([])
-        for a in jaggedarray.tolist():
-            flatarray = np.append(flatarray, a)
-
-        return flatarray
-
     def get_slope(self, true_field, frequency: float = 19.15e9):
 
         approx_power = sc.power_larmor(true_field, frequency)
@@ -1110,5 +889,74 @@ class PostProcessing:
         return approx_slope
 
 
+def build_tracks_for_single_file(root_files_df_row, track_points=True):
+    """
+    Opens the root file once and returns its tracks and (if track_points)
+    its track points, both with the per-file info attached. The raw tables
+    come from the root table cache of the process. Module level so that the
+    -workers pool only pickles the root_files_df row (dict).
+    """
+    root_file_path = root_files_df_row["root_file_path"]
+    tables = ["tracks", "track_points"] if track_points else ["tracks"]
+
+    def read_root_file():
+        with KatydidRootFile(root_file_path) as root_file:
+            tracks_df, track_points_df = root_file.read(track_points=track_points)
+        return {"tracks": tracks_df, "track_points": track_points_df}
+
+    # The raw tables are cached, before any of the per-file info is attached.
+    dfs = process_root_table_cache().load_tables(root_file_path, tables, read_root_file)
+    tracks_df, track_points_df = dfs["tracks"], dfs.get("track_points")
+
+    tracks_df = build_bulk_track_params_for_single_file(root_files_df_row, tracks_df)
+    if track_points:
+        track_points_df = build_track_points_for_single_file(root_files_df_row, track_points_df)
+
+    return tracks_df, track_points_df
+
+
+def build_bulk_track_params_for_single_file(root_files_df_row, tracks_df):
+    """
+    Attaches the per-file info (env data etc.) to the bulk track parameters.
+    """
+
+    tracks_df["run_id"] = root_files_df_row["run_id"]
+    tracks_df["file_id"] = root_files_df_row["file_id"]
+    tracks_df["root_file_path"] = root_files_df_row["root_file_path"]
+    tracks_df["field"] = root_files_df_row["field"]
+    tracks_df["true_voltage"] = root_files_df_row["voltage"]
+    tracks_df["arduino_monitor_rate"] = root_files_df_row["arduino_monitor_rate"]
+    tracks_df["nitrogen"] = root_files_df_row["nitrogen"]
+    tracks_df["helium"] = root_files_df_row["helium"]
+    tracks_df["hydrogen"] = root_files_df_row["hydrogen"]
+    tracks_df["water"] = root_files_df_row["water"]
+    tracks_df["a19"] = root_files_df_row["a19"]
+    tracks_df["total"] = root_files_df_row["total"]
+    tracks_df["A_temp"] = root_files_df_row["A"]
+    tracks_df["B_temp"] = root_files_df_row["B"]
+    tracks_df["C_temp"] = root_files_df_row["C"]
+    tracks_df["D_temp"] = root_files_df_row["D"]
+    tracks_df["E_temp"] = root_files_df_row["E"]
+    tracks_df["F_temp"] = root_files_df_row["F"]
+    tracks_df["G_temp"] = root_files_df_row["G"]
+    tracks_df["H_temp"] = root_files_df_row["H"]
+
+    return tracks_df.reset_index(drop=True)
+
+
+def build_track_points_for_single_file(root_files_df_row, track_points_df):
+    """
+    Attaches the per-file info to the track points.
+    """
+
+    track_points_df["run_id"] = root_files_df_row["run_id"]
+    track_points_df["file_id"] = root_files_df_row["file_id"]
+    track_points_df["root_file_path"] = root_files_df_row["root_file_path"]
+    track_points_df["field"] = root_files_df_row["field"]
+    track_points_df["arduino_monitor_rate"] = root_files_df_row["arduino_monitor_rate"]
+
+    return track_points_df.reset_index(drop=True)
+
+
 if __name__ == "__main__":
     main()
@@ -8,7 +8,6 @@ import pandas as pd
 import pandas.io.sql as psql
 
 import pytz
-import numpy as np
 import datetime
 from glob import glob
 import subprocess as sp
@@ -21,10 +20,6 @@ from typing import List
 
 from pathlib import Path
 import yaml
-import uproot
-
-import numpy as np
-
 
 # Local imports.
 from rocks_utility import (
@@ -33,6 +28,7 @@ from rocks_utility import (
     check_if_exists,
     log_file_break,
 )
+from root_utility import KatydidRootFile
 
 # Import options.
 pd.set_option("display.max_columns", 100)
@@ -272,22 +268,10 @@ class PostProcessing:
         DOCUMENT.
         """
 
-        tracks_df = pd.DataFrame()
-
-        rootfile = uproot.open(root_files_df_row["root_file_path"])
-
-        if "MB-events;1" in rootfile.keys():
-            tracks_root = rootfile["MB-events;1"]["MultiBandEvent"]["fTracks"]
-            cols = {}
-            for key, branch in tracks_root.items():
-                # Skip object/pointer branches that trigger the “arbitrary pointer” error
-                if branch.interpretation.__class__.__name__ == "AsObjects":
-                    continue
-
-                tracks_df[key[9:]] = self.flat(branch.array())
-
-            if cols:
-                tracks_df = pd.DataFrame(cols)
+        with KatydidRootFile(
+            root_files_df_row["root_file_path"], tree_types=("MB-events",)
+        ) as root_file:
+            tracks_df = root_file.tracks()
 
         tracks_df["run_name"] = root_files_df_row["run_name"]
         tracks_df["file_id"] = root_files_df_row["file_id"]
@@ -301,22 +285,8 @@ class PostProcessing:
         DOCUMENT.
         """
 
-        track_points_df = pd.DataFrame()
-
-        rootfile = uproot.open(root_files_df_row["root_file_path"])
-
-        if "tracks;1" in rootfile.keys():
-            track_points_root = rootfile["tracks;1"]["Track"]["fPoints"]
-            cols = {}
-            for key, branch in track_points_root.items():
-                # Skip object/pointer branches that trigger the “arbitrary pointer” error
-                if branch.interpretation.__class__.__name__ == "AsObjects":
-                    continue
-
-                track_points_df[key[9:]] = self.flat(branch.array())
-
-            if cols:
-                track_points_df = pd.DataFrame(cols)
+        with KatydidRootFile(root_files_df_row["root_file_path"]) as root_file:
+            track_points_df = root_file.track_points()
 
         track_points_df["run_name"] = root_files_df_row["run_name"]
         track_points_df["file_id"] = root_files_df_row["file_id"]
@@ -350,15 +320,5 @@ class PostProcessing:
 
         return None
 
-    def flat(self, jaggedarray) -> np.ndarray:
-        """
-        Given jagged array (common in root), it returns a flattened array.
-        """
-        flatarray = np.array([])
-        for a in jaggedarray.tolist():
-            flatarray = np.append(flatarray, a)
-
-        return flatarray
-
 if __name__ == "__main__":
     main()
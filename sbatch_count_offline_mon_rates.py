@@ -4,6 +4,7 @@ Submit a SLURM array job to add environment data and count offline beta monitor
 
 Usage:
   sbatch_count_offline_mon_rates.py -rids 1748 1749 ... -aid 13
+  sbatch_count_offline_mon_rates.py -rids 1748 1749 ... -aid 13 -runs_per_job 10 -workers 4
 """
 
 import subprocess as sp
@@ -20,6 +21,10 @@ def main():
     arg("-t", "--tlim", nargs=1, type=str, help="set time limit (HH:MM:SS)")
     arg("-rids", "--runids", nargs="+", type=int, help="run ids to analyze")
     arg("-aid", "--analysis_id", type=int, default=-1, help="analysis_id")
+    arg("-coincidence_channels", "--coincidence-channels", nargs="+", type=int, help="count coincidences between these CAEN channels")
+    arg("-coincidence_window_ns", "--coincidence-window-ns", type=int, help="coincidence window (ns)")
+    arg("-runs_per_job", "--runs-per-job", type=int, default=1, help="run ids handled together by each job")
+    arg("-workers", "--workers", type=int, default=1, help="worker threads (and cpus requested) per job")
 
     args = par.parse_args()
 
@@ -35,16 +40,24 @@ def main():
         "/bin/bash -c $'umask 002; source /data/raid2/eliza4/he6_cres/.bashrc {} "
     ).format(r"\n")
 
-    for run_id in args.runids:
+    runs_per_job = max(1, args.runs_per_job)
+    for first in range(0, len(args.runids), runs_per_job):
+        run_ids = args.runids[first:first + runs_per_job]
+        rids_formatted = " ".join(str(rid) for rid in run_ids)
         count_cmd = (
                 f"/opt/python3.7/bin/python3.7 -u /data/raid2/eliza4/he6_cres/rocks_analysis_pipeline/count_offline_mon_rates.py "
-            f"-rid {run_id} -aid {analysis_id}"
+            f"-rids {rids_formatted} -aid {analysis_id} -workers {args.workers}"
         )
+        if args.coincidence_channels:
+            count_cmd += " -coincidence_channels " + " ".join(str(ch) for ch in args.coincidence_channels)
+        if args.coincidence_window_ns is not None:
+            count_cmd += f" -coincidence_window_ns {args.coincidence_window_ns}"
         cmd = apptainer_prefix + f"{count_cmd}'\""
-        sbatch_job(run_id, analysis_id, cmd, tlim)
+        # Jobs (and their logs) are named after their first run id.
+        sbatch_job(run_ids[0], analysis_id, cmd, tlim, args.workers)
 
 
-def sbatch_job(run_id, analysis_id, cmd, tlim):
+def sbatch_job(run_id, analysis_id, cmd, tlim, cpus_per_task=1):
     """
     Replaces SGE qsub with Slurm sbatch.
     Uses --wrap for inline command submission.
@@ -59,6 +72,8 @@ def sbatch_job(run_id, analysis_id, cmd, tlim):
         "--export=ALL",
         "--mail-type=NONE",
     ]
+    if cpus_per_task > 1:
+        sbatch_opts.append(f"--cpus-per-task={cpus_per_task}")
 
     sbatch_str = " ".join(sbatch_opts)
     batch_cmd = f"sbatch {sbatch_str} --wrap={cmd}"
@@ -72,6 +72,47 @@ def main():
             """,
     )
 
+    arg(
+        "-step_size",
+        "--step-size",
+        type=str,
+        default=None,
+        help="stream track points in chunks of this many entries (ex: 10000) or bytes (ex: 100MB).",
+    )
+    arg(
+        "-workers",
+        "--workers",
+        type=int,
+        default=1,
+        help="number of worker processes (and cpus requested) per stage 1 job.",
+    )
+    arg(
+        "-no_cache",
+        "--no-cache",
+        action="store_true",
+        help="read the root files directly, without the root table cache.",
+    )
+    arg(
+        "-refresh_cache",
+        "--refresh-cache",
+        action="store_true",
+        help="re-read the root files and overwrite their entries in the root table cache.",
+    )
+    arg(
+        "-nearest_on_server",
+        "--nearest-on-server",
+        action="store_true",
+        help="have he6cres_db pick the slow control rows nearest each file (stage 0).",
+    )
+    arg(
+        "-output_format",
+        "--output-format",
+        type=str,
+        choices=["csv", "parquet"],
+        default="csv",
+        help="write tracks and track points as csv or as parquet partitioned by run_id (stages 1 and 2).",
+    )
+
     args = par.parse_args()
 
     tlim = "12:00:00" if args.tlim is None else args.tlim[0]
@@ -90,22 +131,36 @@ def main():
         "/data/raid2/eliza4/he6_cres/rocks_analysis_pipeline/run_post_processing_2025LTF.py "
         "-rids {rids} -aid {aid} -name \"{name}\" "
         "-nft {nft} -nfp {nfp} -fid {fid} -stage {stage} "
-        "-ms_standard {ms_standard}"
+        "-ms_standard {ms_standard} -workers {workers} -output_format {output_format}"
     )
 
+    if args.step_size is not None:
+        base_post_processing_cmd += f" -step_size {args.step_size}"
+    if args.no_cache:
+        base_post_processing_cmd += " -no_cache"
+    if args.refresh_cache:
+        base_post_processing_cmd += " -refresh_cache"
+    if args.nearest_on_server:
+        base_post_processing_cmd += " -nearest_on_server"
+
     rids_formatted = " ".join(str(rid) for rid in args.run_ids)
+    # The same for every stage, only fid changes.
+    cmd_fields = dict(
+        rids=rids_formatted,
+        aid=args.analysis_id,
+        name=args.experiment_name,
+        nft=args.num_files_tracks,
+        nfp=args.num_files_points,
+        stage=args.stage,
+        ms_standard=args.ms_standard,
+        workers=args.workers,
+        output_format=args.output_format,
+    )
 
     if args.stage == 0:
         file_id = -1
         post_processing_cmd = base_post_processing_cmd.format(
-            rids=rids_formatted,
-            aid=args.analysis_id,
-            name=args.experiment_name,
-            nft=args.num_files_tracks,
-            nfp=args.num_files_points,
-            fid=file_id,
-            stage=args.stage,
-            ms_standard=args.ms_standard
+            fid=file_id, **cmd_fields
         )
         cmd = apptainer_prefix + f"{post_processing_cmd}'\""
         print(cmd)
@@ -120,31 +175,17 @@ def main():
         for file_id in range(files_to_process):
 
             post_processing_cmd = base_post_processing_cmd.format(
-                rids=rids_formatted,
-                aid=args.analysis_id,
-                name=args.experiment_name,
-                nft=args.num_files_tracks,
-                nfp=args.num_files_points,
-                fid=file_id,
-                stage=args.stage,
-                ms_standard=args.ms_standard
+                fid=file_id, **cmd_fields
             )
             cmd = apptainer_prefix + f"{post_processing_cmd}'\""
             print(cmd)
 
-            sbatch_job(args.experiment_name, args.analysis_id, file_id, cmd, tlim)
+            sbatch_job(args.experiment_name, args.analysis_id, file_id, cmd, tlim, args.workers)
 
     if args.stage == 2:
         file_id = -1
         post_processing_cmd = base_post_processing_cmd.format(
-            rids=rids_formatted,
-            aid=args.analysis_id,
-            name=args.experiment_name,
-            nft=args.num_files_tracks,
-            nfp=args.num_files_points,
-            fid=file_id,
-            stage=args.stage,
-            ms_standard=args.ms_standard
+            fid=file_id, **cmd_fields
         )
         cmd = apptainer_prefix + f"{post_processing_cmd}'\""
         print(cmd)
@@ -155,7 +196,9 @@ def main():
     #set_permissions()
 
 
-def sbatch_job(experiment_name: str, analysis_id: int, file_id: int, cmd: str, tlim: str):
+def sbatch_job(
+    experiment_name: str, analysis_id: int, file_id: int, cmd: str, tlim: str, cpus_per_task: int = 1
+):
     """
     Submit an inline command via Slurm's --wrap.
     """
@@ -170,6 +213,8 @@ def sbatch_job(experiment_name: str, analysis_id: int, file_id: int, cmd: str, t
         "--export=ALL",
         "--mail-type=NONE",
     ]
+    if cpus_per_task > 1:
+        sbatch_opts.append(f"--cpus-per-task={cpus_per_task}")
 
     sbatch_str = " ".join(sbatch_opts)
     batch_cmd = f"sbatch {sbatch_str} --wrap={cmd}"
@@ -0,0 +1,58 @@
+"""
+dbscan_1d against sklearn's DBSCAN fitted on each group separately.
+"""
+import numpy as np
+import pytest
+from sklearn.cluster import DBSCAN
+
+from clustering_utility import dbscan_1d
+
+
+def sklearn_labels(values, group_codes, eps):
+    """
+    The per-group DBSCAN loop that dbscan_1d replaces.
+    """
+    eps = np.broadcast_to(np.asarray(eps, dtype=np.float64), values.shape)
+    labels = np.full(len(values), np.nan)
+    for code in np.unique(group_codes[group_codes >= 0]):
+        rows = group_codes == code
+        labels[rows] = DBSCAN(eps=eps[rows][0], min_samples=1).fit(values[rows, None]).labels_
+
+    return labels
+
+
+@pytest.mark.parametrize("seed", range(5))
+def test_dbscan_1d_matches_sklearn(seed):
+    rng = np.random.default_rng(seed)
+    num_rows = 500
+    # Values on a 0.25 grid so that there are ties and gaps of exactly eps.
+    values = rng.integers(0, 200, num_rows) * 0.25
+    group_codes = rng.integers(-1, 20, num_rows)
+    group_eps = rng.choice([0.25, 0.5, 1.0], 20)
+    eps = np.where(group_codes >= 0, group_eps[group_codes], np.nan)
+
+    np.testing.assert_array_equal(
+        dbscan_1d(values, group_codes, eps), sklearn_labels(values, group_codes, eps)
+    )
+
+
+def test_dbscan_1d_eps_boundary():
+    # Gaps of exactly eps join, gaps just over it split.
+    values = np.array([0.0, 0.5, 1.0, 1.5000001, 1.5000001, 3.0])
+    group_codes = np.zeros(len(values), dtype=np.int64)
+
+    labels = dbscan_1d(values, group_codes, 0.5)
+
+    np.testing.assert_array_equal(labels, [0, 0, 0, 1, 1, 2])
+    np.testing.assert_array_equal(labels, sklearn_labels(values, group_codes, 0.5))
+
+
+def test_dbscan_1d_labels_by_first_row():
+    # Labels follow the order of the first row of each cluster, as sklearn's do.
+    values = np.array([10.0, 0.0, 10.2, 5.0, 0.1])
+    group_codes = np.array([0, 0, 0, 1, -1])
+
+    labels = dbscan_1d(values, group_codes, 0.5)
+
+    np.testing.assert_array_equal(labels, [0, 1, 0, 0, np.nan])
+    np.testing.assert_array_equal(labels, sklearn_labels(values, group_codes, 0.5))
@@ -0,0 +1,143 @@
+"""
+The COPY text parsing of he6cres_db_copy_query(), on canned COPY output and
+a stand-in connection, against the DataFrame he6cres_db_query() builds from
+the rows psycopg2 returns.
+"""
+import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from rocks_utility import CopyChunks, copy_query, read_copy_text
+
+# (name, type oid) as in cursor.description.
+COLUMNS = [
+    ("id", 23),  # int4
+    ("value", 701),  # float8
+    ("ok", 16),  # bool
+    ("label", 25),  # text
+    ("created_at", 1114),  # timestamp
+]
+
+# COPY (...) TO STDOUT text: tab separated, NULL as \N, backslash escapes.
+COPY_TEXT = (
+    "1\t1.5\tt\tplain\t2024-01-01 00:00:00\n"
+    "2\t\\N\tf\ttab\\there\t2024-01-01 00:00:00.25\n"
+    "3\tNaN\tt\t\\N\t\\N\n"
+    "4\t-2\tf\tback\\\\slash \\N\\nnewline\t2024-01-01 00:00:01.000001\n"
+)
+
+# The same rows as psycopg2 returns them to he6cres_db_query().
+ROWS = [
+    (1, 1.5, True, "plain", datetime.datetime(2024, 1, 1)),
+    (2, None, False, "tab\there", datetime.datetime(2024, 1, 1, 0, 0, 0, 250000)),
+    (3, float("nan"), True, None, None),
+    (4, -2.0, False, "back\\slash N\nnewline", datetime.datetime(2024, 1, 1, 0, 0, 1, 1)),
+]
+
+
+def he6cres_db_query_result(rows, columns=COLUMNS):
+    """
+    The DataFrame he6cres_db_query() builds from the fetched rows.
+    """
+    return pd.DataFrame(rows, columns=[name for name, _ in columns])
+
+
+class StandInCursor:
+    """
+    Just enough of a psycopg2 cursor for copy_query(): the LIMIT 0 describe
+    and a COPY that writes copy_text one row per write, as psycopg2 does.
+    """
+
+    def __init__(self, columns, copy_text):
+        self.columns = columns
+        self.copy_text = copy_text
+        self.copy_sql = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def mogrify(self, query, params):
+        return (query % tuple(f"'{param}'" for param in params)).encode()
+
+    def execute(self, query, params=None):
+        self.description = [(name, type_code) for name, type_code in self.columns]
+
+    def copy_expert(self, sql, file):
+        self.copy_sql = sql
+        for line in self.copy_text.splitlines(keepends=True):
+            file.write(line.encode())
+
+
+class StandInConnection:
+    def __init__(self, columns, copy_text):
+        self.cursor_ = StandInCursor(columns, copy_text)
+
+    def cursor(self):
+        return self.cursor_
+
+
+def test_read_copy_text_matches_he6cres_db_query():
+    result = read_copy_text(COPY_TEXT, COLUMNS)
+
+    # Bools stay nullable per chunk; CopyChunks.result() settles them.
+    expected = he6cres_db_query_result(ROWS).astype({"ok": "boolean"})
+    pd.testing.assert_frame_equal(result, expected)
+
+
+@pytest.mark.parametrize("chunk_bytes", [1, 40, 1 << 20])
+def test_copy_chunks_split_at_rows(chunk_bytes):
+    output = CopyChunks(COLUMNS, chunk_bytes=chunk_bytes)
+    for line in COPY_TEXT.splitlines(keepends=True):
+        output.write(line.encode())
+
+    pd.testing.assert_frame_equal(output.result(), he6cres_db_query_result(ROWS))
+
+
+def test_copy_query_timestamptz_as_naive_utc():
+    columns = [("id", 23), ("created_at", 1184)]  # timestamptz
+    # What the server prints for (created_at AT TIME ZONE 'UTC').
+    connection = StandInConnection(columns, "1\t2024-01-01 08:00:00.5\n2\t\\N\n")
+
+    result = copy_query(connection, "SELECT id, created_at FROM t WHERE id > %s", [0])
+
+    assert "(q.\"created_at\" AT TIME ZONE 'UTC') AS \"created_at\"" in connection.cursor_.copy_sql
+    assert "WHERE id > '0'" in connection.cursor_.copy_sql
+    # he6cres_db_query() gives these tz aware; the copy path gives naive UTC.
+    expected = he6cres_db_query_result(
+        [(1, datetime.datetime(2024, 1, 1, 8, 0, 0, 500000)), (2, None)], columns
+    )
+    pd.testing.assert_frame_equal(result, expected)
+
+
+def test_copy_query_nullable_bool_and_numeric():
+    columns = [("ok", 16), ("amount", 1700)]  # bool, numeric
+    connection = StandInConnection(columns, "t\t1.25\n\\N\t\\N\n")
+
+    result = copy_query(connection, "SELECT ok, amount FROM t")
+
+    assert "AT TIME ZONE" not in connection.cursor_.copy_sql
+    assert result["ok"].dtype == "boolean"
+    assert result["ok"].isna().tolist() == [False, True]
+    # numeric comes back float64, not Decimal.
+    assert result["amount"].dtype == np.float64
+
+
+def test_copy_query_empty_result():
+    connection = StandInConnection(COLUMNS, "")
+
+    result = copy_query(connection, "SELECT * FROM t")
+
+    assert result.empty
+    assert list(result.columns) == [name for name, _ in COLUMNS]
+    assert result.dtypes.to_dict() == {
+        "id": np.int64,
+        "value": np.float64,
+        "ok": bool,
+        "label": read_copy_text("x\n", [("label", 25)])["label"].dtype,
+        "created_at": he6cres_db_query_result(ROWS)["created_at"].dtype,
+    }
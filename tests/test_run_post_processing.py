@@ -0,0 +1,418 @@
+"""
+The vectorized PostProcessing reductions against the row-wise versions they
+replaced, on small synthetic track tables.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.cluster import DBSCAN
+
+# Needs he6_cres_spec_sims (on rocks) to import.
+rpp = pytest.importorskip("run_post_processing")
+
+SET_FIELDS = np.array([1.0, 2.0])
+
+
+def post_processing():
+    """
+    PostProcessing with only the settings the reductions use.
+    """
+    pp = rpp.PostProcessing.__new__(rpp.PostProcessing)
+    pp.set_fields = SET_FIELDS.copy()
+    pp.workers = 1
+    pp.get_slope = lambda field, frequency=19.15e9: 1e11 * field
+
+    return pp
+
+
+def event_tracks(seed=0, num_tracks=300):
+    """
+    Tracks as add_event_info gets them, shuffled, with several tracks per
+    event and events spread over files and acquisitions.
+    """
+    rng = np.random.default_rng(seed)
+    start = rng.uniform(0, 1, num_tracks)
+    start_freq = rng.uniform(1e8, 2e9, num_tracks)
+    time_length = rng.uniform(1e-4, 1e-2, num_tracks)
+    slope = rng.uniform(1e10, 3e11, num_tracks)
+    field = rng.choice(SET_FIELDS, num_tracks)
+
+    tracks = pd.DataFrame(
+        {
+            "run_id": rng.integers(1, 3, num_tracks),
+            "file_id": rng.integers(0, 3, num_tracks),
+            "EventID": rng.integers(0, 8, num_tracks),
+            "TrackID": np.arange(num_tracks),
+            "EventSequenceID": rng.integers(0, 4, num_tracks),
+            "Acq_ID": rng.integers(1, 3, num_tracks),
+            "StartTimeInRunC": start,
+            "EndTimeInRunC": start + time_length,
+            "StartTimeInAcq": start - 0.1,
+            "EndTimeInAcq": start + time_length - 0.1,
+            "StartFrequency": start_freq,
+            "EndFrequency": start_freq + time_length * slope,
+            "TimeLength": time_length,
+            "NTrackBins": rng.integers(1, 50, num_tracks),
+            "MeanTrackSNR": rng.uniform(5, 50, num_tracks),
+            "TotalTrackSNR": rng.uniform(10, 500, num_tracks),
+            "MaxTrackSNR": rng.uniform(10, 100, num_tracks),
+            "TotalTrackNUP": rng.uniform(1, 10, num_tracks),
+            "TotalPower": rng.uniform(1e-15, 1e-14, num_tracks),
+            "MeanTrackSNR_Percentile": rng.uniform(0, 100, num_tracks),
+            "field": field,
+            "set_field": field,
+        }
+    )
+    # A single track event, whose std reductions are NaN.
+    tracks.loc[0, ["run_id", "file_id", "EventID"]] = [9, 9, 9]
+
+    return tracks.sample(frac=1, random_state=seed).reset_index(drop=True)
+
+
+def old_add_event_info(pp, tracks_in):
+    """
+    add_event_info before user-007: one groupby transform per column.
+    """
+    tracks = tracks_in.copy()
+    event_key = ["run_id", "file_id", "EventID"]
+
+    tracks["Acq_ID"] = tracks.groupby(event_key)["Acq_ID"].transform("mean")
+    tracks["EventStartTime"] = tracks.groupby(event_key)["StartTimeInRunC"].transform("min")
+    tracks["EventStartTimeInAcq"] = tracks.groupby(event_key)["StartTimeInAcq"].transform("min")
+    tracks["EventEndTime"] = tracks.groupby(event_key)["EndTimeInRunC"].transform("max")
+    tracks["EventEndTimeInAcq"] = tracks.groupby(event_key)["EndTimeInAcq"].transform("max")
+    tracks["EventStartFreq"] = tracks.groupby(event_key)["StartFrequency"].transform("min")
+    tracks["EventEndFreq"] = tracks.groupby(event_key)["EndFrequency"].transform("max")
+    tracks["EventTimeLength"] = tracks["EventEndTime"] - tracks["EventStartTime"]
+    tracks["EventFreqLength"] = tracks["EventEndFreq"] - tracks["EventStartFreq"]
+    tracks["EventNBins"] = tracks.groupby(event_key)["NTrackBins"].transform("sum")
+    tracks["EventSlope"] = tracks["EventFreqLength"] / tracks["EventTimeLength"]
+    tracks["EventTrackCoverage"] = (
+        tracks.groupby(event_key)["TimeLength"].transform("sum") / tracks["EventTimeLength"]
+    )
+    for prefix, column in [
+        ("MeanSNR", "MeanTrackSNR"),
+        ("TotalSNR", "TotalTrackSNR"),
+        ("MaxSNR", "MaxTrackSNR"),
+        ("TotalNUP", "TotalTrackNUP"),
+        ("TotalPower", "TotalPower"),
+        ("MeanSNR_Percentile", "MeanTrackSNR_Percentile"),
+    ]:
+        tracks["m" + prefix] = tracks.groupby(event_key)[column].transform("mean")
+        tracks["s" + prefix] = tracks.groupby(event_key)[column].transform("std")
+    tracks["EventTrackTot"] = tracks.groupby(event_key).EventSequenceID.transform("count")
+
+    tracks["EventFreqIntc"] = (
+        tracks["EventEndFreq"] - tracks["EventEndTime"] * tracks["EventSlope"]
+    )
+    tracks["EventTimeIntc"] = (
+        tracks["EventStartTime"] - tracks["EventStartFreq"] / tracks["EventSlope"]
+    )
+    tracks["EventFreqIntA"] = (
+        tracks["EventEndFreq"] - tracks["EventEndTimeInAcq"] * tracks["EventSlope"]
+    )
+    tracks["EventTimeIntA"] = (
+        tracks["EventStartTimeInAcq"] - tracks["EventStartFreq"] / tracks["EventSlope"]
+    )
+
+    approx_slopes = np.array([pp.get_slope(field) * 1e-9 for field in pp.set_fields])
+    tracks["FieldAveSlope"] = approx_slopes[np.searchsorted(pp.set_fields, tracks["set_field"])]
+    tracks["Eventb"] = 0.6 + 1 / tracks["FieldAveSlope"] * 0.5
+    tracks["Eventtheta"] = np.arctan(1 / tracks["FieldAveSlope"])
+    tracks["Eventx0"] = (tracks["Eventb"] - tracks["EventFreqIntc"] * 1e-9) / (
+        tracks["EventSlope"] * 1e-9 + (1 / tracks["FieldAveSlope"])
+    )
+    tracks["EventPerpInt"] = (tracks["Eventb"] - tracks["EventFreqIntc"] * 1e-9) / (
+        (tracks["EventSlope"] * 1e-9 + (1 / tracks["FieldAveSlope"])) * np.cos(tracks["Eventtheta"])
+    )
+
+    return tracks
+
+
+def test_add_event_info_matches_groupby_transforms():
+    pp = post_processing()
+    tracks = event_tracks()
+
+    expected = old_add_event_info(pp, tracks)
+    result = pp.add_event_info(tracks)
+
+    pd.testing.assert_frame_equal(result, expected, check_exact=False, rtol=1e-12)
+
+
+def clustered_events(seed=0, num_events=200):
+    """
+    Events as merge_clustered_events gets them from cluster_events: several
+    rows share each new (run_id, file_id, Acq_ID, EventID).
+    """
+    rng = np.random.default_rng(seed)
+    events = pd.DataFrame(
+        {column: rng.uniform(0, 1, num_events) for column in rpp.EVENT_COLS}
+    )
+    events["run_id"] = rng.integers(1, 3, num_events)
+    events["file_id"] = rng.integers(0, 3, num_events)
+    events["Acq_ID"] = rng.integers(1, 3, num_events).astype(float)
+    events["EventID"] = rng.integers(1, 6, num_events).astype(float)
+    events["EventNBins"] = rng.integers(1, 50, num_events)
+    events["EventTrackTot"] = rng.integers(1, 5, num_events)
+    events["event_label"] = events["EventID"] - 1
+    # A NaN in one of the averaged columns.
+    events.loc[0, "sMeanSNR"] = np.nan
+
+    return events.sample(frac=1, random_state=seed).reset_index(drop=True)
+
+
+def old_merge_clustered_events(events_in):
+    """
+    update_event_info then build_events, before user-008: a transform per
+    column broadcast to every row, then .first() of each event.
+    """
+    events = events_in.copy()
+    events = events.loc[:, ~events.columns.duplicated()]
+    event_key = ["run_id", "file_id", "Acq_ID", "EventID"]
+
+    for column, how in [
+        ("EventStartTime", "min"),
+        ("EventStartTimeInAcq", "min"),
+        ("EventEndTime", "max"),
+        ("EventEndTimeInAcq", "max"),
+        ("EventStartFreq", "min"),
+        ("EventEndFreq", "max"),
+    ]:
+        events[column] = events.groupby(event_key)[column].transform(how)
+
+    events["EventTimeLength"] = events["EventEndTime"] - events["EventStartTime"]
+    events["EventFreqLength"] = events["EventEndFreq"] - events["EventStartFreq"]
+    events["EventNBins"] = events.groupby(event_key)["EventNBins"].transform("sum")
+    events["EventSlope"] = events["EventFreqLength"] / events["EventTimeLength"]
+
+    cols_to_average_over = [
+        "EventTrackCoverage",
+        "EventTrackTot",
+        "EventFreqIntc",
+        "EventTimeIntc",
+        "EventFreqIntA",
+        "EventTimeIntA",
+        "mMeanSNR",
+        "sMeanSNR",
+        "mTotalSNR",
+        "sTotalSNR",
+        "mMaxSNR",
+        "sMaxSNR",
+        "mTotalNUP",
+        "sTotalNUP",
+        "mTotalPower",
+        "sTotalPower",
+        "mMeanSNR_Percentile",
+        "sMeanSNR_Percentile",
+        "field",
+        "set_field",
+        "arduino_monitor_rate",
+        "FieldAveSlope",
+        "EventPerpInt",
+    ]
+    for column in cols_to_average_over:
+        events[column] = events.groupby(event_key)[column].transform("mean")
+
+    return events.groupby(event_key).first().reset_index()[rpp.EVENT_COLS]
+
+
+def test_merge_clustered_events_matches_transforms_then_first():
+    pp = post_processing()
+    events = clustered_events()
+
+    expected = old_merge_clustered_events(events)
+    result = pp.merge_clustered_events(events)
+
+    assert len(result) < len(events)
+    pd.testing.assert_frame_equal(result, expected, check_exact=False, rtol=1e-12)
+
+
+def file_tracks(seed=0, tracks_per_file=40):
+    """
+    Raw tracks of a few files and their slew times. Some tracks start
+    before the first acquisition of their file, some exactly on a Time_On,
+    and one file has no slew times at all.
+    """
+    rng = np.random.default_rng(seed)
+    time_on = np.array([0.1, 0.4, 0.7])
+
+    tracks, slewtimes = [], []
+    for run_id, file_id in [(1, 0), (1, 1), (2, 0), (2, 5)]:
+        start = rng.uniform(0, 1, tracks_per_file)
+        start[:3] = [0.05, time_on[1], time_on[2]]
+        start_freq = rng.uniform(1e8, 2e9, tracks_per_file)
+        time_length = rng.uniform(1e-4, 1e-2, tracks_per_file)
+        slope = rng.uniform(1e10, 3e11, tracks_per_file)
+        tracks.append(
+            pd.DataFrame(
+                {
+                    "run_id": run_id,
+                    "file_id": file_id,
+                    "TrackID": np.arange(tracks_per_file),
+                    "EventID": rng.integers(0, 10, tracks_per_file),
+                    "StartTimeInRunC": start,
+                    "EndTimeInRunC": start + time_length,
+                    "StartFrequency": start_freq,
+                    "EndFrequency": start_freq + time_length * slope,
+                    "Slope": slope,
+                    "TimeLength": time_length,
+                    "NTrackBins": rng.integers(1, 50, tracks_per_file),
+                    "TotalTrackSNR": rng.uniform(10, 500, tracks_per_file),
+                    "field": rng.choice(SET_FIELDS, tracks_per_file),
+                }
+            )
+        )
+        if file_id != 5:
+            slewtimes.append(
+                pd.DataFrame(
+                    {
+                        "Time_On": time_on,
+                        "Time_Off": time_on + 0.25,
+                        "on_length": 0.25,
+                        "run_id": run_id,
+                        "file_id": file_id,
+                    }
+                )
+            )
+
+    return pd.concat(tracks, ignore_index=True), pd.concat(slewtimes, ignore_index=True)
+
+
+def old_add_track_info(tracks, slewtimes):
+    """
+    add_track_info before user-009: every track merged with every slew time
+    of its file, then the latest acquisition the event's start is in.
+    """
+    tracks = tracks.copy()
+    tracks["set_field"] = tracks["field"].round(decimals=2)
+    tracks["FreqIntc"] = tracks["EndFrequency"] - tracks["EndTimeInRunC"] * tracks["Slope"]
+    tracks["TimeIntc"] = tracks["StartTimeInRunC"] - tracks["StartFrequency"] / tracks["Slope"]
+    tracks["MeanTrackSNR"] = tracks["TotalTrackSNR"] / tracks["NTrackBins"]
+    bins = np.arange(100e6, 2400e6 + 10e6, 10e6)
+    tracks["FrequencyBin"] = pd.cut(
+        tracks["StartFrequency"], bins, labels=np.arange(len(bins) - 1), include_lowest=True
+    )
+    tracks["MeanTrackSNR_Percentile"] = (
+        tracks.groupby(["FrequencyBin", "set_field"], observed=False)["MeanTrackSNR"].transform(
+            lambda s: s.rank(pct=True)
+        )
+        * 100
+    )
+
+    merged_df = pd.merge(tracks, slewtimes, on=["run_id", "file_id"])
+    merged_df = merged_df[merged_df["StartTimeInRunC"] >= merged_df["Time_On"]]
+    merged_df_E = merged_df.rename(columns={"StartTimeInRunC": "StartTimeInRunC_E"})
+    earliest_start_time = (
+        merged_df_E.groupby(["run_id", "file_id", "EventID"])["StartTimeInRunC_E"]
+        .min()
+        .reset_index()
+    )
+    merged_earliest = pd.merge(merged_df, earliest_start_time, on=["run_id", "file_id", "EventID"])
+    merged_earliest = merged_earliest[
+        merged_earliest["StartTimeInRunC_E"] >= merged_earliest["Time_On"]
+    ]
+    merged_earliest["Acq_ID"] = (
+        merged_earliest.groupby(["run_id", "file_id", "TrackID"]).cumcount() + 1
+    )
+    max_acq_id_indices = merged_earliest.groupby(["run_id", "file_id", "TrackID"])[
+        "Acq_ID"
+    ].idxmax()
+    tracks = merged_earliest.loc[max_acq_id_indices]
+    tracks = tracks.drop(columns=["StartTimeInRunC_E"])
+
+    tracks["StartTimeInAcq"] = tracks["StartTimeInRunC"] - tracks["Time_On"]
+    tracks["EndTimeInAcq"] = tracks["EndTimeInRunC"] - tracks["Time_On"]
+    tracks["FreqIntA"] = tracks["EndFrequency"] - tracks["EndTimeInAcq"] * tracks["Slope"]
+    tracks["TimeIntA"] = tracks["StartTimeInAcq"] - tracks["StartFrequency"] / tracks["Slope"]
+
+    intc_info = (
+        tracks.groupby(["run_id", "file_id", "EventID"])
+        .agg(
+            TimeIntc_mean=("TimeIntc", "mean"),
+            TimeIntc_std=("TimeIntc", "std"),
+            TimeIntA_mean=("TimeIntA", "mean"),
+            TimeIntA_std=("TimeIntA", "std"),
+            TimeLength_mean=("TimeLength", "mean"),
+            TimeLength_std=("TimeLength", "std"),
+            Slope_mean=("Slope", "mean"),
+            Slope_std=("Slope", "std"),
+        )
+        .reset_index()
+    )
+
+    return pd.merge(tracks, intc_info, how="left", on=["run_id", "file_id", "EventID"])
+
+
+def test_add_track_info_matches_tracks_x_slewtimes_merge():
+    pp = post_processing()
+    tracks, slewtimes = file_tracks()
+
+    expected = old_add_track_info(tracks, slewtimes)
+    result = pp.add_track_info(tracks.copy(), slewtimes.copy())
+
+    # Tracks before the first acquisition or in a file with no slew times are dropped.
+    assert len(result) < len(tracks)
+    assert not (result["file_id"] == 5).any()
+    pd.testing.assert_frame_equal(result, expected, check_exact=False, rtol=1e-12)
+
+
+CLUST_PARAMS = {
+    1.0: {"features": ["EventPerpInt"], "eps": 0.5},
+    2.0: {"features": ["EventStartTime", "EventPerpInt"], "eps": 0.5},
+}
+
+
+def unclustered_events(seed=0, num_events=300):
+    """
+    Events before clustering, with ties and gaps of exactly eps in
+    EventPerpInt and a few with no Acq_ID.
+    """
+    rng = np.random.default_rng(seed)
+    events = pd.DataFrame(
+        {
+            "run_id": rng.integers(1, 3, num_events),
+            "file_id": rng.integers(0, 3, num_events),
+            "Acq_ID": rng.integers(1, 4, num_events).astype(float),
+            "EventID": rng.integers(1, 10, num_events),
+            "EventStartTime": rng.uniform(0, 2, num_events),
+            "EventPerpInt": rng.integers(0, 40, num_events) * 0.25,
+        }
+    )
+    # One set field per (run_id, file_id), so that its groups share their clust_params.
+    events["field"] = np.where(events["run_id"] == 1, 1.0, 2.0) + rng.normal(0, 1e-4, num_events)
+    events.loc[:4, "Acq_ID"] = np.nan
+
+    return events.sample(frac=1, random_state=seed).reset_index(drop=True)
+
+
+def old_cluster_events(events):
+    """
+    cluster_events before user-010: a DBSCAN fit per (run_id, file_id, Acq_ID).
+    """
+    events_copy = events.copy()
+    events_copy["event_label"] = np.nan
+    for name, group in events_copy.groupby(["run_id", "file_id", "Acq_ID"]):
+        params = CLUST_PARAMS[group.field.mean().round(2)]
+        condition = (
+            (events_copy.run_id == name[0])
+            & (events_copy.file_id == name[1])
+            & (events_copy.Acq_ID == name[2])
+        )
+        X = events_copy.loc[condition, params["features"]]
+        db = DBSCAN(eps=params["eps"], min_samples=1).fit(X)
+        events_copy.loc[condition, "event_label"] = db.labels_
+    events_copy["EventID"] = events_copy["event_label"] + 1
+
+    return events_copy
+
+
+def test_cluster_events_matches_dbscan_per_acquisition():
+    pp = post_processing()
+    pp.clust_params = CLUST_PARAMS
+    events = unclustered_events()
+
+    expected = old_cluster_events(events)
+    result = pp.cluster_events(events)
+
+    assert result["event_label"].isna().sum() == 5
+    pd.testing.assert_frame_equal(result, expected)